@@ -10,12 +10,32 @@
     Parser commands that can be passed from command line/terminal: 
     -i {Index Name} Insert command -  with index_name as latest_only_year_month_day or all_years_year_month_day 
     -f              Force  command - used when inserting which removes and insert forms versus just inserting    
-    -l {Number}     Limit  command - Number of forms that will be inserted simultaneously default 1000
+    -l {Number}     Limit  command - Number of forms that will be inserted simultaneously (one bulk write) default 1000
     -c {Number}     Continue command - Location from an index where you want to continue/begin inserting/processing 
-    -u              Update command - Re downloads a specific index incase things have changed   
+    -s {Number}     Stop command - Used with -c, number of filings to process from the -c location (default until the end of the index)
+    --form-type {T} Only process the filings of an index with FormType T (990, 990EZ or 990PF), -c & -s count filtered filings
+    --tax-year {Y}  Only process the filings of an index with TaxYear Y, -c & -s count filtered filings
+    --since-last-run Only process the filings of the index that are new or changed (FileSha256) since they were stored, see helpers/database/checkpoints.py
+    --resume {ID}   Continue run ID of the same -i index (its id is printed when it starts) skipping the filings it completed or that failed, needs --mongodb
+    --retry-failed {ID} Process only the filings that failed in run ID of the same -i index, needs --mongodb
+    -u              Update command - Re downloads a specific index incase things have changed, only fields & schedules that changed are written
+    --normalize-tables Store each row of a table (i.e. schedule I grants) as its own document in a collection per table instead of inside its form, see helpers/database/table_rows.py
+    --reparse       Process every filing even when its fingerprint (FileSha256, mapping & parser version) shows it is stored unchanged, see helpers/database/fingerprints.py
+    --async         Download filings concurrently (connection pooling, retries) while earlier filings are parsed, see settings/Settings.py for limits
+    --workers {N}   Number of processes that parse the filings of an index in parallel default 1
+    --stream        Parse each filing while it downloads (iterparse) instead of loading it whole, use for very large filings
+    --zip           Read the filings out of the datalake zip archives named in the index (ZipFile) one archive at a time instead of downloading them one by one
+    --cache         Keep downloaded filings on disk by FileSha256 and read them from there next time, see settings/Settings.py for the size limit
     --local         Index is available locally in helpers/indices/
     --gtdatalake    Index is to be downloaded from the givingtuesday datalake. Index name above in -i must follow giving tuesday naming conventions
     --mongodb       Mongo 
+    --sink {S}      Where forms are written: mongo (default, with --mongodb), parquet, ndjson or columnar (files in --output, no database needed)
+                    columnar writes the fixed typed columns of every variable in the concordance with tables & repeating variables as child tables
+    --output {Dir}  Folder the parquet/ndjson/columnar sinks write to, see settings/Settings.py for the default
+    --typed         Store amounts & counts as integers, percentages as floats, checkboxes as booleans & dates as dates instead of text (mongo & ndjson)
+    --metrics-port {N} Time each stage (download, xml parse, path extraction, tables, schedules, mongo) per form type & serve p50/p95/p99 at http://127.0.0.1:N/metrics
+    --metrics-file {F} Same timings written as json to file F every few seconds, see settings/Settings.py for the interval
+    --check-indexes Prints the explain plan of each query we run per form against mongo (are the indexes used?) then exits
     --qa            Specifies the environment QA            - Local Test Environment
     --prod          Specifies the environment PRODUCTION    - AWS Production Environment 
     
@@ -39,26 +59,55 @@ import sys  # python library allows us to use sys values like from terminal
 import re  # allows us to use regular expressions
 import os  # allows us to use operating system functions
 from datetime import datetime  # allows us to figure out what current date is etc
+from itertools import islice  # allows us to start & stop part way through the filings of an index
 # allows us to parellelize the running of our code
 from multiprocessing import Process, Pool
 # Allows us to update an index i.e. process an index for latest filings
 from helpers.index_downloader import fetch_filings_updated
-# Given a index_name Downloads an index from aws and creates a list of filings
-from helpers.index_downloader import fetch_filings_from_index_file
+# Given a index_name Downloads an index from aws and reads its filings one at a time
+from helpers.index_downloader import iter_filings_from_index_file, count_filings_in_index_file
+# Allows us to read & filter the columns of an index from its memory mapped sidecar instead of the json
+from helpers.index_downloader import load_index_sidecar, filter_index_sidecar, iter_filings_from_index_sidecar
+# Downloads filings concurrently while we parse (--async) or one after the other
+from helpers.xml_downloader import fetch_xmls, read_xmls
+# Keeps downloaded filings on disk so they aren't downloaded again (--cache)
+from helpers.xml_cache import XmlCache
 # Parser is what we use to parse xml
 from helpers.parser.formparser import FormParser
+# Allows us to parse the filings of an index with a pool of worker processes (--workers)
+from helpers.parser.workers import create_pool, parse_filings, parse_archives
+# Allows us to store forms into mongo in batches
+from helpers.database.bulk_writer import BulkWriter
+# Allows us to update forms in mongo by only writing what changed (-u)
+from helpers.database.updater import DiffUpdater
+# Allows us to write forms to files instead of mongo (--sink)
+from helpers.database.sinks import NdjsonSink, ParquetSink, ColumnarSink
+# Allows us to write forms with the fixed typed columns of every variable in the concordance (--sink columnar)
+from helpers.parser.catalog import VariableCatalog
+# Allows us to store values as the type implied by the concordance i.e. amounts as integers (--typed)
+from helpers.parser.coercion import Coercion
+# Allows us to remember which filings are stored in mongo so later runs only process new or changed filings (--since-last-run)
+from helpers.database.checkpoints import Checkpoints
+# Allows us to skip filings that are stored with the same fingerprint (FileSha256, mapping & parser version) before downloading them
+from helpers.database.fingerprints import Fingerprints
+# Allows us to time each stage of the parser & serve the timings (--metrics-port / --metrics-file)
+from helpers.metrics import METRICS
+# Allows us to create the mongo indexes we rely on & check they are used
+from helpers.database.interface import ensure_indexes, check_indexes
 # Allows us to read the mapping (list of variables) csv file
 from helpers.helpers import csv_to_object
 # Allows us to read the mapping (list of variables) for table values.
 from helpers.helpers import csv_table_to_object
+# Allows us to compile both mappings once so every parser can share them
+from helpers.helpers import csv_to_mapping
 # helper function takes a list of dictionaries and extracts certain values and outputs as a list of lists
 from helpers.helpers import partition_list
 # Allow us to access Mongodb
 from pymongo import MongoClient 
 # Import all variables that are hardcoded
-from settings.Settings import mongo_qa_details, mongo_production_details
+from settings.Settings import mongo_qa_details, mongo_production_details, sink_output_directory
 # Import Custom Logging
-from helpers.loggingutil import Log_Details, log_access, log_error, log_progress
+from helpers.loggingutil import Log_Details, log_access, log_error, log_progress, ProgressSummary
 
 # Store name of current script in Log_Details class object as script name. We do this so that error log will always tell us which script error comes from. 
 Log_Details.script = os.path.split(sys.argv[0])[1]
@@ -72,6 +121,20 @@ ARGS = sys.argv[1:]
 # Turn all args into string
 initial_args = ' '. join([str(arg) for arg in sys.argv[1:]])
 
+def forget(xml_link, fingerprints, checkpoints):
+
+    '''
+
+    Drops what fingerprints & checkpoints (either may be None) remember about a filing that couldn't be downloaded or parsed
+    so it doesn't linger until the end of the run (checkpoints journal it as failed)
+
+    '''
+
+    if fingerprints is not None:
+        fingerprints.forget(xml_link)
+    if checkpoints is not None:
+        checkpoints.forget(xml_link)
+
 def init(index_name):
 
     '''
@@ -121,6 +184,50 @@ def init(index_name):
         bject. Mapping_table is really a list of all tables in 
         forms and schedules. Output is a dictionary of Paths/Variables'''
 
+        # Step 2b. Compile both mappings into a trie of xml tags once so parsers dont redo this work per filing
+        CSV_MAPPING = csv_to_mapping(CSV_OBJECT, CSV_TABLE_OBJECT)
+
+        # Step 2c. Check to see if --stream is in arguments as that makes parsers read filings piece by piece (lower memory for very large filings)
+        STREAM = '--stream' in ARGS
+
+        # Step 2d. Check to see if --async is in arguments as that downloads filings concurrently while we parse
+        ASYNC = '--async' in ARGS
+
+        # Step 2e. Check to see how many worker processes should parse the filings of the index (--workers N) default 1 i.e. parse in this process
+        WORKERS = int((re.search("'--workers', '([0-9]+)'", str(sys.argv)) or re.search("(1)", "1")).group(1))
+
+        # Step 2f. Check to see if --cache is in arguments as that keeps downloaded filings on disk (by FileSha256) & reads them from there next time
+        CACHE = XmlCache() if '--cache' in ARGS else None
+
+        # Step 2g. Check to see if --zip is in arguments as that reads filings out of the zip archives named in the index instead of downloading each one
+        ZIP = '--zip' in ARGS
+
+        # Step 2h. Check to see where forms are written (--sink mongo|parquet|ndjson|columnar) mongo is the default & needs --mongodb, files go to --output
+        SINK = (re.search("'--sink', '(mongo|parquet|ndjson|columnar)'", str(sys.argv)) or re.search("(mongo)", "mongo")).group(1)
+        OUTPUT = (re.search("'--output', '([^']+)'", str(sys.argv)) or re.search("(.*)", sink_output_directory)).group(1)
+
+        # Step 2h1. Check to see if --typed is in arguments as that converts values to the type implied by the concordance (batches are converted by the writer)
+        TYPED = '--typed' in ARGS
+        COERCION = Coercion(VariableCatalog(CSV_MAPPING)) if TYPED else None
+
+        # Step 2h1a. Check to see if --normalize-tables is in arguments as that stores the rows of tables as documents of a collection per table (mongo only)
+        NORMALIZE_TABLES = '--normalize-tables' in ARGS
+
+        # Step 2h2. Check to see if --metrics-port or --metrics-file are in arguments as that times each stage of the parser per form type (off otherwise)
+        # the timings are served at http://127.0.0.1:PORT/metrics and/or written to a json file every few seconds
+        metrics_port = re.search("'--metrics-port', '([0-9]+)'", str(sys.argv))
+        metrics_file = re.search("'--metrics-file', '([^']+)'", str(sys.argv))
+        if metrics_port or metrics_file:
+            METRICS.enable()
+            if metrics_port:
+                METRICS.serve(int(metrics_port.group(1)))
+            if metrics_file:
+                METRICS.write_every(metrics_file.group(1))
+
+        # Step 2i. Make sure the indexes used to look up forms (FILEREIN, TAXYEAR) exist before we start writing to mongo
+        if (SINK == 'mongo' and '--mongodb' in ARGS) or '-u' in ARGS:
+            ensure_indexes()
+
         # Step 3a. Check to see if -u is in arguments as that triggers updating of document vs insertion
         if '-u' in ARGS:  
 
@@ -140,25 +247,46 @@ def init(index_name):
             '''
 
             # Step 3a1. Create Form Parser object and pass CSV Object & Table Object
-            form_parser = FormParser(CSV_OBJECT, CSV_TABLE_OBJECT)
+            form_parser = FormParser(CSV_OBJECT, CSV_TABLE_OBJECT, CSV_MAPPING, STREAM, TYPED)
+
+            # Step 3a1a. The updater compares batches of forms with what is stored (one query for the forms & one for their schedules per batch)
+            # and only writes the fields & schedules that changed, fields & schedules that are gone are removed
+            updater = DiffUpdater(int((re.search("'-l', '([0-9]+)'", str(sys.argv)) or re.search("(1000)", "1000")).group(1)), tables=NORMALIZE_TABLES)
 
             # Step 3a2. Grab latest version of index by using fetch_filings method from index_downloader.py script
             filings_updated = fetch_filings_updated(index_name)
             # Uncomment line below (and comment line above) to run test with simple filing
             # filings_updated = [{u'OrganizationName': u'JAWONIO RESIDENTIAL OPPORTUNITIES III INC', u'ObjectId': u'201803129349301355', u'URL': u'https://s3.amazonaws.com/irs-form-990/201803129349301355_public.xml', u'SubmittedOn': u'2018-12-03', u'DLN': u'93493312013558', u'LastUpdated': u'2019-02-21T16:25:33', u'TaxPeriod': u'201712', u'FormType': u'990', u'EIN': u'201078564'}]#, {u'OrganizationName': u'ROAD RUNNERS CLUB OF AMERICA 1174 PACE SETTERS RUNNING CLUB INC', u'ObjectId': u'201803269349300500', u'URL': u'https://s3.amazonaws.com/irs-form-990/201803269349300500_public.xml', u'SubmittedOn': u'2018-12-19', u'DLN': u'93493326005008', u'LastUpdated': u'2019-02-21T16:25:33', u'TaxPeriod': u'201712', u'FormType': u'990', u'EIN': u'391455942'}, {u'OrganizationName': u'UNITED HOMES FUND INC CO FLUSHING HOUSE', u'ObjectId': u'201803129349201105', u'URL': u'https://s3.amazonaws.com/irs-form-990/201803129349201105_public.xml', u'SubmittedOn': u'2018-12-03', u'DLN': u'93492312011058', u'LastUpdated': u'2019-02-21T16:25:33', u'TaxPeriod': u'201712', u'FormType': u'990EZ', u'EIN': u'112808943'}, {u'OrganizationName': u'HOUGHTON VOLUNTEER AMBULANCE SERVICE INC', u'ObjectId': u'201803119349201075', u'URL': u'https://s3.amazonaws.com/irs-form-990/201803119349201075_public.xml', u'SubmittedOn': u'2018-12-03', u'DLN': u'93492311010758', u'LastUpdated': u'2019-02-21T16:25:33', u'TaxPeriod': u'201712', u'FormType': u'990EZ', u'EIN': u'262980099'}, {u'OrganizationName': u'VALLEY MEMORIAL FOUNDATION', u'ObjectId': u'201803119349301280', u'URL': u'https://s3.amazonaws.com/irs-form-990/201803119349301280_public.xml', u'SubmittedOn': u'2018-11-30', u'DLN': u'93493311012808', u'LastUpdated': u'2019-02-21T16:25:33', u'TaxPeriod': u'201806', u'FormType': u'990', u'EIN': u'450392710'}, {u'OrganizationName': u'PLUMBERS AND STEAMFITTERS PROTECTIVE ASSOCIATION INC', u'ObjectId': u'201803119349302560', u'URL': u'https://s3.amazonaws.com/irs-form-990/201803119349302560_public.xml', u'SubmittedOn': u'2018-12-03', u'DLN': u'93493311025608', u'LastUpdated': u'2019-02-21T16:25:33', u'TaxPeriod': u'201712', u'FormType': u'990', u'EIN': u'526038675'}]
 
-            # Step 3a3. For each filing in the index, download, process index and store filing in mongo
-            for index, xml_list in enumerate(partition_list(filings_updated, 1)):
-                # creates a list of urls to download filings from filings_update (list of dictionaries)
-                for xml_link in xml_list:
+            # Step 3a2a. Skip the filings stored with the same fingerprint (FileSha256, mapping & parser version) as they wouldn't change anything
+            # (one query per batch) unless --reparse is passed, the forms that are written carry their fingerprint
+            fingerprints = Fingerprints(TYPED, skip='--reparse' not in ARGS, tables=NORMALIZE_TABLES)
+            filings_updated = fingerprints.changed(filings_updated, updater.batch_size)
+
+            # Step 3a3. For each filing in the index, download (or read from the cache with --cache), process index and store filing in mongo
+            for index, filing_list in enumerate(partition_list(filings_updated, 1, None)):
+                # creates a list of (url, xml bytes or None, error) from filings_update (list of dictionaries)
+                downloads = CACHE.fetch(filing_list, read_xmls) if CACHE is not None else ((filing['URL'], None, None) for filing in filing_list)
+                for xml_link, xml_data, error in downloads:
+                    if error is not None:
+                        log_error(error, str.format("Issue Downloadin the following xml_link: {0}.", xml_link), Log_Details)
+                        fingerprints.forget(xml_link)
+                        continue
                     # for each url link in list do following 2 steps
                     # 1. Download Document
                     # 2. Process document saves it as a form object/class
-                    form = form_parser.create(xml_link)
-                    # 3. Saves form to mongo using update data method in mongo inteface found in interface2.py
-                    form.update_data_mongo()
-                    # 3a. Inserts data into Schedules
-                    # 3b. Inserts data into main forms
+                    form = form_parser.create(xml_link, xml_data)
+                    if form is None:
+                        fingerprints.forget(xml_link)
+                        continue
+                    # 3. Buffers the form (with its fingerprint), the updater writes what changed since it was stored (or inserts it when it isn't stored yet) a batch at a time
+                    updater.add(fingerprints.stamp(form))
+                    # 3a. Inserts/updates/removes data of Schedules
+                    # 3b. Inserts/updates data of main forms
+
+            # Step 3a4. Write the forms still buffered
+            updater.close()
+            fingerprints.close()
 
 
         # Step 3b. Check to see if -i in argument list as this means we are clean inserting (ie. for first tiem) into mongo
@@ -172,82 +300,162 @@ def init(index_name):
         if '-c' in ARGS: # if -c is passed as an argument  is passed it means we are trying to start from specific location in index
             
             # Step 3b2. Check for the specific number from an index where we may want to continue
-            # default will be to start at beginning i.e. 0
-            continue_progress = int((re.search("'-c', '([0-9]+)'",str(sys.argv)) or re.search("(0)", "0")).group(1)) - 2 
-            stop_progress = int((re.search("'-s', '([0-9]+)'",str(sys.argv)) or (len(fetch_filings_from_index_file(index_name)) - 1)))
-            end_process = continue_progress + stop_progress
-
-            # Step 3b3. Build a list of filings fetch all filings from index and slice using continue_progress
-            filings = fetch_filings_from_index_file(index_name)[continue_progress:end_process]
+            # default will be to start at beginning i.e. 0, -s is the number of filings to process from there (default until the end of the index)
+            continue_progress = max(int((re.search("'-c', '([0-9]+)'",str(sys.argv)) or re.search("(0)", "0")).group(1)) - 2, 0)
+            stop_progress = re.search("'-s', '([0-9]+)'",str(sys.argv))
+            end_process = continue_progress + int(stop_progress.group(1)) if stop_progress else None
     
         else:
 
             # Step 3b4. Initialize Progress Counter
             continue_progress = 0 
+            end_process = None
+
+        # Step 3b3. Check for --form-type & --tax-year filters i.e. only process 990PF filings for tax year 2021
+        form_type = re.search("'--form-type', '([0-9A-Za-z]+)'", str(sys.argv))
+        tax_year = re.search("'--tax-year', '([0-9]{4})'", str(sys.argv))
+        form_types = [form_type.group(1).upper()] if form_type else None
+        tax_years = [int(tax_year.group(1))] if tax_year else None
+
+        # Step 3b5. Read the filings of the index between continue_progress and end_process from its sidecar (built from the json the first time & memory mapped after that)
+        sidecar = load_index_sidecar(index_name)
+        if sidecar is not None:
+            sidecar = filter_index_sidecar(sidecar, form_types, tax_years)
+            filings = iter_filings_from_index_sidecar(sidecar, continue_progress, end_process)
+            total_filings = len(sidecar)
+
+        # Step 3b5a. Without a sidecar read the json one filing at a time (only the fields we use), the index is counted (not parsed) so we can show our progress
+        else:
+            filings = iter_filings_from_index_file(index_name)
+            if form_types or tax_years:
+                filings = (filing for filing in filings if (not form_types or filing['FormType'] in form_types) and (not tax_years or filing['TaxYear'] in [str(year) for year in tax_years]))
+            filings = islice(filings, continue_progress, end_process)
+            total_filings = count_filings_in_index_file(index_name) or 0
+        if end_process is not None:
+            total_filings = min(total_filings, end_process)
+
+        # Step 3b5b. With --mongodb remember every filing stored in mongo in a local sqlite (ObjectId & FileSha256)
+        # with --since-last-run only the filings that were never stored or changed since are processed
+        checkpoints = Checkpoints(index_name) if (SINK == 'mongo' and '--mongodb' in ARGS) or '--since-last-run' in ARGS else None
+        if '--since-last-run' in ARGS:
+            filings = list(checkpoints.changed(filings))
+            total_filings = continue_progress + len(filings)
+            log_progress('', str.format("{0} filings of index {1} are new or changed since the last run", len(filings), index_name), Log_Details)
+
+        # Step 3b5c. With --mongodb journal the filings of the run (in flight, completed, failed) so it can be resumed if it crashes (--resume RUN_ID)
+        # or its failures processed again (--retry-failed RUN_ID). A new run gets a new id which is printed so it can be resumed later
+        if SINK == 'mongo' and '--mongodb' in ARGS:
+            resume = re.search("'--resume', '([0-9]+)'", str(sys.argv))
+            retry = re.search("'--retry-failed', '([0-9]+)'", str(sys.argv))
+            run_id = checkpoints.start_run(int((retry or resume).group(1)) if retry or resume else None, initial_args)
+            if run_id is None:
+                print (str.format("Run {0} doesn't exist or isn't a run of index {1}", (retry or resume).group(1), index_name))
+                return
+            print (str.format("Run {0} of index {1}", run_id, index_name))
+            if retry:
+                filings = checkpoints.retry_failed(filings)
+            elif resume:
+                filings = checkpoints.remaining(filings)
+
+        # Step 3b5d. Progress is printed & logged as a summary every few thousand filings or seconds (see settings/Settings.py) instead of a line per filing
+        progress = ProgressSummary(total_filings, Log_Details, start=continue_progress)
+
+        # Step 3b5e. With --mongodb skip the filings stored with the same fingerprint (FileSha256, mapping & parser version) before they are downloaded
+        # (one query per batch of -l filings, skipped filings count as completed) unless --reparse is passed. Every form written carries its fingerprint
+        fingerprints = Fingerprints(TYPED, skip='--reparse' not in ARGS, tables=NORMALIZE_TABLES) if SINK == 'mongo' and '--mongodb' in ARGS else None
+        if fingerprints is not None:
+            filings = fingerprints.changed(filings, limit, progress)
+        if checkpoints is not None:
+            filings = checkpoints.track(filings)
+
+        # Step 3b6. Creates a log for index_name we are currently processing this is deprecated as we use our own logging.py 
+        # logging.basicConfig(
+        #     filename=str.format('log-{0}.log', index_name),
+        #     format='%(levelname)s: TIME: %(asctime)s MESSAGE: %(message)s',
+        #     level=logging.INFO
+        # )
+
+        # Step 3b6a. With --workers N start a pool of N processes that parse filings (each one compiles the mapping once when it starts)
+        pool = create_pool(WORKERS, STREAM)
+
+        # Step 3b6b. With --mongodb start a writer that stores forms in batches of -l forms, -f replaces forms that already exist
+        # each batch written to mongo is recorded in the checkpoints (unless some of its writes failed)
+        # with --sink parquet/ndjson/columnar the batches are written to files in OUTPUT instead
+        if SINK == 'parquet':
+            writer = ParquetSink(os.path.join(OUTPUT, 'parquet'), VariableCatalog(CSV_MAPPING), limit)
+        elif SINK == 'ndjson':
+            writer = NdjsonSink(os.path.join(OUTPUT, 'ndjson'), limit, coercion=COERCION)
+        elif SINK == 'columnar':
+            writer = ColumnarSink(os.path.join(OUTPUT, 'columnar'), VariableCatalog(CSV_MAPPING), limit)
+        elif '--mongodb' in ARGS:
+            writer = BulkWriter(limit, force='-f' in ARGS, on_flush=checkpoints.flushed, coercion=COERCION, tables=NORMALIZE_TABLES)
+        else:
+            writer = None
+
+        # Step 3b7. With --zip read the filings out of the zip archive that holds them (each archive is read once, archives are spread over the workers) & store them in mongodb
+        if ZIP:
+            for xml_link, form in parse_archives(filings, pool, CSV_MAPPING, STREAM, limit):
+                if form is None:
+                    forget(xml_link, fingerprints, checkpoints)
+                    progress.tick(failed=True)
+                    continue
+                if fingerprints is not None:
+                    fingerprints.stamp(form)
+                if writer is not None:
+                    writer.add(form)
+                progress.tick()
+
+        # Step 3b7. Otherwise download every filing in the index, process it and store it in mongodb
+        else:
 
-            # Step 3b5 # Fetch filings from index file 
-            filings = fetch_filings_from_index_file(index_name)
-
-            # Step 3b6. Creates a log for index_name we are currently processing this is deprecated as we use our own logging.py 
-            # logging.basicConfig(
-            #     filename=str.format('log-{0}.log', index_name),
-            #     format='%(levelname)s: TIME: %(asctime)s MESSAGE: %(message)s',
-            #     level=logging.INFO
-            # )
-
-            # Step 3b7. For each filing in the index, download, process index and store filing in mongodb 
-            for index, xml_list in enumerate(partition_list(filings, limit)):
-
-                # Step 3b7a1
-                counter = 0  # set counter at 0 
-
-                # Step 3b7a2 for each url link in list do following 2 steps
-                for xml_link in xml_list:
-
-                    # Step 3b5a1 Create Form Parser object and pass CSV Object & Table Object
-                    form_parser = FormParser(CSV_OBJECT, CSV_TABLE_OBJECT)
-
-                    # Step 3b7a2 Create Form by:
-                    # 1. Download Document
-                    # 2. Process document saves it as a form object/class
-                    form = form_parser.create(xml_link)
-
-                    # Step 3b7a3 If the form is None continue processing
-                    if form is None:
-                        continue
-
-                    # Step 3b7a4 if --Mongodb has been passed from consol then store to mongo
-                    if '--mongodb' in ARGS:
-
-                        # Step 3b7a4a1 if -f is in arguments then use the insert data by force into mongo
-                        if '-f' in ARGS:
-
-                            # Step 3b7a4a2
-                            # Finds the form, if it exists removes it and reinserts it
-                            form.insert_data_force_to_mongo()
-
-                        # Step 3b7a4b Else insert the data normally into mongo.
-                        else:
-                            #print ('Inserting document %s into Mongo' % xml_link)
-                            form.insert_data_to_mongo()
-                    
-                    # 3b7b Increase counter
-                    counter = counter + 1
-                    
-                    # 3b7c. Create a string of our progress
-                        # Index tells us what position we are in the index multiply it by index and adding continue_progress tells us how many documents inserted
-                        # Numerator = if index was 10k documents limit was 1 then it would be 10k*1 + whatever position we start from
-                        # Denominator = Nnumber of filings + where we started from
-                    progress = str.format(
-                        "Completed {0} / {1}", ((limit * index) + continue_progress) + counter,
-                        len(filings) + continue_progress
-                    )
-
-                    # 3b7d. Log Progress we keep this commented as we will already have details at document level (elsewhere in code)
-                    #log_progress('', 'Parser Progress: %s Finished inserting: %s' % (progress, xml_link), Log_Details) # original logging -> #logging.info(progress) 
-
-                    # 3b7e. Log our progress to the console
-                    print (progress)
+            # Step 3b7a1 The filings of the whole index go through one download stream (the writer batches the writes by -l)
+            # with --async the filings are downloaded concurrently over one session for the whole run and handed to us as they arrive (so the network overlaps with parsing)
+            # with --cache filings we already have are read from disk, the others are downloaded (with --async or one by one) & kept for next time
+            if CACHE is not None:
+                downloads = CACHE.fetch(filings, fetch_xmls if ASYNC else read_xmls)
+            else:
+                xml_links = (filing['URL'] for filing in filings)
+                downloads = fetch_xmls(xml_links) if ASYNC else ((xml_link, None, None) for xml_link in xml_links)
+
+            # Step 3b7a2 Create Form by (in the pool workers when there is a pool, filings that could not be downloaded come back without a form):
+            # 1. Download Document
+            # 2. Process document saves it as a form object/class
+            for xml_link, form in parse_filings(downloads, pool, CSV_MAPPING, STREAM):
+
+                # Step 3b7a3 If the form is None (download or parse failed) count it as failed (its fingerprint & checkpoint are dropped) & continue processing
+                if form is None:
+                    forget(xml_link, fingerprints, checkpoints)
+                    progress.tick(failed=True)
+                    continue
+
+                # Step 3b7a4 if --Mongodb (or --sink) has been passed from consol then buffer the form, the writer stores the buffered forms to mongo (or files) in bulk
+                # with -f forms that already exist are replaced otherwise they are skipped, forms written to mongo carry the fingerprint of their filing
+                if fingerprints is not None:
+                    fingerprints.stamp(form)
+                if writer is not None:
+                    writer.add(form)
+
+                # 3b7b. Count the filing, every progress_every_filings filings (or progress_every_seconds) the number completed out of the number
+                # we will have processed once we reach the end (or -s) is printed & logged along with the rate i.e. Completed 12000 / 250000 filings (48.0 filings/s, 2 failed)
+                progress.tick()
+
+        # Step 3b8. Store the forms still buffered & stop the workers once the index is done
+        progress.finish()
+        if CACHE is not None:
+            log_progress('', str.format("XML cache: {0} filings read from disk, {1} downloaded", CACHE.hits, CACHE.misses), Log_Details)
+        if writer is not None:
+            writer.close()
+        if fingerprints is not None:
+            fingerprints.close()
+        if checkpoints is not None:
+            checkpoints.finish_run()
+            checkpoints.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if METRICS.enabled:
+            log_progress('', str.format("Metrics: {0}", METRICS.stats()['counters']), Log_Details)
+            METRICS.close()
 
     log_access('', 'Finished Running XML Parser', Log_Details)
 
@@ -280,6 +488,17 @@ if __name__ == '__main__':
         # Step 1d. Terminate Script as we are only running tests
         sys.exit("Finished Testing Connections")
 
+    # Step 1e - Check to see if --check-indexes in arguments that prints how mongo runs the queries we make per form
+    elif '--check-indexes' in ARGS:
+        log_access('', 'Started Running The XML Parser with following arguments & flags: %s' % initial_args, Log_Details)
+        print ('Checking Indexes')
+
+        # Step 1e1. Print the explain plan of each query (COLLSCAN means the index is missing, it is created the next time we run with --mongodb)
+        check_indexes()
+
+        # Step 1e2. Terminate Script as we are only checking indexes
+        sys.exit("Finished Checking Indexes")
+
     else: # Step 1b check other args passed via console
             
         # Step 2a. Check to see if -i has been passed (i.e. inserting) as argument from console
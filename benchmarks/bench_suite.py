@@ -0,0 +1,348 @@
+'''
+    Parse & Load Benchmark Suite
+
+    Generates synthetic 990, 990EZ & 990PF filings (benchmarks/synthetic.py) for every form type & number of table rows and measures
+        - parse throughput of FormParser.parse (filings per second & MB per second)
+        - peak RSS of parsing a scenario (each scenario runs in a fresh process)
+        - the cost of each step of the parser: reading the xml, find_all_nodes (single pass that replaced find_all_path, timed too for reference),
+          find_table_value, handle_object_parsed, find_schedules, find_all_data & building the form
+        - insert throughput of BulkWriter against a local mongod (--mongo-uri) or mongomock when it is installed
+    Results are written as json (--output) with the commit they were measured on, pass a previous result (--compare) to see what got slower.
+
+    Run from the main repository level:
+
+        python3 -m benchmarks.bench_suite --output benchmark.json
+        python3 -m benchmarks.bench_suite --rows 1 10 100 --filings 20 --compare benchmark.json
+        python3 -m benchmarks.bench_suite --mongo-uri mongodb://localhost:27017 --batch-sizes 100 1000
+'''
+
+import argparse  # allows us to read arguments from the command line
+import copy  # the bulk writer adds ids to the forms it writes so every run gets a fresh copy
+import json  # format of the results
+import multiprocessing  # runs each scenario in a fresh process so its peak RSS is its own
+import platform  # recorded with the results
+import resource  # peak RSS of a process
+import subprocess  # reads the commit being benchmarked
+import sys  # exit code of --compare
+import time  # allows us to time the parser
+from datetime import datetime  # recorded with the results
+from io import BytesIO  # the streaming parser reads file like objects
+from lxml import etree  # xml parsing library used by the parser
+from helpers.helpers import csv_to_mapping  # compiled concordance mapping
+from helpers.parser.formparser import FormParser  # parser being benchmarked
+from helpers.factory.formfactory import FormFactory  # builds the form objects that are written to mongo
+import helpers.database.interface as interface  # mongo interface, pointed at the benchmark database
+import helpers.database.bulk_writer as bulk_writer  # mongo sink being benchmarked
+from benchmarks.synthetic import build_filing  # synthetic filings
+
+FORM_TYPES = ['990', '990EZ', '990PF']
+STAGES = ['xml', 'find_all_nodes', 'find_all_path', 'find_table_value', 'handle_object_parsed', 'find_schedules', 'find_all_data', 'form']
+BENCHMARK_DATABASE = 'irs_xml_benchmark'  # Database the load benchmark writes to (dropped before every run) so a real mongod keeps its data
+LOWER_IS_BETTER = ('ms_per_filing', 'peak_rss_mb')  # Metrics that regress when they grow, every other metric regresses when it shrinks
+
+
+def build_filings(mapping, form_type, rows, density, filings):
+
+    '''
+
+    Returns a list of the bytes of synthetic filings of a scenario (every filing has its own seed so values & EINs differ)
+
+    '''
+
+    return [build_filing(mapping, form_type, rows=rows, density=density, seed=seed) for seed in range(filings)]
+
+
+def time_stages(form_parser, xml, stages):
+
+    '''
+
+    Parses a filing step by step (see FormParser.parse) and adds the seconds each step took to stages
+
+    '''
+
+    def timed(stage, function, *arguments):
+        start = time.perf_counter()
+        value = function(*arguments)
+        stages[stage] += time.perf_counter() - start
+        return value
+
+    # Step 1. Find the mapped leaves & table rows (the streaming parser reads the xml as it goes so reading the xml is part of find_all_nodes)
+    tables = {}
+    if form_parser.stream:
+        leaves = timed('find_all_nodes', form_parser.find_all_nodes_streaming, BytesIO(xml), tables)
+        root = etree.XML(xml)
+    else:
+        root = timed('xml', etree.XML, xml)
+        leaves = timed('find_all_nodes', form_parser.find_all_nodes, root, form_parser.mapping.root(root.tag), tables)
+    timed('find_all_path', form_parser.find_all_path, root, 'Return')
+
+    # Step 2. Tables on their own, then the whole of handle_object_parsed (which looks tables up too)
+    object_parsed = {}
+    start = time.perf_counter()
+    for node, _ in leaves:
+        form_parser.find_table_value(node, object_parsed, tables, leaves)
+    stages['find_table_value'] += time.perf_counter() - start
+    object_parsed = {}
+    timed('handle_object_parsed', form_parser.handle_object_parsed, leaves, object_parsed, tables)
+
+    # Step 3. Schedules, main form & the form object
+    schedules = timed('find_schedules', form_parser.find_schedules, object_parsed)
+    all_data = timed('find_all_data', form_parser.find_all_data, object_parsed)
+    timed('form', lambda: FormFactory(all_data, schedules).create())
+
+
+def run_parse_scenario(scenario):
+
+    '''
+
+    Benchmarks the parser on the filings of one scenario {form_type, rows, density, filings, repeat, stream} & returns its results.
+    Meant to run in its own process (see main) so peak_rss_mb only covers this scenario
+
+    '''
+
+    # Step 1. Build the parser & the filings, remember how much memory that took before parsing anything
+    mapping = csv_to_mapping()
+    form_parser = FormParser(mapping.csv_object, mapping.csv_table_object, mapping, stream=scenario['stream'])
+    filings = build_filings(mapping, scenario['form_type'], scenario['rows'], scenario['density'], scenario['filings'])
+    megabytes = sum(len(xml) for xml in filings) / 1e6
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    # Step 2. Parse every filing repeat times, keep the best time (filings that fail are counted & left out)
+    failed = 0
+    best = None
+    for _ in range(scenario['repeat']):
+        start = time.perf_counter()
+        for xml in filings:
+            try:
+                form_parser.parse(xml).form()
+            except Exception:
+                failed += 1
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    failed //= scenario['repeat']
+
+    # Step 3. Time the steps of the parser on the filings that parse repeat times, keep the best time of each step
+    stages = {}
+    for _ in range(scenario['repeat']):
+        repeat_stages = dict.fromkeys(STAGES, 0.0)
+        for xml in filings:
+            try:
+                time_stages(form_parser, xml, repeat_stages)
+            except Exception:
+                pass
+        stages = {stage: min(seconds, stages.get(stage, seconds)) for stage, seconds in repeat_stages.items()}
+
+    ok = max(len(filings) - failed, 1)
+    return dict(scenario,
+                megabytes=round(megabytes, 3),
+                failed=failed,
+                seconds=round(best, 4),
+                filings_per_second=round(len(filings) / best, 2),
+                mb_per_second=round(megabytes / best, 2),
+                ms_per_filing=round(1000 * best / len(filings), 3),
+                baseline_rss_mb=round(baseline_rss, 1),
+                peak_rss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                stages_ms_per_filing={stage: round(1000 * seconds / ok, 3) for stage, seconds in stages.items()})
+
+
+def use_database(database, gridfs):
+
+    '''
+
+    Points the mongo interface & the bulk writer at database (a benchmark database of a local mongod or of mongomock) instead of the configured one
+
+    '''
+
+    for module in (interface, bulk_writer):
+        module.mongo_database = database
+        module.schedules_collection = database['schedules']
+        module.schedules_collection_b = gridfs(database, 'schedulesb')
+
+
+def benchmark_database(mongo_uri):
+
+    '''
+
+    Returns (name of the server, benchmark database, GridFS class) for a local mongod when mongo_uri is passed otherwise for mongomock,
+    returns None when neither can be used
+
+    '''
+
+    from gridfs import GridFS
+    if mongo_uri:
+        from pymongo import MongoClient
+        client = MongoClient(mongo_uri, serverSelectionTimeoutMS=5000)
+        client.admin.command('ping')
+        return 'mongod ' + client.server_info()['version'], client[BENCHMARK_DATABASE], GridFS
+    try:
+        import mongomock
+        import mongomock.gridfs
+    except ImportError:
+        return None
+    mongomock.gridfs.enable_gridfs_integration()
+    return 'mongomock ' + mongomock.__version__, mongomock.MongoClient()[BENCHMARK_DATABASE], GridFS
+
+
+def run_load(args):
+
+    '''
+
+    Benchmarks BulkWriter writing parsed synthetic filings of every form type to mongo for each batch size, once into an empty database (inserts)
+    and once more over the same filings (every filing already exists so it is looked up & skipped). Returns the results or an empty list when no mongo is available
+
+    '''
+
+    # Step 1. Connect to mongod or mongomock
+    try:
+        database = benchmark_database(args.mongo_uri)
+    except Exception as g:
+        print('Skipping load benchmark, could not connect to %s: %s' % (args.mongo_uri, g))
+        return []
+    if database is None:
+        print('Skipping load benchmark, pass --mongo-uri or install mongomock')
+        return []
+    server, database, gridfs = database
+    use_database(database, gridfs)
+
+    # Step 2. Parse the filings once, a third of every form type
+    mapping = csv_to_mapping()
+    form_parser = FormParser(mapping.csv_object, mapping.csv_table_object, mapping)
+    forms = []
+    for position in range(args.load_filings):
+        xml = build_filing(mapping, FORM_TYPES[position % len(FORM_TYPES)], rows=args.load_rows, density=args.density, seed=position)
+        try:
+            forms.append(form_parser.parse(xml).form())
+        except Exception:
+            pass
+    schedules = sum(len(form.schedules or []) for form in forms)
+
+    # Step 3. Write them with each batch size into an empty database, then again now that they exist
+    results = []
+    for batch_size in args.batch_sizes:
+        database.client.drop_database(BENCHMARK_DATABASE)
+        use_database(database.client[BENCHMARK_DATABASE], gridfs)
+        for mode in ('insert', 'existing'):
+            batch = copy.deepcopy(forms)
+            writer = bulk_writer.BulkWriter(batch_size)
+            start = time.perf_counter()
+            for form in batch:
+                writer.add(form)
+            totals = writer.close()
+            elapsed = time.perf_counter() - start
+            results.append({'server': server, 'mode': mode, 'batch_size': batch_size, 'filings': len(forms), 'schedules': schedules,
+                            'seconds': round(elapsed, 4), 'filings_per_second': round(len(forms) / elapsed, 2),
+                            'documents_per_second': round((len(forms) + schedules) / elapsed, 2), 'totals': totals})
+    database.client.drop_database(BENCHMARK_DATABASE)
+    return results
+
+
+def commit():
+
+    '''
+
+    Returns the commit the benchmark runs on (with + when the tree has changes) or None outside of git
+
+    '''
+
+    try:
+        head = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL, text=True).strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], stderr=subprocess.DEVNULL, text=True).strip()
+        return head + ('+' if dirty else '')
+    except Exception:
+        return None
+
+
+def scenario_key(result):
+
+    '''
+
+    Returns what identifies a result between runs i.e. parse 990 rows=10 density=0.5 stream=False or load insert batch_size=1000
+
+    '''
+
+    if 'form_type' in result:
+        return 'parse %s rows=%s density=%s stream=%s' % (result['form_type'], result['rows'], result['density'], result['stream'])
+    return 'load %s batch_size=%s' % (result['mode'], result['batch_size'])
+
+
+def compare(previous, current, threshold):
+
+    '''
+
+    Prints how every metric changed since a previous run & returns the number of metrics that got worse by more than threshold (0.1 -> 10%)
+
+    '''
+
+    before = {scenario_key(result): result for result in previous['parse'] + previous['load']}
+    regressions = 0
+    print('\nCompared to %s (%s)' % (previous.get('commit'), previous.get('date')))
+    print('%-50s %-22s %12s %12s %8s' % ('scenario', 'metric', 'before', 'after', 'change'))
+    for result in current['parse'] + current['load']:
+        old = before.get(scenario_key(result))
+        if old is None:
+            continue
+        metrics = [(metric, old.get(metric), result.get(metric)) for metric in ('filings_per_second', 'mb_per_second', 'ms_per_filing', 'documents_per_second', 'peak_rss_mb')]
+        metrics += [(stage, old.get('stages_ms_per_filing', {}).get(stage), value) for stage, value in result.get('stages_ms_per_filing', {}).items()]
+        for metric, old_value, value in metrics:
+            if not old_value or value is None:
+                continue
+            change = value / old_value - 1
+            worse = change > threshold if metric in LOWER_IS_BETTER + tuple(STAGES) else change < -threshold
+            regressions += worse
+            print('%-50s %-22s %12.3f %12.3f %+7.1f%% %s' % (scenario_key(result), metric, old_value, value, 100 * change, 'WORSE' if worse else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--forms', nargs='+', default=FORM_TYPES, choices=FORM_TYPES, help='form types to generate')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1, 10, 100], help='rows per repeating group (table) of each filing')
+    parser.add_argument('--density', type=float, default=0.5, help='share of the mapped elements included in each filing')
+    parser.add_argument('--filings', type=int, default=10, help='filings generated per scenario')
+    parser.add_argument('--repeat', type=int, default=3, help='times the filings of a scenario are parsed (best time is kept)')
+    parser.add_argument('--stream', action='store_true', help='benchmark the streaming parser (-s)')
+    parser.add_argument('--mongo-uri', help='local mongod to benchmark inserts against (default mongomock)')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[100, 1000], help='bulk writer batch sizes')
+    parser.add_argument('--load-filings', type=int, default=300, help='filings written to mongo per batch size')
+    parser.add_argument('--load-rows', type=int, default=5, help='rows per table of the filings written to mongo')
+    parser.add_argument('--no-load', action='store_true', help='skip the mongo benchmark')
+    parser.add_argument('--output', help='json file the results are written to')
+    parser.add_argument('--compare', help='json file of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='change that counts as a regression with --compare (0.1 -> 10%%)')
+    args = parser.parse_args()
+
+    # Step 1. Parse scenarios, each in a fresh process (spawned so it doesn't start with the memory of this one)
+    scenarios = [{'form_type': form_type, 'rows': rows, 'density': args.density, 'filings': args.filings, 'repeat': args.repeat, 'stream': args.stream}
+                 for form_type in args.forms for rows in args.rows]
+    print('%-6s %5s %8s %9s %9s %9s | %s' % ('form', 'rows', 'MB', 'filing/s', 'MB/s', 'peak RSS', ' '.join('%10s' % stage[0:10] for stage in STAGES)))
+    parse_results = []
+    with multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1) as pool:
+        for result in pool.imap(run_parse_scenario, scenarios):
+            parse_results.append(result)
+            print('%-6s %5d %8.2f %9.1f %9.2f %9.1f | %s' % (result['form_type'], result['rows'], result['megabytes'], result['filings_per_second'],
+                  result['mb_per_second'], result['peak_rss_mb'], ' '.join('%10.3f' % result['stages_ms_per_filing'][stage] for stage in STAGES)))
+    print('(stages in ms per filing, find_table_value is also part of handle_object_parsed & find_all_path is the old path walk kept for reference)')
+
+    # Step 2. Load benchmark
+    load_results = [] if args.no_load else run_load(args)
+    if load_results:
+        print('\n%-16s %-9s %6s %8s %10s %11s' % ('server', 'mode', 'batch', 'filings', 'filing/s', 'document/s'))
+        for result in load_results:
+            print('%-16s %-9s %6d %8d %10.1f %11.1f' % (result['server'], result['mode'], result['batch_size'], result['filings'],
+                  result['filings_per_second'], result['documents_per_second']))
+
+    # Step 3. Write the results & compare them with a previous run
+    results = {'commit': commit(), 'date': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+               'machine': platform.platform(), 'arguments': vars(args), 'parse': parse_results, 'load': load_results}
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    if args.compare:
+        with open(args.compare) as previous:
+            regressions = compare(json.load(previous), results, args.threshold)
+        print('\n%d metrics got worse by more than %d%%' % (regressions, 100 * args.threshold))
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
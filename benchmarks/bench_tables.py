@@ -0,0 +1,69 @@
+'''
+    Table Extraction Benchmark
+
+    Times the single pass table extraction of FormParser (find_all_nodes + handle_object_parsed) on synthetic filings
+    with a growing number of table rows. Time per row should stay flat as the number of rows grows (linear scaling).
+
+    Run from the main repository level:
+
+        python3 -m benchmarks.bench_tables
+        python3 -m benchmarks.bench_tables --rows 250 500 1000 2000 4000 --repeat 5
+'''
+
+import argparse  # allows us to read arguments from the command line
+import time  # allows us to time the parser
+from lxml import etree  # xml parsing library used by the parser
+from helpers.helpers import csv_to_mapping  # compiled concordance mapping
+from helpers.parser.formparser import FormParser  # parser being benchmarked
+from benchmarks.synthetic import build_filing  # synthetic filings
+
+# Large tables we see in practice: Schedule I grants, Schedule J compensation, Schedule R related orgs & 990PF grants
+SCENARIOS = [
+    ('990', ['SI-PC-02-GRANTS_SI_PART_II', 'SJ-PC-02-OFFICERS_SJ_PART_II', 'SR-PC-04-RELATED_ORGS_PART_IV']),
+    ('990PF', ['F9-PF-15-GRANTS_PF_PART_XV_A', 'F9-PF-04-CAP_GAIN_LOSS_PROPERTY_PART_IV']),
+]
+
+
+def time_tables(form_parser, xml, repeat):
+
+    '''
+
+    Returns the best time in seconds it took to extract the values & tables of a filing and the number of rows extracted
+
+    '''
+
+    root = etree.XML(xml)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        tables = {}
+        object_parsed = {}
+        leaves = form_parser.find_all_nodes(root, form_parser.mapping.root(root.tag), tables)
+        form_parser.handle_object_parsed(leaves, object_parsed, tables)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    rows = sum(len(value) for value in object_parsed.values() if isinstance(value, list) and value and isinstance(value[0], dict))
+    return best, rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[250, 500, 1000, 2000, 4000], help='rows per repeating group')
+    parser.add_argument('--repeat', type=int, default=3, help='times each filing is parsed (best time is kept)')
+    args = parser.parse_args()
+
+    mapping = csv_to_mapping()
+    form_parser = FormParser(mapping.csv_object, mapping.csv_table_object, mapping)
+
+    print('%-6s %-7s %8s %10s %10s %12s' % ('form', 'rows', 'mode', 'table rows', 'seconds', 'us per row'))
+    for form_type, tables in SCENARIOS:
+        for sparse_rows in (False, True):
+            for rows in args.rows:
+                xml = build_filing(mapping, form_type, rows=rows, tables=tables, sparse_rows=sparse_rows)
+                seconds, table_rows = time_tables(form_parser, xml, args.repeat)
+                print('%-6s %-7d %8s %10d %10.4f %12.2f' % (
+                    form_type, rows, 'sparse' if sparse_rows else 'dense', table_rows, seconds, 1e6 * seconds / max(table_rows, 1)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+'''
+    Synthetic Filing Generator
+
+    Builds form 990 / 990EZ / 990PF xml filings out of the concordance XPATHs (helpers/concordance_files) so the parser
+    can be benchmarked at controlled sizes without downloading anything from the datalake.
+
+    Example:
+
+        from helpers.helpers import csv_to_mapping
+        from benchmarks.synthetic import build_filing
+
+        xml = build_filing(csv_to_mapping(), '990', rows=500, tables=['SI-PC-02-GRANTS_SI_PART_II'])
+'''
+
+import random  # allows us to generate reproducible values
+import re  # allows us to skip concordance paths that are not valid xml tags
+from xml.sax.saxutils import escape  # allows us to escape values placed in the xml
+
+NAMESPACE = 'http://www.irs.gov/efile'  # Namespace present in all XML filings
+REGEXP_TAG = re.compile('^[A-Za-z_][A-Za-z0-9_]*$')  # The concordance has a handful of paths that are descriptions instead of tags
+
+# Top level elements of ReturnData that belong to each form type
+FORM_ROOTS = {
+    '990': ['IRS990'] + ['IRS990Schedule' + letter for letter in 'ABCDEFGHIJKLMNOR'],
+    '990EZ': ['IRS990EZ', 'IRS990ScheduleA', 'IRS990ScheduleB', 'IRS990ScheduleC', 'IRS990ScheduleE', 'IRS990ScheduleG', 'IRS990ScheduleL', 'IRS990ScheduleN', 'IRS990ScheduleO'],
+    '990PF': ['IRS990PF', 'IRS990ScheduleB'],
+}
+
+
+def synthetic_value(tag, counter, rnd):
+
+    '''
+
+    Returns a plausible value for a tag using the IRS naming conventions i.e. ...Amt -> 1200 ...Ind -> true
+
+    '''
+
+    if tag.endswith('Ind'):
+        return rnd.choice(['true', 'false', 'X', '1'])
+    if tag.endswith(('Amt', 'Cnt', 'Pct')):
+        return str(rnd.randint(0, 10 ** 7))
+    if tag.endswith('Dt'):
+        return '2022-%02d-%02d' % (rnd.randint(1, 12), rnd.randint(1, 28))
+    if tag.endswith(('Yr', 'TaxYear')):
+        return str(rnd.randint(2015, 2023))
+    if tag.endswith('EIN'):
+        return '%09d' % rnd.randint(0, 999999999)
+    return '%s %d' % (tag.upper(), counter)
+
+
+def build_filing(mapping, form_type='990', rows=10, density=1.0, tables=None, sparse_rows=False, seed=0):
+
+    '''
+
+    Returns the bytes of a synthetic filing
+
+    mapping     - CompiledMapping from helpers.helpers.csv_to_mapping
+    form_type   - 990, 990EZ or 990PF
+    rows        - number of times every repeating group (table row) is repeated
+    density     - probability that any mapped element outside of the header is included
+    tables      - optional list of table variables i.e. SI-PC-02-GRANTS_SI_PART_II, when passed only those tables are generated (plus the header)
+    sparse_rows - when True every table row only holds its first value (rows with a single value borrow the values of their parent)
+    seed        - seed for the random values so the same arguments always generate the same filing
+
+    '''
+
+    # Step 0. Setup
+    rnd = random.Random(seed)
+    output = ['<?xml version="1.0" encoding="utf-8"?>', '<Return xmlns="%s" returnVersion="2022v5.0">' % NAMESPACE]
+    counter = [0]
+    header_variables = set()
+    tables = set(tables) if tables else None
+
+    # Step 1. Decide whether a node (and everything below it) is part of the filing
+    groups = []
+    if tables is not None:
+        groups = [node.parent.path for node in mapping.walk() if node.table in tables]
+
+    def include(node, depth):
+        if not REGEXP_TAG.match(node.tag):
+            return False
+        if depth == 2 and node.parent.tag == 'ReturnData':
+            return node.tag in FORM_ROOTS[form_type]
+        if node.path.startswith('Return/ReturnHeader'):
+            return True
+        if tables is not None and node.path.startswith('Return/ReturnData'):
+            return any(group == node.path or group.startswith(node.path + '/') or node.path.startswith(group + '/') for group in groups)
+        return density >= 1.0 or rnd.random() < density
+
+    # Step 2. Write a node as a leaf or as a branch, repeating groups are written once per row (groups nested in a repeating group are written once)
+    def write(node, depth, in_header, in_group=False):
+        children = [child for child in node.children.values() if include(child, depth + 1)]
+        repeating = node.group and not in_group and (tables is None or node.path in groups)
+        for row in range(rows if repeating else 1):
+            if children:
+                output.append('<%s>' % node.tag)
+                written = 0
+                for child in children:
+                    if sparse_rows and repeating and written:
+                        break
+                    written += write(child, depth + 1, in_header, in_group or repeating)
+                output.append('</%s>' % node.tag)
+            elif node.children and not (node.variable or node.table):
+                return 0
+            else:
+                if in_header:
+                    if node.variable in header_variables:
+                        return 0
+                    header_variables.add(node.variable)
+                counter[0] += 1
+                value = form_type if node.tag in ('ReturnType', 'ReturnTypeCd') else synthetic_value(node.tag, counter[0], rnd)
+                output.append('<%s>%s</%s>' % (node.tag, escape(value), node.tag))
+        return 1
+
+    # Step 3. Write the header and the data of the filing
+    root = mapping.roots['Return']
+    write(root.children['ReturnHeader'], 1, True)
+    write(root.children['ReturnData'], 1, False)
+    output.append('</Return>')
+
+    # Step 4. Return the filing as bytes
+    return ''.join(output).encode('utf-8')
@@ -0,0 +1,296 @@
+import os,sys                           # lets us use console and system
+import bson                             # allows us to measure the size of a document before sending it to mongo
+from gridfs import GridFS               # library that allows us to store files larger than 16mb into mongo
+from gridfs.errors import FileExists    # raised when a file with the same id is already stored in gridfs
+from pymongo import UpdateOne, ReplaceOne, DeleteMany # bulk write operations
+from pymongo.errors import BulkWriteError
+from settings.Settings import mongo_max_document_size, mongo_bulk_flush_seconds
+from helpers.database.interface import mongo_database, schedules_collection, schedules_collection_b, form_id, schedule_id
+from helpers.database.sinks import Sink # buffers forms & writes them in batches
+from helpers.database.large_documents import put_document # stores documents larger than 16mb in gridfs as compressed bson
+from helpers.database.table_rows import TableRows # stores the rows of tables as their own documents (--normalize-tables)
+from helpers.metrics import METRICS     # times every mongo operation per collection (when metrics are on)
+from helpers.loggingutil import Log_Details, log_error, log_progress  # Import Custom Logging
+
+# Store name of current script in Log_Details class object as script name. We do this so that error log will always tell us which script error comes from.
+Log_Details.script = os.path.split(sys.argv[0])[1]
+
+SIZE_MAX_MONGO = mongo_max_document_size # Max size is 16mb for regular documents otherwise we need to use GridFs to store docs in mongo
+DUPLICATE_KEY = 11000                    # Code of the error mongo returns when a unique key (_id or FILEREIN, TAXYEAR) is already stored
+
+# Overview: Buffers parsed forms and writes them to mongo in batches (a few round trips per batch instead of 3+ per form)
+
+
+class BulkWriter (Sink):
+
+    '''
+
+    Buffers forms (Form990/Form990EZ/Form990PF) and writes them to mongo once batch_size forms are buffered or flush_seconds have passed since the last write.
+
+    Forms & schedules have _ids derived from the ObjectId of their filing (see form_id & schedule_id in interface.py) so each batch is 1 unordered bulk_write
+    of upserts on _id per form collection followed by 1 for the schedules, nothing is read first & writing the same filings again (or from several processes
+    at once) never creates duplicates. Like insert_data_to_mongo forms that already exist are skipped, with force=True they are replaced and their old
+    schedules removed (like insert_data_force_to_mongo) which takes 1 query per form collection for the stored forms. Only documents that are actually
+    larger than 16mb go to GridFS. With tables=True the tables of forms & schedules are stored as a document per row (see table_rows.py) written
+    last with 1 unordered bulk_write per table.
+
+        Example:
+            writer = BulkWriter(1000)
+            for form in forms:
+                writer.add(form)
+            writer.close()
+
+    '''
+
+    name = 'Bulk writer'
+
+    def __init__(self, batch_size=1000, flush_seconds=mongo_bulk_flush_seconds, force=False, on_flush=None, coercion=None, tables=False):
+        self.force = force                 # True replaces forms that already exist (-f) instead of skipping them
+        self.tables = TableRows(mongo_database, force) if tables else None # moves tables into row collections (--normalize-tables)
+        super(BulkWriter, self).__init__(batch_size, flush_seconds, on_flush, coercion)
+
+    @staticmethod
+    def new_result():
+
+        '''
+
+        Returns an empty batch result i.e. how many forms were inserted, replaced, skipped (already in mongo) etc.
+
+        '''
+
+        return {'forms': 0, 'inserted': 0, 'replaced': 0, 'skipped': 0, 'schedules': 0, 'schedules_removed': 0, 'rows': 0, 'gridfs': 0, 'errors': 0, 'invalid': 0}
+
+    def write(self, forms, result):
+
+        '''
+
+        Writes a batch of forms to mongo (see Sink.flush which buffers them & reports the result)
+
+        '''
+
+        # Step 1. Group forms by collection (990/990EZ/990PF) & key (FILEREIN, TAXYEAR), every form gets its _id from the ObjectId of its filing (see form_id)
+        # A key that shows up twice in a batch keeps the first form (like inserting) or the last one when forcing (like removing & reinserting)
+        batches = {}
+        for form in forms:
+            key = self.form_key(form.all_data)
+            batch = batches.setdefault(form.form_type, {})
+            if key in batch and not self.force:
+                result['skipped'] += 1
+                continue
+            form.all_data['_id'] = form_id(form.all_data)
+            batch[key] = form
+
+        # Step 2. Build the write operations for every collection
+        schedule_requests = {} # _id of a form -> writes of its schedules
+        row_requests = {}      # _id of a form -> {table: writes of its rows} (--normalize-tables)
+        form_requests = {}     # collection -> writes of its forms
+        form_ids = {}          # collection -> _id of the form of each write (to find the forms that were skipped)
+        removals = {}          # collection -> forms stored under another _id that are removed before their replacement is written (-f)
+        gridfs_requests = {}   # _id of a form -> oversized documents (its schedules or itself) stored in GridFS once the form is known not to be skipped
+        for form_type, batch in batches.items():
+            collectionb = GridFS(mongo_database, (form_type + 'b'))
+
+            # Step 2a. When forcing, one query for the forms of the batch that are already in mongo so their schedules that are gone can be removed
+            # Otherwise nothing is read: writes are upserts on _id that leave a stored form as it is
+            existing = self.find_existing(mongo_database[form_type], batch) if self.force else {}
+            requests = form_requests[form_type] = []
+            ids = form_ids[form_type] = []
+            removals[form_type] = []
+
+            for key, form in batch.items():
+                all_data = form.all_data
+                main_id = all_data['_id']
+                requests_of_form = schedule_requests.setdefault(main_id, [])
+                gridfs_of_form = gridfs_requests.setdefault(main_id, [])
+                stored = existing.get(key)
+
+                # Step 2a1. With tables the rows of the tables of the form & its schedules are taken out before anything is measured or written
+                # (tables stored with the same sha256 aren't written again when forcing)
+                if self.tables is not None:
+                    row_requests[main_id] = self.tables.split(form, main_id, stored.get('TABLES') if stored is not None else None)
+
+                # Step 2b. Schedules get their ids from the form's _id & their type so the main form can point to them, oversized schedules go to GridFS
+                if form.schedules:
+                    all_data['schedules'] = self.new_schedules(form.schedules, form_type, all_data, requests_of_form, result, replace=self.force, gridfs_requests=gridfs_of_form)
+
+                # Step 2c. When forcing, the schedules of the stored form that are gone are removed & so is a form stored under another _id
+                if stored is not None:
+                    gone = [schedule for schedule in stored.get('schedules', []) if schedule not in all_data.get('schedules', [])]
+                    if gone:
+                        requests_of_form.append(DeleteMany({'_id': {'$in': gone}}))
+                    if stored['_id'] != main_id:
+                        removals[form_type].append(DeleteMany({'_id': stored['_id']}))
+
+                # Step 2d. Oversized main forms go to GridFS under the form's _id otherwise upsert the form on its _id
+                if self.oversized(all_data):
+                    gridfs_of_form.append((collectionb, all_data, all_data, form_type, 'main_form', main_id, self.force))
+                    if stored is not None and stored['_id'] == main_id:
+                        removals[form_type].append(DeleteMany({'_id': main_id}))
+                    continue
+                if self.force:
+                    requests.append(ReplaceOne({'_id': main_id}, all_data, upsert=True))
+                else:
+                    requests.append(UpdateOne({'_id': main_id}, {'$setOnInsert': {field: value for field, value in all_data.items() if field != '_id'}}, upsert=True))
+                ids.append(main_id)
+
+        # Step 3. Remove the forms stored under another _id first (-f) so their (FILEREIN, TAXYEAR) is free
+        for form_type, requests in removals.items():
+            self.bulk_write(mongo_database[form_type], requests, result)
+
+        # Step 4. Write the forms of each collection. A form whose (FILEREIN, TAXYEAR) is stored under another _id (i.e. stored before _ids came from the ObjectId)
+        # is skipped & so are its schedules
+        skipped = set()
+        for form_type, requests in form_requests.items():
+            duplicates = []
+            forms_result = self.bulk_write(mongo_database[form_type], requests, result, duplicates)
+            result['inserted'] += forms_result.get('nUpserted', 0)
+            result['replaced' if self.force else 'skipped'] += forms_result.get('nMatched', 0)
+            result['skipped'] += len(duplicates)
+            skipped.update(form_ids[form_type][position] for position in duplicates)
+
+        # Step 4a. Then the oversized main forms & schedules go to GridFS, leaving out those of the forms that were skipped
+        for main_id, gridfs_of_form in gridfs_requests.items():
+            if main_id in skipped:
+                continue
+            for collectionb, document, all_data, form_type, part, file_id, replace in gridfs_of_form:
+                self.put_gridfs(collectionb, document, all_data, form_type, part, result, file_id, replace)
+
+        # Step 5. Then the schedules of the forms that were written, schedules that are already stored are left as they are unless forcing
+        # (writing a batch again adds the schedules a crashed run didn't write)
+        requests = [request for main_id, requests_of_form in schedule_requests.items() if main_id not in skipped for request in requests_of_form]
+        schedules_result = self.bulk_write(schedules_collection, requests, result)
+        result['schedules'] += schedules_result.get('nUpserted', 0)
+        result['schedules_removed'] += schedules_result.get('nRemoved', 0)
+
+        # Step 6. Then the rows of the tables of the forms that were written, 1 bulk_write per table collection
+        if self.tables is not None:
+            for table, requests in self.tables.group(row_requests, skipped):
+                rows_result = self.bulk_write(self.tables.collection(table), requests, result)
+                result['rows'] += rows_result.get('nUpserted', 0) + rows_result.get('nModified', 0) + rows_result.get('nRemoved', 0)
+
+    def new_schedules(self, schedules, form_type, all_data, schedule_requests, result, replace=False, gridfs_requests=None):
+
+        '''
+
+        Returns the ids of the schedules of a form & adds their upserts to schedule_requests (oversized schedules go to GridFS under the same ids).
+        A schedule's _id comes from the form's _id & its type (see schedule_id), schedules already stored are left as they are unless replace is True.
+        When a list is passed as gridfs_requests the GridFS writes are added to it (see put_gridfs for their arguments) instead of being made right away
+
+        '''
+
+        main_id = form_id(all_data)
+        schedules_ids = []
+        for schedule in schedules:
+            schedule['_id'] = schedule_id(main_id, schedule.get('type'))
+            if self.oversized(schedule) and gridfs_requests is not None:
+                gridfs_requests.append((schedules_collection_b, schedule, all_data, form_type, schedule.get('type'), schedule['_id'], replace))
+                schedules_ids.append(schedule['_id'])
+                continue
+            if self.oversized(schedule):
+                schedules_ids.append(self.put_gridfs(schedules_collection_b, schedule, all_data, form_type, schedule.get('type'), result, schedule['_id'], replace))
+                continue
+            if replace:
+                schedule_requests.append(ReplaceOne({'_id': schedule['_id']}, schedule, upsert=True))
+            else:
+                schedule_requests.append(UpdateOne({'_id': schedule['_id']}, {'$setOnInsert': {field: value for field, value in schedule.items() if field != '_id'}}, upsert=True))
+            schedules_ids.append(schedule['_id'])
+        return schedules_ids
+
+    @staticmethod
+    def form_key(all_data):
+
+        '''
+
+        Returns the (FILEREIN, TAXYEAR) key of a form, values that repeat in a filing are lists so they are turned into tuples
+
+        '''
+
+        return tuple(tuple(value) if isinstance(value, list) else value for value in (all_data.get('FILEREIN'), all_data.get('TAXYEAR')))
+
+    @staticmethod
+    def find_existing(collection, batch, projection={'FILEREIN': 1, 'TAXYEAR': 1, 'schedules': 1, 'TABLES': 1}):
+
+        '''
+
+        Returns {(FILEREIN, TAXYEAR): document} for the forms of a batch that are already in a collection
+        (only _id, FILEREIN, TAXYEAR, schedules & TABLES are loaded unless another projection is passed, None loads the whole document)
+
+        '''
+
+        existing = {}
+        try:
+            eins = [form.all_data.get('FILEREIN') for form in batch.values()]
+            with METRICS.timer('mongo_find_existing', collection.name):
+                for document in collection.find({'FILEREIN': {'$in': eins}}, projection):
+                    key = BulkWriter.form_key(document)
+                    if key in batch:
+                        existing[key] = document
+        except Exception as g:
+            log_error(g, "Failed to check which forms of the batch already exist", Log_Details)
+        return existing
+
+    @staticmethod
+    def oversized(document):
+
+        '''
+
+        Returns True when a document is too large to be stored as a regular mongo document
+
+        '''
+
+        return len(bson.encode(document)) > SIZE_MAX_MONGO
+
+    @staticmethod
+    def put_gridfs(collectionb, document, all_data, form_type, part, result, file_id=None, replace=False):
+
+        '''
+
+        Stores an oversized document (schedule or main form) in a GridFS collection as compressed bson (see large_documents.py) under file_id and returns
+        the id as a string (like insert_data_to_mongo does). A file already stored under file_id is kept unless replace is True
+
+        '''
+
+        filenm = str.format("{0}_{1}_{2}.bson", all_data.get("FILEREIN"), all_data.get('TAXYEAR'), part)
+        try:
+            with METRICS.timer('mongo_gridfs', form_type):
+                file_id = put_document(collectionb, document, file_id, replace, type=part, filename=filenm, year=all_data.get('TAXYEAR'), state=all_data.get('FILERUSSTATE'), FILEREIN=all_data.get("FILEREIN"), filing_type=form_type)
+            result['gridfs'] += 1
+            log_progress('', str.format("SUCCESSFULLY INSERTED {0} FOR EIN: {1} into mongo gridfs", part, all_data.get("FILEREIN")), Log_Details)
+            return str(file_id)
+        except FileExists:
+            return str(file_id)
+        except Exception as g:
+            result['errors'] += 1
+            log_error(g, str.format("FAILED TO INSERT {0} FOR EIN: {1} into mongo gridfs.", part, all_data.get("FILEREIN")), Log_Details)
+            return None
+
+    @staticmethod
+    def bulk_write(collection, requests, result, duplicates=None):
+
+        '''
+
+        Runs an unordered bulk_write and returns its counts i.e. {'nInserted': 10, 'nUpserted': 5, 'nMatched': 2, 'nRemoved': 0 ...}
+        Errors of single operations are counted & logged without stopping the others. When a list is passed as duplicates the positions of the requests
+        that failed because their unique key is already stored are added to it instead of being counted as errors
+
+        '''
+
+        if not requests:
+            return {}
+        try:
+            with METRICS.timer('mongo_bulk_write', collection.name):
+                return collection.bulk_write(requests, ordered=False).bulk_api_result
+        except BulkWriteError as g:
+            write_errors = g.details.get('writeErrors', [])
+            if duplicates is not None:
+                duplicates.extend(error['index'] for error in write_errors if error.get('code') == DUPLICATE_KEY)
+                write_errors = [error for error in write_errors if error.get('code') != DUPLICATE_KEY]
+                if not write_errors:
+                    return g.details
+            result['errors'] += len(write_errors)
+            log_error(g, str.format("Bulk write to {0} had {1} errors first one was: {2}", collection.name, len(write_errors), write_errors[0].get('errmsg') if write_errors else None), Log_Details)
+            return g.details
+        except Exception as g:
+            result['errors'] += len(requests)
+            log_error(g, str.format("Bulk write to {0} failed", collection.name), Log_Details)
+            return {}
@@ -0,0 +1,297 @@
+import os,sys                           # lets us use console and system
+import sqlite3                          # local database that remembers which filings are already in mongo
+from datetime import datetime           # allows us to record when a filing was ingested
+from settings.Settings import checkpoint_database
+from helpers.loggingutil import Log_Details, log_error, log_progress  # Import Custom Logging
+
+# Store name of current script in Log_Details class object as script name. We do this so that error log will always tell us which script error comes from.
+Log_Details.script = os.path.split(sys.argv[0])[1]
+
+LOOKUP_SIZE = 500 # Number of filings looked up in one query (sqlite allows at most 999 parameters per query)
+
+# Overview: Local sqlite store of every filing (ObjectId & FileSha256) written to mongo so a later run can process only the filings
+# of a new index that are new or have changed since (--since-last-run) instead of the whole index.
+# It also keeps a journal per run of the filings that are in flight (read from the index but not stored yet), completed or failed
+# so a run that crashed can be resumed (--resume RUN_ID) and its failures processed again later (--retry-failed RUN_ID).
+
+
+class Checkpoints (object):
+
+    '''
+
+    Remembers the (ObjectId, FileSha256) of the filings we stored in mongo. The same ObjectId with another FileSha256 means the filing changed.
+    Once a run is started (start_run) every filing tracked is journaled as in flight, then as completed or failed once its batch is written.
+
+        Example:
+            checkpoints = Checkpoints('latest_only_2018-12-31')
+            run_id = checkpoints.start_run()
+            writer = BulkWriter(1000, on_flush=checkpoints.flushed)
+            form_parser = FormParser(CSV_OBJECT, CSV_TABLE_OBJECT, csv_to_mapping(CSV_OBJECT, CSV_TABLE_OBJECT))
+            for filing in checkpoints.track(checkpoints.changed(iter_filings_from_index_file('latest_only_2018-12-31'))):
+                writer.add(form_parser.create(filing['URL']))
+            writer.close()
+            checkpoints.finish_run()
+
+    '''
+
+    def __init__(self, index_name=None, path=checkpoint_database):
+        self.index_name = index_name # index the filings we record come from
+        self.path = path
+        self.links = {}              # {xml link: (ObjectId, FileSha256)} of the filings read by track that aren't recorded yet
+        self.run_id = None           # run being journaled (see start_run)
+        # Step 1. Open (or create) the database, other processes (more than 1 index) may write to it at the same time
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS ingested (object_id TEXT PRIMARY KEY, sha256 TEXT, index_name TEXT, ingested_on TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY AUTOINCREMENT, index_name TEXT, arguments TEXT, started_on TEXT, finished_on TEXT, completed INTEGER, failed INTEGER)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS journal (run_id INTEGER, url TEXT, object_id TEXT, state TEXT, updated_on TEXT, PRIMARY KEY (run_id, url))')
+        self.connection.commit()
+
+    def start_run(self, run_id=None, arguments=''):
+
+        '''
+
+        Starts journaling a new run and returns its id, or continues the run with run_id (a crashed or finished run of the same index).
+        Returns None when run_id doesn't exist or belongs to another index.
+
+        '''
+
+        # Step 1. Continue a run we already know about
+        if run_id is not None:
+            run = self.connection.execute('SELECT index_name FROM runs WHERE run_id = ?', (run_id,)).fetchone()
+            if run is None or run[0] != self.index_name:
+                log_error('', str.format("Run {0} doesn't exist or isn't a run of index {1}", run_id, self.index_name), Log_Details)
+                return None
+            with self.connection:
+                self.connection.execute('UPDATE runs SET finished_on = NULL WHERE run_id = ?', (run_id,))
+            self.run_id = int(run_id)
+
+        # Step 2. Otherwise start a new one
+        else:
+            with self.connection:
+                cursor = self.connection.execute('INSERT INTO runs (index_name, arguments, started_on) VALUES (?, ?, ?)', (self.index_name, arguments, self.now()))
+            self.run_id = cursor.lastrowid
+        log_progress('', str.format("Journaling run {0} of index {1}", self.run_id, self.index_name), Log_Details)
+        return self.run_id
+
+    def finish_run(self):
+
+        '''
+
+        Marks the filings of the run still in flight as failed (they were read from the index but couldn't be downloaded or parsed)
+        and records when the run finished along with how many of its filings completed & failed. Returns (completed, failed)
+
+        '''
+
+        if self.run_id is None:
+            return None
+        with self.connection:
+            self.connection.execute("UPDATE journal SET state = 'failed', updated_on = ? WHERE run_id = ? AND state = 'in_flight'", (self.now(), self.run_id))
+            counts = dict(self.connection.execute('SELECT state, COUNT(*) FROM journal WHERE run_id = ? GROUP BY state', (self.run_id,)).fetchall())
+            self.connection.execute('UPDATE runs SET finished_on = ?, completed = ?, failed = ? WHERE run_id = ?', (self.now(), counts.get('completed', 0), counts.get('failed', 0), self.run_id))
+        log_progress('', str.format("Run {0} finished: {1} filings completed {2} failed", self.run_id, counts.get('completed', 0), counts.get('failed', 0)), Log_Details)
+        return counts.get('completed', 0), counts.get('failed', 0)
+
+    def journal(self, urls, state):
+
+        '''
+
+        Records the state (in_flight, completed or failed) of the filings with these urls in the journal of the run
+
+        '''
+
+        if self.run_id is None or not urls:
+            return
+        updated_on = self.now()
+        rows = [(self.run_id, url, (self.links.get(url) or (None, None))[0], state, updated_on) for url in urls]
+        try:
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?, ?)', rows)
+        except Exception as g:
+            log_error(g, str.format("Failed to journal {0} filings as {1} for run {2}", len(rows), state, self.run_id), Log_Details)
+
+    def remaining(self, filings, states=('completed', 'failed')):
+
+        '''
+
+        Generator that skips the filings the journal of the run has in one of states i.e. those a crashed run already completed (or that failed, see retry_failed)
+
+        '''
+
+        for chunk in self.chunks(filings):
+            done = self.journaled(chunk, states)
+            yield from (filing for filing in chunk if filing['URL'] not in done)
+
+    def retry_failed(self, filings):
+
+        '''
+
+        Generator that yields only the filings that failed in the journal of the run
+
+        '''
+
+        for chunk in self.chunks(filings):
+            failed = self.journaled(chunk, ('failed',))
+            yield from (filing for filing in chunk if filing['URL'] in failed)
+
+    def journaled(self, filings, states):
+
+        '''
+
+        Returns the set of urls of filings (a chunk) that are in one of states in the journal of the run
+
+        '''
+
+        urls = [filing['URL'] for filing in filings]
+        query = str.format('SELECT url FROM journal WHERE run_id = ? AND state IN ({0}) AND url IN ({1})', ','.join('?' * len(states)), ','.join('?' * len(urls)))
+        return set(url for url, in self.connection.execute(query, [self.run_id] + list(states) + urls))
+
+    @staticmethod
+    def chunks(filings):
+
+        '''
+
+        Generator that yields filings in lists of LOOKUP_SIZE so they can be looked up with one query
+
+        '''
+
+        chunk = []
+        for filing in filings:
+            chunk.append(filing)
+            if len(chunk) == LOOKUP_SIZE:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    @staticmethod
+    def now():
+
+        '''
+
+        Returns the current time as text i.e. 2024-01-05T03:00:00
+
+        '''
+
+        return datetime.now().isoformat(timespec='seconds')
+
+    def changed(self, filings):
+
+        '''
+
+        Generator that yields the filings (index entries) that were never stored or whose FileSha256 changed since they were stored.
+        Filings without an ObjectId can't be checked so they are always yielded.
+
+        '''
+
+        # Step 1. Look the filings up a chunk at a time
+        for chunk in self.chunks(filings):
+            yield from self.changed_chunk(chunk)
+
+    def changed_chunk(self, filings):
+
+        '''
+
+        Returns the filings of a chunk that are new or changed (see changed)
+
+        '''
+
+        object_ids = [filing.get('ObjectId') for filing in filings if filing.get('ObjectId')]
+        query = str.format('SELECT object_id, sha256 FROM ingested WHERE object_id IN ({0})', ','.join('?' * len(object_ids)))
+        stored = dict(self.connection.execute(query, object_ids).fetchall()) if object_ids else {}
+        return [filing for filing in filings if not filing.get('ObjectId') or stored.get(filing['ObjectId'], False) != filing.get('FileSha256')]
+
+    def track(self, filings):
+
+        '''
+
+        Generator that yields filings (index entries) as they are and remembers their ObjectId & FileSha256 by URL so flushed can record them once they are stored.
+        When a run is journaled each chunk of filings is journaled as in flight before it is yielded.
+
+        '''
+
+        for chunk in self.chunks(filings):
+            for filing in chunk:
+                self.links[filing['URL']] = self.key(filing)
+            self.journal([filing['URL'] for filing in chunk], 'in_flight')
+            yield from chunk
+
+    def flushed(self, forms, result):
+
+        '''
+
+        Called by BulkWriter (on_flush) after a batch of forms was written to mongo. Records the filings of the batch (by their XML_LINK) & journals them as completed
+        unless some writes of the batch failed, then none are recorded (so they are processed again by the next run) & they are journaled as failed.
+
+        '''
+
+        urls = [form.all_data.get('XML_LINK') for form in forms]
+        if result.get('errors'):
+            self.journal(urls, 'failed')
+        else:
+            self.mark([self.links.get(url) or (None, None) for url in urls])
+            self.journal(urls, 'completed')
+        for url in urls:
+            self.links.pop(url, None)
+
+    def forget(self, xml_link):
+
+        '''
+
+        Journals a filing read by track that couldn't be downloaded or parsed as failed & drops it (it will never be flushed)
+
+        '''
+
+        self.journal([xml_link], 'failed')
+        self.links.pop(xml_link, None)
+
+    def mark(self, filings, index_name=None):
+
+        '''
+
+        Records that filings (index entries or (ObjectId, FileSha256) tuples) are stored in mongo
+
+        '''
+
+        index_name = index_name or self.index_name
+        ingested_on = self.now()
+        rows = [(object_id, sha256, index_name, ingested_on) for object_id, sha256 in (self.key(filing) for filing in filings) if object_id]
+        try:
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO ingested VALUES (?, ?, ?, ?)', rows)
+        except Exception as g:
+            log_error(g, str.format("Failed to record {0} filings of index {1} in {2}", len(rows), index_name, self.path), Log_Details)
+
+    @staticmethod
+    def key(filing):
+
+        '''
+
+        Returns the (ObjectId, FileSha256) of an index entry
+
+        '''
+
+        if isinstance(filing, tuple):
+            return filing
+        return filing.get('ObjectId'), filing.get('FileSha256')
+
+    def count(self):
+
+        '''
+
+        Returns the number of filings recorded
+
+        '''
+
+        return self.connection.execute('SELECT COUNT(*) FROM ingested').fetchone()[0]
+
+    def close(self):
+
+        '''
+
+        Logs how many filings are recorded & closes the database
+
+        '''
+
+        log_progress('', str.format("Checkpoints: {0} filings recorded in {1}", self.count(), self.path), Log_Details)
+        self.connection.close()
@@ -0,0 +1,157 @@
+import os,sys                           # lets us use console and system
+import hashlib                          # fingerprints are sha256 hashes
+from settings.Settings import mapping_main_file, mapping_table_file
+from helpers.parser.formparser import PARSER_VERSION
+from helpers.helpers import partition_list # reads the filings of an index a batch at a time
+from helpers.database.interface import mongo_database, form_types
+from helpers.metrics import METRICS     # times every mongo operation per collection (when metrics are on)
+from helpers.loggingutil import Log_Details, log_error, log_progress  # Import Custom Logging
+
+# Store name of current script in Log_Details class object as script name. We do this so that error log will always tell us which script error comes from.
+Log_Details.script = os.path.split(sys.argv[0])[1]
+
+# Overview: Every form stored in mongo carries the fingerprint of what it was made of (FINGERPRINT): the FileSha256 of its filing, a hash of both
+# concordance mapping files, PARSER_VERSION & whether values were typed (--typed). A filing of an index whose fingerprint is already stored would be
+# parsed into the very same form so it is skipped before it is downloaded & parsed. Re-running an index (even with -f) after the mapping or the parser
+# changed only touches the filings that need it. Filings without a FileSha256 & forms stored in GridFS (larger than 16mb) are always processed.
+
+
+def mapping_hash(paths=(mapping_main_file, mapping_table_file)):
+
+    '''
+
+    Returns the sha256 of the concordance mapping files i.e. 'fd45...' (a mapping that changed changes every fingerprint)
+
+    '''
+
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
+def fingerprint(file_sha256, mapping, typed=False, tables=False):
+
+    '''
+
+    Returns the fingerprint of a filing i.e. sha256 of (FileSha256, mapping hash, parser version, typed) or None when the filing has no FileSha256
+    Forms whose tables are stored as rows (--normalize-tables) get another fingerprint so switching it on stores them again
+
+    '''
+
+    if not file_sha256:
+        return None
+    return hashlib.sha256(str.format('{0}|{1}|{2}|{3}{4}', file_sha256.lower(), mapping, PARSER_VERSION, 'typed' if typed else 'text', '|rows' if tables else '').encode('utf-8')).hexdigest()
+
+
+class Fingerprints (object):
+
+    '''
+
+    Skips the filings (index entries) whose fingerprint is already stored in mongo, one $in query per form collection for each batch of filings.
+    Remembers the fingerprint of the filings it lets through by URL so stamp can add it to their forms before they are written.
+
+        Example:
+            fingerprints = Fingerprints(typed=False)
+            writer = BulkWriter(1000, force=True)
+            form_parser = FormParser(CSV_OBJECT, CSV_TABLE_OBJECT, csv_to_mapping(CSV_OBJECT, CSV_TABLE_OBJECT))
+            for filing in fingerprints.changed(iter_filings_from_index_file('latest_only_2018-12-31'), 1000):
+                form = form_parser.create(filing['URL'])
+                if form is not None:
+                    writer.add(fingerprints.stamp(form))
+            writer.close()
+
+    '''
+
+    def __init__(self, typed=False, skip=True, tables=False):
+        self.typed = typed             # --typed stores other values than a text run so it is part of the fingerprint
+        self.tables = tables           # --normalize-tables stores tables in row collections so it is part of the fingerprint too
+        self.skip = skip               # False (--reparse) lets every filing through, their forms are still stamped
+        self.mapping = mapping_hash()  # hash of the concordance mapping files
+        self.links = {}                # {xml link: fingerprint} of the filings let through that aren't stamped yet
+        self.skipped = 0               # filings skipped because they are unchanged
+
+    def changed(self, filings, batch_size=1000, progress=None):
+
+        '''
+
+        Generator that yields the filings that aren't stored with their current fingerprint (new filings, changed filings or filings stored by another
+        mapping or parser version). Skipped filings are counted in progress (see ProgressSummary) when it is passed
+
+        '''
+
+        for batch in partition_list(filings, batch_size, None):
+            yield from self.changed_batch(batch, progress)
+
+    def changed_batch(self, filings, progress=None):
+
+        '''
+
+        Returns the filings of a batch that have to be processed (see changed)
+
+        '''
+
+        # Step 1. Fingerprint every filing of the batch & group the fingerprints by the collection its form would be stored in
+        fingerprints = {}
+        by_form_type = {}
+        for filing in filings:
+            fingerprints[filing['URL']] = fingerprint(filing.get('FileSha256'), self.mapping, self.typed, self.tables)
+            if fingerprints[filing['URL']] is not None and filing.get('FormType') in form_types:
+                by_form_type.setdefault(filing['FormType'], []).append(fingerprints[filing['URL']])
+
+        # Step 2. One query per collection for the fingerprints of the batch that are already stored
+        stored = set()
+        for form_type, batch in (by_form_type.items() if self.skip else ()):
+            try:
+                with METRICS.timer('mongo_find_fingerprints', form_type):
+                    stored.update(document['FINGERPRINT'] for document in mongo_database[form_type].find({'FINGERPRINT': {'$in': batch}}, {'_id': 0, 'FINGERPRINT': 1}))
+            except Exception as g:
+                log_error(g, str.format("Failed to check which {0} filings of the batch are unchanged", form_type), Log_Details)
+
+        # Step 3. Let through the filings whose fingerprint isn't stored & remember it for stamp
+        changed = []
+        for filing in filings:
+            if fingerprints[filing['URL']] in stored:
+                continue
+            if fingerprints[filing['URL']] is not None:
+                self.links[filing['URL']] = fingerprints[filing['URL']]
+            changed.append(filing)
+        skipped = len(filings) - len(changed)
+        self.skipped += skipped
+        if skipped and progress is not None:
+            progress.tick(skipped)
+        return changed
+
+    def stamp(self, form):
+
+        '''
+
+        Adds the fingerprint of its filing to a form (FINGERPRINT) & returns the form
+
+        '''
+
+        value = self.links.pop(form.all_data.get('XML_LINK'), None)
+        if value is not None:
+            form.all_data['FINGERPRINT'] = value
+        return form
+
+    def forget(self, xml_link):
+
+        '''
+
+        Drops the fingerprint of a filing that was let through but couldn't be downloaded or parsed (it will never be stamped)
+
+        '''
+
+        self.links.pop(xml_link, None)
+
+    def close(self):
+
+        '''
+
+        Logs how many filings were skipped because they are unchanged
+
+        '''
+
+        log_progress('', str.format("Fingerprints: {0} unchanged filings were skipped", self.skipped), Log_Details)
@@ -3,17 +3,24 @@ import logging                          # python library that allows us to log t
 from pymongo import MongoClient         # library that lets us use mongo with python 
 from gridfs import GridFS               # library that allows us to store files larger than 16mb into mongo 
 from bson import objectid               # way to handle bson objects for mongo
+from pymongo import UpdateOne           # bulk write operations
+from pymongo.errors import DuplicateKeyError # raised when a unique index cant be created because of duplicates or a form is already stored
+from gridfs.errors import FileExists    # raised when a file with the same id is already stored in gridfs
 from helpers.helpers import get_config  # a method that gets database details depending on arguments passed from the terminal when running xml parser script
-import pickle                           # file format for large python objects
 import os,sys                           #lets us use console and system
+import re                               # allows us to read the ObjectId of a filing out of its link
+import bson                             # allows us to measure the size of a document before sending it to mongo
                                         #lets us import specific settings relating mostly to mongo
 from settings.Settings import mongo_max_document_size, mongo_database_name, schedules_reg_collection_name, schedules_large_collection_name
+from helpers.database.large_documents import put_document # stores documents larger than 16mb in gridfs as compressed bson
+from helpers.metrics import METRICS     # times every mongo operation per form type (when metrics are on)
 from helpers.loggingutil import Log_Details, log_error, log_progress  # Import Custom Logging
 
 # Store name of current script in Log_Details class object as script name. We do this so that error log will always tell us which script error comes from. 
 Log_Details.script = os.path.split(sys.argv[0])[1]
 
 SIZE_MAX_MONGO = mongo_max_document_size # Max size is 16mb for regular documents otherwise we need to use GridFs to store docs in mongo
+OBJECT_ID = re.compile(r'([0-9]+)_public\.xml$') # ObjectId of a filing in the IRS index is part of the name of its xml i.e. 201803129349301355_public.xml
 
 ## Connect To Mongo
 try:
@@ -40,6 +47,104 @@ mongo_database = mongodb_client[mongo_database_name]
 schedules_collection = mongo_database[schedules_reg_collection_name]             # mongo collection that holds schedules
 schedules_collection_b = GridFS(mongo_database, schedules_large_collection_name) # mongo collection that holds schedules larger than 16mb
 
+## Indexes for the queries we run on every form
+# (collection name, keys, unique) -> forms & schedules are always looked up by (FILEREIN, TAXYEAR), schedules also by type & gridfs files by (FILEREIN, year)
+# forms are also looked up by the fingerprint of their filing to skip unchanged filings (see helpers/database/fingerprints.py)
+form_types = ['990', '990EZ', '990PF']
+mongo_indexes = (
+    [(form_type, [('FILEREIN', 1), ('TAXYEAR', 1)], True) for form_type in form_types] +
+    [(form_type, [('FINGERPRINT', 1)], False) for form_type in form_types] +
+    [(schedules_reg_collection_name, [('FILEREIN', 1), ('TAXYEAR', 1), ('type', 1)], False)] +
+    [(name + '.files', [('FILEREIN', 1), ('year', 1)], False) for name in [form_type + 'b' for form_type in form_types] + [schedules_large_collection_name]] +
+    [(name + '.chunks', [('files_id', 1), ('n', 1)], True) for name in [form_type + 'b' for form_type in form_types] + [schedules_large_collection_name]]
+)
+
+
+def form_id(all_data):
+
+    '''
+
+    Returns the _id of a main form: the ObjectId of its filing in the IRS index read out of its XML_LINK i.e. '201803129349301355'
+    or FILEREIN_TAXYEAR when the link doesn't hold one. The same filing always gets the same _id so writing it again is an upsert, not a duplicate
+
+    '''
+
+    found = OBJECT_ID.search(str(all_data.get('XML_LINK') or ''))
+    if found:
+        return found.group(1)
+    return str.format('{0}_{1}', all_data.get('FILEREIN'), all_data.get('TAXYEAR'))
+
+
+def schedule_id(form_id, schedule_type):
+
+    '''
+
+    Returns the _id of a schedule of a form i.e. ('201803129349301355', 'SA') -> '201803129349301355_SA' (a filing has one schedule per type)
+
+    '''
+
+    return str.format('{0}_{1}', form_id, schedule_type)
+
+
+def ensure_indexes():
+
+    '''
+
+    Creates the indexes in mongo_indexes if they dont exist yet (creating an index that already exists does nothing)
+    A unique index that can't be created because the collection already holds duplicates is created as a regular index instead and logged
+
+    '''
+
+    for collection_name, keys, unique in mongo_indexes:
+        collection = mongo_database[collection_name]
+        try:
+            try:
+                collection.create_index(keys, unique=unique)
+            except DuplicateKeyError as g:
+                log_error(g, str.format("Collection {0} has duplicate {1} so the index was created without unique", collection_name, [key for key, direction in keys]), Log_Details)
+                collection.create_index(keys)
+        except Exception as g:
+            log_error(g, str.format("Failed to create index {0} on collection {1}", keys, collection_name), Log_Details)
+    log_progress('', "Mongo indexes are in place", Log_Details)
+
+
+def check_indexes():
+
+    '''
+
+    Prints the explain plan of each query we run on every form so we can see whether it uses an index (IXSCAN) or scans the whole collection (COLLSCAN)
+    Values of an existing document are used when a collection isn't empty
+
+    '''
+
+    # Step 1. Build the queries we run on every form with values of an existing form
+    queries = []
+    for form_type in form_types:
+        sample = mongo_database[form_type].find_one({}, {'FILEREIN': 1, 'TAXYEAR': 1}) or {}
+        query = {'FILEREIN': sample.get('FILEREIN', '000000000'), 'TAXYEAR': sample.get('TAXYEAR', '0000')}
+        queries.append((form_type, 'form exists / remove / update', query))
+        queries.append((form_type, 'forms of a batch already in mongo', {'FILEREIN': {'$in': [query['FILEREIN']]}}))
+        queries.append((form_type, 'unchanged filings of a batch', {'FINGERPRINT': {'$in': ['0' * 64]}}))
+    sample = schedules_collection.find_one({}, {'FILEREIN': 1, 'TAXYEAR': 1, 'type': 1}) or {}
+    queries.append((schedules_reg_collection_name, 'schedule by id', {'_id': sample.get('_id', objectid.ObjectId())}))
+    queries.append((schedules_reg_collection_name, 'schedules of a form', {'FILEREIN': sample.get('FILEREIN', '000000000'), 'TAXYEAR': sample.get('TAXYEAR', '0000'), 'type': sample.get('type', 'SA')}))
+    for name in [form_type + 'b' for form_type in form_types] + [schedules_large_collection_name]:
+        queries.append((name + '.files', 'large documents of a form', {'FILEREIN': '000000000', 'year': '0000'}))
+
+    # Step 2. Print the winning plan of each query i.e. 990 form exists / remove / update: FETCH > IXSCAN (FILEREIN_1_TAXYEAR_1)
+    for collection_name, description, query in queries:
+        try:
+            plan = mongo_database[collection_name].find(query).explain().get('queryPlanner', {}).get('winningPlan', {})
+            plan = plan.get('queryPlan', plan) # newer mongo versions (slot based engine) nest the plan one level down
+            stages = []
+            while plan:
+                stages.append(plan.get('stage', '') + (str.format(' ({0})', plan['indexName']) if plan.get('indexName') else ''))
+                plan = plan.get('inputStage')
+            print (str.format("{0} {1}: {2}", collection_name, description, ' > '.join(stages)))
+        except Exception as g:
+            print (str.format("{0} {1}: failed to explain query {2}", collection_name, description, g))
+            log_error(g, str.format("Failed to explain query on {0}", collection_name), Log_Details)
+
 
 class MongoInterface (object):
 
@@ -62,57 +167,58 @@ class MongoInterface (object):
 
         '''
 
-        # Step 1 is to use the collection name to find 1 document using find_one mongo api -> https://docs.mongodb.com/manual/reference/method/db.collection.findOne/
-        # We use two criteria EIN & TAXYEAR as that ensures that we have singled out only 1 document. If we just used EIN we would get more than one
-        nonprofit = collection.find_one({
-            'FILEREIN': self.all_data.get('FILEREIN'),
-            'TAXYEAR': self.all_data.get('TAXYEAR')
-        })
+        # Step 1 is to find & delete the document in one go using find_one_and_delete mongo api -> https://docs.mongodb.com/manual/reference/method/db.collection.findOneAndDelete/
+        # We use two criteria EIN & TAXYEAR as that ensures that we have singled out only 1 document whatever its _id is (forms stored before _ids were derived from the ObjectId have random ones)
+        try:
+            with METRICS.timer('mongo_remove', self.form_type):
+                nonprofit = collection.find_one_and_delete({
+                    'FILEREIN': self.all_data.get('FILEREIN'),
+                    'TAXYEAR': self.all_data.get('TAXYEAR')
+                }, {'schedules': 1})
+        except Exception as g:
+            log_error(g, str.format( "Unable to find or delete records for EIN: {0} TaxYear: {1}", self.all_data.get("FILEREIN"), self.all_data.get("TAXYEAR")),Log_Details)
+            return
 
-        # If the result exists i.e. the document exists then we proceed to delte all related data
+        # If the document existed then we proceed to delete all related data
         if nonprofit:
             # find all the relevant schedules for this document and delete them. Remember schedules are in separate collection than main document. 
-            #print ("Removing Schedules Associated with Document")
             try: 
-                schedules_collection.delete_many({
-                    '_id': {'$in': nonprofit.get('schedules', [])}
-                })
-                #print (str.format("Deleting record for EIN: {0} TaxYear: {1} ", self.all_data.get("FILEREIN"),self.all_data.get("TAXYEAR")))
-                log_progress('',collection.delete_one({'_id': nonprofit.get('_id', 0)}),Log_Details)
+                with METRICS.timer('mongo_remove', self.form_type):
+                    schedules_collection.delete_many({
+                        '_id': {'$in': nonprofit.get('schedules', [])}
+                    })
+                log_progress('',str.format("Deleted record for EIN: {0} TaxYear: {1}", self.all_data.get("FILEREIN"),self.all_data.get("TAXYEAR")),Log_Details)
             except Exception as g:
-                log_error(g, str.format( "Unable to find or delete records for EIN: {0} TaxYear: {1}", self.all_data.get("FILEREIN"), self.all_data.get("TAXYEAR")),Log_Details)
+                log_error(g, str.format( "Unable to delete schedules for EIN: {0} TaxYear: {1}", self.all_data.get("FILEREIN"), self.all_data.get("TAXYEAR")),Log_Details)
         else:
-            #print (str.format("Record not found for EIN: {0} TaxYear: {1} ", self.all_data.get("FILEREIN"),self.all_data.get("TAXYEAR")))
-            log_error(g, str.format("Record not found for EIN: {0}  TaxYear: {1} so could not remove. ", self.all_data.get("FILEREIN"),self.all_data.get("TAXYEAR")), Log_Details)
-    
-    def __form_not_exists(self, collection):
+            log_progress('', str.format("Record not found for EIN: {0}  TaxYear: {1} so could not remove. ", self.all_data.get("FILEREIN"),self.all_data.get("TAXYEAR")), Log_Details)
+
+    def __put_gridfs(self, collectionb, document, file_id, part, replace=False):
 
         '''
 
-        This methods checks to see if a form exist in mongo once we have provided a colleciton to search. 
+        This method stores a document larger than 16mb (main form or schedule) in gridfs under file_id as compressed bson (see large_documents.py)
+        a file already stored under file_id is kept unless replace is True. Read it back with load_form / load_schedules
 
         '''
 
-        # Step 1 is to use the collection name to find 1 document using find_one mongo api -> https://docs.mongodb.com/manual/reference/method/db.collection.findOne/
-        # We use two criteria EIN & TAXYEAR as that ensures that we have singled out only 1 document. If we just used EIN we would get more than one
-        try: 
-            nonprofit = collection.find_one({
-                'FILEREIN': self.all_data['FILEREIN'],
-                'TAXYEAR': self.all_data['TAXYEAR']
-            })
-            return nonprofit is None # Step 2b if the search results in nothing then we return None
-
+        filenm = str.format("{0}_{1}_{2}.bson", self.all_data.get("FILEREIN"), self.all_data.get('TAXYEAR'), part)
+        try:
+            with METRICS.timer('mongo_gridfs', self.form_type):
+                put_document(collectionb, document, file_id, replace, type=part, filename=filenm, year=self.all_data.get('TAXYEAR'), state=self.all_data.get('FILERUSSTATE'), FILEREIN=self.all_data.get("FILEREIN"), filing_type=self.form_type)
+            log_progress('',str.format( "SUCCESSFULLY INSERTED {0} FOR EIN: {1} into mongo gridfs", part, self.all_data.get("FILEREIN")),Log_Details)
+        except FileExists:
+            log_progress('',str.format( "{0} FOR EIN: {1} ALREADY EXISTS IN MONGO GRIDFS! Skipping", part, self.all_data.get("FILEREIN")),Log_Details)
         except Exception as g:
-            # Step 2b if the search results in nothing then we return None
-            log_error(g, "Failed to check if form does not exist", Log_Details)
+            log_error(g, str.format( "FAILED TO INSERT {0} FOR EIN: {1} into mongo gridfs.", part, self.all_data.get("FILEREIN")),Log_Details)
 
-            return False # we return false and store ein for logging
-
-    def insert_data_to_mongo(self):
+    def insert_data_to_mongo(self, replace=False):
 
         '''
 
-        This method will insert form & schedule data into mongo after making sure it doesnt already exist
+        This method will insert form & schedule data into mongo unless it already exists.
+        Forms & schedules have _ids derived from the ObjectId of the filing (see form_id & schedule_id) so inserting is an upsert that leaves a stored form as it is:
+        there is no check before writing that another process could race & inserting the same filing twice (or from 2 processes at once) never creates duplicates
 
         '''
 
@@ -120,96 +226,54 @@ class MongoInterface (object):
         # Example if Form is 990pf mongodb_client['irs_xml'] -> collection = mongodb_client['irs_xml']['990PF'] 
         collection = mongo_database[self.form_type]
         collectionb = GridFS(mongo_database, (self.form_type+'b')) # way to access collection by form type for documents larger than 16mb
+        main_id = form_id(self.all_data)
 
         # Step 2. Log whats going on i.e ein we are processing 
         log_progress('',str.format("PROCESSING EIN: {0} & Inserting into Mongo",self.all_data.get("FILEREIN")), Log_Details)
-        #print (str.format("PROCESSING EIN: {0}",self.all_data.get("FILEREIN")))
-
-        # Step 3. Check to make sure the form doesn't already exist in Mongo if it does we pass because we are not interested in reinserting information
-        if self.__form_not_exists(collection): # if it doesn't exist i.e. if return is a NONE:
-
-            # Step 3a. If the form contains schedule data (remember schedules is one of the 2 data dictionaries store with each form )
-            if self.schedules:
-
-                # Step 3a1
-                # Then we need to insert each schedule's data in data collection 
-                # This is mongo docs for insert_many-> https://docs.mongodb.com/manual/reference/method/db.collection.insertMany/
-                try:
-                    schedules_ids = schedules_collection.insert_many(self.schedules).inserted_ids
-                    # Step 3a2 # Once we have inserted them we get as a result -> { "acknowledged" : true, "insertedIds" : [ 10, 11, 12 ] }
-                    # We will store schedules_ids -> as list [ 10, 11, 12 ] these are the unique identifiers then for what we just inserted
-
-                    # Step 3a3 Now that we have inserted the schedule data into mongo -> we just insert the id's for each schedule into the main form 
-                    # remember all_data is the dictionary with the main form -> so now it contains a field called ['schedules'] with identifiers for each schedule that goes with that form 
-                    self.all_data['schedules'] = schedules_ids
-                    log_progress('',str.format( "SUCCESSFULLY INSERTED SCHEDULE DATA FOR EIN: {0} into mongo", self.all_data.get("FILEREIN")),Log_Details)
-                    #print (str.format( "SUCCESSFULLY INSERTED SCHEDULE DATA FOR EIN: {0} into mongo", self.all_data.get("FILEREIN")))
-
-                except:
-                    # This happens if BSON is too large then we need to use gridfs to insert into mongo database
-                    try:
-                        schedules_inserted = []
-                        schedz = self.schedules
-                        # Processing each schedule and inserting it as a separate object into main data form
-                        for sched in schedz:
-                            # for each schedule in list of schedules store schedule and save object
-                            filenm= self.all_data.get("FILEREIN")+"_"+self.all_data.get('TAXYEAR')+"_"+ sched.get("type")+".pickle"
-                            with open(filenm, 'wb') as handle:
-                                # Saves schedule as pickle file locally
-                                pickle.dump(sched, handle, protocol=pickle.HIGHEST_PROTOCOL)
-                            with open(filenm) as z:
-                                # Save pickle filed schedule to mongo
-                                x = schedules_collection_b.put(z, content_type='pickle', type= sched.get("type"), filename=filenm, year=self.all_data.get('TAXYEAR'), state=self.all_data.get('FILERUSSTATE'), FILEREIN=self.all_data.get("FILEREIN"), filing_type =self.form_type )
-                            # Converts object's objectid into string to append to list
-                                nam = str(x)
-                            # Append object id to list
-                                schedules_inserted.append(nam)
-                        # add list of schedules inserted into schedules
-                        self.all_data['schedules'] = schedules_inserted
-                        log_progress('',str.format( "SUCCESSFULLY INSERTED SCHEDULE DATA FOR EIN: {0} into mongo gridfs list of ids{1}", self.all_data.get("FILEREIN"),self.all_data.get("schedules")),Log_Details)
-                        #print (str.format( "SUCCESSFULLY INSERTED SCHEDULE DATA FOR EIN: {0} into mongo gridfs list of ids{1}", self.all_data.get("FILEREIN"),self.all_data.get("schedules")))
-                    except Exception as g: 
-                        # If this fails then we log it
-                        log_error(g, str.format( "FAILED TO INSERT SCHEDULE DATA FOR EIN: {0} into mongo gridfs. Error was: {1}", self.all_data.get("FILEREIN")),Log_Details)
-                        #print (str.format( "FAILED TO INSERT SCHEDULE DATA FOR EIN: {0} into mongogridfs. Error was: {1}", self.all_data.get("FILEREIN"), g ))
-
-            # we take the main form type in our example 990PF -> insert the main form data by calling the mongo insert_one method docs ->  https://docs.mongodb.com/manual/reference/method/db.collection.insertOne/
-            try:
-
-                # Step 4. Insert Document
-                collection.insert_one(self.all_data)
-                
-                # Step 5. We log that insertion works
-                log_progress('',str.format( "SUCCESSFULLY INSERTED MAIN FORM DATA FOR EIN: {0} into mongo",self.all_data.get("FILEREIN")),Log_Details)
-                #print (str.format( "SUCCESSFULLY INSERTED MAIN FORM DATA FOR EIN: {0} into mongo",self.all_data.get("FILEREIN")))
 
-            except:
-                # Step 6. If insertion failed we make note of it
-                try:
-                    # Setup name of pickle file
-                    filenm2= self.all_data.get("FILEREIN")+"_"+self.all_data.get('TAXYEAR')+"_"+"main_form"+".pickle"
-                    with open(filenm2, 'wb') as second_handle:
-                        # Save as pickle file
-                        pickle.dump(self.all_data, second_handle, protocol=pickle.HIGHEST_PROTOCOL)
-                    with open(filenm2) as zz:
-                        # Try to insert pickle file using gridfs
-                        collectionb.put(zz, content_type='pickle', filename=filenm2, year=self.all_data.get('TAXYEAR'), state=self.all_data.get('FILERUSSTATE'), FILEREIN=self.all_data.get("FILEREIN"), filing_type=self.form_type)
-                    # Step 5. We log that insertion works
-                    log_progress('',str.format( "SUCCESSFULLY INSERTED MAIN FORM DATA FOR EIN: {0} into mongo gridfs",self.all_data.get("FILEREIN")),Log_Details)
-                    #print (str.format( "SUCCESSFULLY INSERTED MAIN FORM DATA FOR EIN: {0} into mongo gridfs",self.all_data.get("FILEREIN")))
-                except Exception as g:
-                    # If this fails we log it. 
-                    log_error(g,str.format("FAILED TO INSERT MAIN FORM DATA FOR EIN: {0} into mongo gridfs. Error was: {1}", self.all_data.get("FILEREIN")),Log_Details)
-                    #print (str.format("FAILED TO INSERT MAIN FORM DATA FOR EIN: {0} into mongo gridfs. Error was: {1}", self.all_data.get("FILEREIN"), h ))
-            
-            # Step 6. Removing Large Pickle Files That were created and inserted using GridFs    
-            #try:
-            #    os.system("rm *.pickle") # removes all pickle files
-            #except:
-            #    pass
+        # Step 3. Each schedule gets its _id from the form's _id & its type so the main form can point to its schedules before they are written
+        schedules = self.schedules or []
+        for schedule in schedules:
+            schedule['_id'] = schedule_id(main_id, schedule.get('type'))
+        if schedules:
+            self.all_data['schedules'] = [schedule['_id'] for schedule in schedules]
+
+        # Step 4. Upsert the main form on its _id ($setOnInsert -> a form that already exists is left as it is) forms larger than 16mb go to gridfs under the same _id
+        # Docs -> https://docs.mongodb.com/manual/reference/operator/update/setOnInsert/
+        if len(bson.encode(self.all_data)) > SIZE_MAX_MONGO:
+            self.__put_gridfs(collectionb, self.all_data, main_id, 'main_form', replace)
         else:
-            log_progress('',str.format( "FAILED FORM FOR EIN: {0} ALREADY EXISTS IN MONGO! Skipping", self.all_data.get("FILEREIN")),Log_Details)
-            #print (str.format( "FORM FOR EIN: {0} ALREADY EXISTS IN MONGO!", self.all_data.get("FILEREIN")))
+            try:
+                with METRICS.timer('mongo_insert', self.form_type):
+                    inserted = collection.update_one({'_id': main_id}, {'$setOnInsert': {key: value for key, value in self.all_data.items() if key != '_id'}}, upsert=True).upserted_id is not None
+                if inserted:
+                    log_progress('',str.format( "SUCCESSFULLY INSERTED MAIN FORM DATA FOR EIN: {0} into mongo",self.all_data.get("FILEREIN")),Log_Details)
+                else:
+                    log_progress('',str.format( "FORM FOR EIN: {0} ALREADY EXISTS IN MONGO! Skipping", self.all_data.get("FILEREIN")),Log_Details)
+
+            # Step 4a. The (FILEREIN, TAXYEAR) of the form is already stored under another _id (stored before _ids were derived from the ObjectId) so we are done
+            except DuplicateKeyError:
+                log_progress('',str.format( "FORM FOR EIN: {0} TaxYear: {1} ALREADY EXISTS IN MONGO! Skipping", self.all_data.get("FILEREIN"), self.all_data.get("TAXYEAR")),Log_Details)
+                return
+            except Exception as g:
+                log_error(g,str.format("FAILED TO INSERT MAIN FORM DATA FOR EIN: {0} into mongo", self.all_data.get("FILEREIN")),Log_Details)
+                return
+
+        # Step 5. Upsert the schedules on their _ids in one bulk write (schedules a crashed run didn't write are added, those already stored are left as they are)
+        # schedules larger than 16mb go to gridfs under the same _id. Docs -> https://docs.mongodb.com/manual/reference/method/db.collection.bulkWrite/
+        requests = []
+        for schedule in schedules:
+            if len(bson.encode(schedule)) > SIZE_MAX_MONGO:
+                self.__put_gridfs(schedules_collection_b, schedule, schedule['_id'], schedule.get('type'), replace)
+            else:
+                requests.append(UpdateOne({'_id': schedule['_id']}, {'$setOnInsert': {key: value for key, value in schedule.items() if key != '_id'}}, upsert=True))
+        if requests:
+            try:
+                with METRICS.timer('mongo_insert_schedules', self.form_type):
+                    schedules_collection.bulk_write(requests, ordered=False)
+                log_progress('',str.format( "SUCCESSFULLY INSERTED SCHEDULE DATA FOR EIN: {0} into mongo", self.all_data.get("FILEREIN")),Log_Details)
+            except Exception as g:
+                log_error(g, str.format( "FAILED TO INSERT SCHEDULE DATA FOR EIN: {0} into mongo", self.all_data.get("FILEREIN")),Log_Details)
 
 
     def insert_data_force_to_mongo(self):
@@ -227,8 +291,8 @@ class MongoInterface (object):
         # Step 2. Call the remove form method passing the collection information 
         self.__remove_form(collection)
 
-        # Step 3. Call the insert data into mongo method. 
-        self.insert_data_to_mongo()
+        # Step 3. Call the insert data into mongo method (files in gridfs under the same _ids are replaced)
+        self.insert_data_to_mongo(replace=True)
 
         ##! Opportunity for some error/log handling
 
@@ -246,10 +310,11 @@ class MongoInterface (object):
 
         # Step 2. Find a document 
         # We use two criteria EIN & TAXYEAR as that ensures that we have singled out only 1 document. If we just used EIN we would get more than one
-        nonprofit_from_db = collection.find_one({
-            'FILEREIN': self.all_data.get('FILEREIN'),
-            'TAXYEAR': self.all_data.get('TAXYEAR')
-        })
+        with METRICS.timer('mongo_find', self.form_type):
+            nonprofit_from_db = collection.find_one({
+                'FILEREIN': self.all_data.get('FILEREIN'),
+                'TAXYEAR': self.all_data.get('TAXYEAR')
+            })
 
         # Step 3. if we found a document match 
         if nonprofit_from_db is not None:
@@ -263,9 +328,10 @@ class MongoInterface (object):
             # uncomment if you want to log -> log_progress('',str.format("Updating Main Form Data for EIN: {0} Tax Year: {1}", self.all_data.get("FILEREIN"),self.all_data.get("TAXYEAR")),Log_Details)
          
             try: 
-                collection.update_one(
-                    {'_id': nonprofit_from_db.get('_id')}, # passing id so we can identify the proper document
-                    {'$set': self.all_data}) # Passing all the document data
+                with METRICS.timer('mongo_update', self.form_type):
+                    collection.update_one(
+                        {'_id': nonprofit_from_db.get('_id')}, # passing id so we can identify the proper document
+                        {'$set': self.all_data}) # Passing all the document data
             
             except Exception as g:
                 log_error(g, str.format("Unable to Update Main Form Data for EIN: {0} Tax Year: {1}", self.all_data.get("FILEREIN"),self.all_data.get("TAXYEAR")),Log_Details)
@@ -291,8 +357,9 @@ class MongoInterface (object):
             # remember schedules_collection = mongo_database['schedules']  
 
             # Step 2a. Connect to mongo schedules collection and find the relevant document given the id using find_one mongo api -> find_one mongo api -> https://docs.mongodb.com/manual/reference/method/db.collection.findOne/
-            schedule_from_db = schedules_collection.find_one(
-                {"_id": schedule_id})
+            with METRICS.timer('mongo_find_schedule', self.form_type):
+                schedule_from_db = schedules_collection.find_one(
+                    {"_id": schedule_id})
 
             # Step 2b1. 
             # create a list: of schedules by setting schedule equal to all the schedule data in the form self.schedules -> is dictionary with schedule data
@@ -310,9 +377,10 @@ class MongoInterface (object):
                 # Step 2b2a Update document using update_one mongo api https://docs.mongodb.com/manual/reference/method/db.collection.updateOne/
                 #uncomment if you want to log -> log_progress('',str.format("Updating Schedule Data for EIN: {0} Tax Year: {1}", self.all_data.get("FILEREIN"),self.all_data.get("TAXYEAR")),Log_Details)
                 try:
-                    schedules_collection.update_one(
-                        {'_id': schedule_id},
-                        {'$set': schedule_filter[0]}) 
+                    with METRICS.timer('mongo_update_schedule', self.form_type):
+                        schedules_collection.update_one(
+                            {'_id': schedule_id},
+                            {'$set': schedule_filter[0]}) 
                         # we pass schedule filter [0] because there should only be one match for the document given ein/tax year etc. 
                         # Schedule_filter 0 at this point is the underlying schedule data
                     break
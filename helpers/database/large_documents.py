@@ -0,0 +1,187 @@
+import os,sys                           # lets us use console and system
+import zlib                             # compression that is always available
+import pickle                           # file format of large documents stored before they were stored as compressed bson (read only)
+import bson                             # documents are stored in gridfs the way mongo stores them
+from bson import ObjectId               # large documents stored before their _ids were derived from the ObjectId of their filing have bson ids
+import pyarrow as pa                    # zstd compression (much faster than zlib for the same size)
+from gridfs import GridFS               # library that allows us to store files larger than 16mb into mongo
+from gridfs.errors import NoFile        # raised when no gridfs file matches
+from settings.Settings import mongo_gridfs_compression, mongo_gridfs_compression_level, schedules_reg_collection_name, schedules_large_collection_name
+from helpers.database.table_rows import load_rows # puts the rows of tables stored as their own documents back into a form (--normalize-tables)
+from helpers.metrics import METRICS     # times every mongo operation per form type (when metrics are on)
+from helpers.loggingutil import Log_Details, log_error  # Import Custom Logging
+
+# Store name of current script in Log_Details class object as script name. We do this so that error log will always tell us which script error comes from.
+Log_Details.script = os.path.split(sys.argv[0])[1]
+
+CONTENT_TYPE = 'application/bson' # Content type of the gridfs files written here (older files are 'pickle')
+
+# Overview: Documents (main forms & schedules) larger than mongo_max_document_size can't be stored as regular mongo documents so they are stored in gridfs
+# (990b, 990EZb, 990PFb & schedulesb). They are encoded as bson (the size mongo measures), compressed in memory with zstd (or zlib) and streamed to gridfs
+# in chunks, nothing is written to disk. The gridfs file keeps FILEREIN, year, type & filing_type so it can be found, and load_form / load_schedules
+# read a form & its schedules the same way whether they are regular documents or stored in gridfs (compressed bson or the pickles of older runs).
+# Tables stored as a document per row (--normalize-tables see table_rows.py) are put back too.
+
+
+def compression_codec(compression=mongo_gridfs_compression):
+
+    '''
+
+    Returns the compression actually used: zstd when pyarrow has it (otherwise zlib), zlib or none
+
+    '''
+
+    if compression == 'zstd' and not pa.Codec.is_available('zstd'):
+        return 'zlib'
+    return compression if compression in ('zstd', 'zlib') else 'none'
+
+
+def compress(data, compression, level=mongo_gridfs_compression_level):
+
+    '''
+
+    Returns data (bytes) compressed with zstd, zlib or none
+
+    '''
+
+    if compression == 'zstd':
+        return pa.Codec('zstd', compression_level=level).compress(data, asbytes=True)
+    if compression == 'zlib':
+        return zlib.compress(data, level)
+    return data
+
+
+def decompress(data, compression, size):
+
+    '''
+
+    Returns data compressed with compression (zstd, zlib or none), size is the length of the data before it was compressed
+
+    '''
+
+    if compression == 'zstd':
+        return pa.Codec('zstd').decompress(data, decompressed_size=size, asbytes=True)
+    if compression == 'zlib':
+        return zlib.decompress(data)
+    return data
+
+
+def put_document(collectionb, document, file_id=None, replace=False, **metadata):
+
+    '''
+
+    Stores a document in a gridfs collection as compressed bson under file_id (a new id when None) & returns its id.
+    metadata is stored with the file i.e. type='SA', filename='123_2019_SA.bson', year='2019', FILEREIN='123', filing_type='990'.
+    A file already stored under file_id is kept (FileExists is raised) unless replace is True
+
+    '''
+
+    # Step 1. Encode the document as mongo would & compress it in memory
+    data = bson.encode(document)
+    compression = compression_codec()
+    compressed = compress(data, compression)
+
+    # Step 2. Stream it to gridfs in chunks (gridfs splits it into chunk_size documents)
+    if replace and file_id is not None:
+        collectionb.delete(file_id)
+    if file_id is not None:
+        metadata['_id'] = file_id
+    return collectionb.put(compressed, content_type=CONTENT_TYPE, compression=compression, bson_size=len(data), **metadata)
+
+
+def read_document(grid_out):
+
+    '''
+
+    Returns the document stored in a gridfs file (compressed bson or a pickle of an older run)
+
+    '''
+
+    data = grid_out.read()
+    if grid_out.content_type == CONTENT_TYPE:
+        return bson.decode(decompress(data, getattr(grid_out, 'compression', 'none'), getattr(grid_out, 'bson_size', None)))
+    return pickle.loads(data)
+
+
+def get_document(collectionb, file_id):
+
+    '''
+
+    Returns the document stored in a gridfs collection under file_id or None when there is none.
+    Ids of older files were stored as text (str of their bson id) so those are looked up as bson ids too
+
+    '''
+
+    grid_out = collectionb.find_one({'_id': file_id})
+    if grid_out is None and isinstance(file_id, str) and ObjectId.is_valid(file_id):
+        grid_out = collectionb.find_one({'_id': ObjectId(file_id)})
+    return read_document(grid_out) if grid_out is not None else None
+
+
+def delete_document(collectionb, file_id):
+
+    '''
+
+    Removes the document stored in a gridfs collection under file_id, returns True when there was one.
+    Ids of older files were stored as text (str of their bson id) so those are removed as bson ids too
+
+    '''
+
+    for candidate in [file_id] + ([ObjectId(file_id)] if isinstance(file_id, str) and ObjectId.is_valid(file_id) else []):
+        if collectionb.exists(candidate):
+            collectionb.delete(candidate)
+            return True
+    return False
+
+
+def load_schedules(database, schedule_ids):
+
+    '''
+
+    Returns the schedules with these ids (the schedules field of a main form) in the same order wherever they are stored:
+    one query for the regular schedules, the others are read out of gridfs
+
+    '''
+
+    with METRICS.timer('mongo_load_schedules'):
+        found = {schedule['_id']: schedule for schedule in database[schedules_reg_collection_name].find({'_id': {'$in': list(schedule_ids)}})}
+        collectionb = GridFS(database, schedules_large_collection_name)
+        schedules = []
+        for schedule_id in schedule_ids:
+            schedule = found.get(schedule_id)
+            if schedule is None:
+                schedule = get_document(collectionb, schedule_id)
+            if schedule is not None:
+                schedules.append(schedule)
+    return schedules
+
+
+def load_form(database, form_type, filerein, taxyear, schedules=True):
+
+    '''
+
+    Returns the main form (FILEREIN, TAXYEAR) of a form type whether it is a regular document or stored in gridfs, with its schedules (the documents instead
+    of their ids) & the rows of its tables stored in row collections unless schedules is False. Returns None when the form isn't stored
+
+        Example:
+            form = load_form(mongo_database, '990', '123456789', '2019')
+            form['schedules'] -> [{'type': 'SA', ...}, {'type': 'SB', ...}]
+
+    '''
+
+    try:
+        with METRICS.timer('mongo_load_form', form_type):
+            form = database[form_type].find_one({'FILEREIN': filerein, 'TAXYEAR': taxyear})
+            if form is None:
+                try:
+                    form = read_document(GridFS(database, form_type + 'b').get_last_version(FILEREIN=filerein, year=taxyear))
+                except NoFile:
+                    return None
+        if form is not None and schedules and form.get('schedules'):
+            form['schedules'] = load_schedules(database, form['schedules'])
+        if form is not None and schedules and form.get('TABLES'):
+            load_rows(database, form)
+        return form
+    except Exception as g:
+        log_error(g, str.format("Failed to load form {0} for EIN: {1} TaxYear: {2}", form_type, filerein, taxyear), Log_Details)
+        return None
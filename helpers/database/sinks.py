@@ -0,0 +1,405 @@
+import os,sys                           # lets us use console and system
+import time                             # allows us to flush the buffer after a number of seconds
+import json                             # file format of the ndjson sink
+import gzip                             # compresses the ndjson sink
+import hashlib                          # names parquet files after the filings they hold
+import pyarrow as pa                    # columnar tables written by the parquet sink
+import pyarrow.parquet as pq            # parquet file format
+from settings.Settings import mongo_bulk_flush_seconds
+from helpers.parser.coercion import number, coerce_column # converts text values to the type of their column
+from helpers.loggingutil import Log_Details, log_error, log_progress  # Import Custom Logging
+
+# Store name of current script in Log_Details class object as script name. We do this so that error log will always tell us which script error comes from.
+Log_Details.script = os.path.split(sys.argv[0])[1]
+
+# Overview: Sinks are where parsed forms (Form990/Form990EZ/Form990PF) are written to. Every sink buffers forms and writes them in batches.
+# BulkWriter (bulk_writer.py) writes to mongo & is the default, NdjsonSink, ParquetSink & ColumnarSink write files so no database is needed (--sink).
+
+PARTITION_NULL = '__HIVE_DEFAULT_PARTITION__' # Partition folder of rows without a (valid) tax year, parquet readers read it as null
+
+
+class Sink (object):
+
+    '''
+
+    Base class of every sink. Buffers forms and hands them to write once batch_size forms are buffered or flush_seconds have passed since the last write.
+    Sinks implement write(forms, result) which writes a batch and adds up what happened in result (see new_result).
+
+        Example:
+            sink = NdjsonSink('output', 1000)
+            for form in forms:
+                sink.add(form)
+            sink.close()
+
+    '''
+
+    name = 'Sink' # name used when the sink logs its batches
+
+    def __init__(self, batch_size=1000, flush_seconds=mongo_bulk_flush_seconds, on_flush=None, coercion=None):
+        self.batch_size = batch_size       # number of forms buffered before they are written
+        self.flush_seconds = flush_seconds # seconds after which the buffer is written even if it isn't full
+        self.on_flush = on_flush           # called with (forms, batch result) after every batch i.e. Checkpoints.flushed
+        self.coercion = coercion           # Coercion that converts the values of each batch to their types before it is written (--typed)
+        self.forms = []                    # forms waiting to be written
+        self.last_flush = time.monotonic()
+        self.totals = self.new_result()    # results of every batch added up
+
+    @staticmethod
+    def new_result():
+
+        '''
+
+        Returns an empty batch result i.e. how many forms were written, how many failed & how many values didn't fit their type
+
+        '''
+
+        return {'forms': 0, 'written': 0, 'errors': 0, 'invalid': 0}
+
+    def add(self, form):
+
+        '''
+
+        Buffers a form & writes the buffer when it is full or old enough. Returns the batch result when a batch was written otherwise None
+
+        '''
+
+        self.forms.append(form)
+        if len(self.forms) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_seconds:
+            return self.flush()
+        return None
+
+    def close(self):
+
+        '''
+
+        Writes whatever is left in the buffer and logs the totals of every batch. Returns the totals
+
+        '''
+
+        if self.forms:
+            self.flush()
+        log_progress('', str.format("{0} finished: {1}", self.name, self.totals), Log_Details)
+        return self.totals
+
+    def flush(self):
+
+        '''
+
+        Writes the buffered forms and returns the batch result
+
+        '''
+
+        # Step 1. Take the forms out of the buffer & setup the result of the batch
+        forms, self.forms = self.forms, []
+        self.last_flush = time.monotonic()
+        result = self.new_result()
+        result['forms'] = len(forms)
+
+        # Step 2. Convert the values of the batch to their types (--typed) & let the sink write them
+        if self.coercion is not None:
+            result['invalid'] += self.coercion.coerce_forms(forms)
+        self.write(forms, result)
+
+        # Step 3. Report the batch & add it to the totals
+        for name, value in result.items():
+            self.totals[name] += value
+        log_progress('', str.format("{0} batch: {1}", self.name, result), Log_Details)
+        if self.on_flush is not None:
+            self.on_flush(forms, result)
+        return result
+
+    def write(self, forms, result):
+        raise NotImplementedError
+
+
+class NdjsonSink (Sink):
+
+    '''
+
+    Writes forms as gzip compressed newline delimited json, one file per form type i.e. {directory}/990.ndjson.gz
+    Each line is the main form (all_data) with its schedules embedded under 'schedules' i.e. the document we would store in mongo.
+    Every batch is appended to the file as its own gzip member (gzip readers read them as one file). Keys are sorted so the same filing always gives the same line.
+
+    '''
+
+    name = 'Ndjson sink'
+
+    def __init__(self, directory, batch_size=1000, flush_seconds=mongo_bulk_flush_seconds, on_flush=None, coercion=None):
+        super(NdjsonSink, self).__init__(batch_size, flush_seconds, on_flush, coercion)
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+    def write(self, forms, result):
+
+        '''
+
+        Appends a batch of forms to the file of their form type
+
+        '''
+
+        # Step 1. Group the lines of the batch by form type
+        lines = {}
+        for form in forms:
+            try:
+                record = dict(form.all_data, schedules=form.schedules or [])
+                lines.setdefault(form.form_type, []).append(json.dumps(record, sort_keys=True, default=str))
+            except Exception as g:
+                result['errors'] += 1
+                log_error(g, str.format("Failed to convert form of EIN: {0} to json", form.all_data.get('FILEREIN')), Log_Details)
+
+        # Step 2. Append each group to its file
+        for form_type, group in lines.items():
+            path = os.path.join(self.directory, str.format('{0}.ndjson.gz', form_type))
+            try:
+                with gzip.open(path, 'at', encoding='utf-8') as file:
+                    file.write('\n'.join(group) + '\n')
+                result['written'] += len(group)
+            except Exception as g:
+                result['errors'] += len(group)
+                log_error(g, str.format("Failed to write {0} forms to {1}", len(group), path), Log_Details)
+
+
+class ParquetSink (Sink):
+
+    '''
+
+    Writes forms as parquet files partitioned by form type & tax year i.e. {directory}/990/TAXYEAR=2021/part-3f2a....parquet
+    and their schedules to {directory}/schedules/RETURNTYPE=990/TAXYEAR=2021/part-9c1d....parquet (with XML_LINK & FILEREIN to join them back).
+    Each batch writes one file per partition with the same columns in every file of a form type (or of the schedules): every variable of the
+    variable catalog (helpers/parser/catalog.py) & every table, sorted by name. TAXYEAR (& RETURNTYPE of schedules) is only stored in the folder names, readers
+    i.e. pyarrow.parquet.read_table('output/parquet/990') add them back as columns. Every column is text, tables & variables that repeat within a filing
+    are stored as json. A file is named after the filings it holds so writing the same batch again (re-running an index) replaces it.
+
+    '''
+
+    name = 'Parquet sink'
+
+    def __init__(self, directory, catalog, batch_size=1000, flush_seconds=mongo_bulk_flush_seconds, on_flush=None):
+        super(ParquetSink, self).__init__(batch_size, flush_seconds, on_flush)
+        self.directory = directory
+        self.catalog = catalog # VariableCatalog with the columns of every table
+        os.makedirs(self.directory, exist_ok=True)
+
+    def text_columns(self, kind):
+
+        '''
+
+        Returns the sorted columns of the files of a form type or of the schedules (kind) i.e. '990' -> ['ACCOUNTANTCOMPILEORREVIEW', ..., 'XML_LINK']
+        Partition columns (TAXYEAR & RETURNTYPE of schedules) are left out as they are the folder names
+
+        '''
+
+        if kind == 'schedules':
+            columns = (set(name for columns in self.catalog.schedules.values() for name in columns) | {'type'}) - {'RETURNTYPE'}
+        else:
+            columns = set(self.catalog.forms.get(kind, {}))
+        return sorted((columns | set(self.catalog.tables)) - {'TAXYEAR'})
+
+    @staticmethod
+    def part_path(folder, rows):
+
+        '''
+
+        Returns the path of the file a batch of rows is written to in a partition folder, named after the filings (XML_LINK) of the rows
+        i.e. {folder}/part-3f2a9c1d5e6b7a80.parquet so writing the same filings again replaces the file instead of adding another one
+
+        '''
+
+        digest = hashlib.sha256('\n'.join(str(row.get('XML_LINK')) for row in rows).encode('utf-8')).hexdigest()
+        return os.path.join(folder, str.format('part-{0}.parquet', digest[:16]))
+
+    @staticmethod
+    def partition_value(value):
+
+        '''
+
+        Returns the text used for a value in a partition folder name i.e. TAXYEAR=2021 (the first value when it repeats)
+
+        '''
+
+        if isinstance(value, list):
+            value = value[0] if value else None
+        return str(value).replace('/', '_') if value not in (None, '') else 'unknown'
+
+    @staticmethod
+    def text(value):
+
+        '''
+
+        Returns the text stored in a column for a value (lists & dictionaries as json)
+
+        '''
+
+        if value is None or isinstance(value, str):
+            return value
+        if isinstance(value, (list, dict)):
+            return json.dumps(value, sort_keys=True, default=str)
+        return str(value)
+
+    def write(self, forms, result):
+
+        '''
+
+        Writes the forms of a batch & their schedules to a file per partition
+
+        '''
+
+        # Step 1. Group the main forms & schedules of the batch by partition
+        partitions = {}
+        form_partitions = []
+        for form in forms:
+            all_data = form.all_data
+            tax_year = str.format('TAXYEAR={0}', self.partition_value(all_data.get('TAXYEAR')))
+            keys = [(form.form_type, tax_year)]
+            partitions.setdefault(keys[0], []).append(all_data)
+            for schedule in form.schedules or []:
+                keys.append(('schedules', str.format('RETURNTYPE={0}', form.form_type), tax_year))
+                partitions.setdefault(keys[-1], []).append(dict(schedule, FILEREIN=all_data.get('FILEREIN'), XML_LINK=all_data.get('XML_LINK')))
+            form_partitions.append(keys)
+
+        # Step 2. Write each partition as a table with the text columns of its form type (or of the schedules)
+        failed = set()
+        for partition, rows in partitions.items():
+            folder = os.path.join(self.directory, *partition)
+            try:
+                os.makedirs(folder, exist_ok=True)
+                table = pa.table({column: pa.array([self.text(row.get(column)) for row in rows], pa.string()) for column in self.text_columns(partition[0])})
+                pq.write_table(table, self.part_path(folder, rows))
+            except Exception as g:
+                failed.add(partition)
+                log_error(g, str.format("Failed to write {0} rows to {1}", len(rows), folder), Log_Details)
+
+        # Step 3. A form counts as written when its partition & the partitions of its schedules were written
+        for keys in form_partitions:
+            if failed.intersection(keys):
+                result['errors'] += 1
+            else:
+                result['written'] += 1
+
+
+class ColumnarSink (ParquetSink):
+
+    '''
+
+    Writes forms as parquet files with the fixed typed columns of the variable catalog (helpers/parser/catalog.py) instead of the columns found in the batch
+    so every file of a table has the same columns, whichever filings are in it (a variable a filing doesn't have is null)
+        {directory}/forms/990/TAXYEAR=2021/part-{hash}.parquet                   main forms, one file per form type
+        {directory}/schedules/SA/TAXYEAR=2021/part-{hash}.parquet                schedules, one file per schedule type
+        {directory}/tables/OFFICERS_PC_PART_VII_A/TAXYEAR=2021/part-{hash}.parquet table rows (repeating groups), one row per row of the table
+        {directory}/repeated/990/TAXYEAR=2021/part-{hash}.parquet                every value of variables that repeat within a filing (the column holds the first one)
+    Every row starts with XML_LINK, FILEREIN & TAXYEAR so it can be joined back to its filing. Amounts & counts are int64, percentages & rates float64,
+    checkboxes bool & dates date. A value that doesn't fit the type of its column is written as null and counted as invalid.
+    TAXYEAR is only stored in the folder name (int64 in the folders, readers i.e. pyarrow.parquet.read_table('output/columnar/forms/990') add it back as a column).
+
+    '''
+
+    name = 'Columnar sink'
+
+    def __init__(self, directory, catalog, batch_size=1000, flush_seconds=mongo_bulk_flush_seconds, on_flush=None):
+        super(ColumnarSink, self).__init__(directory, catalog, batch_size, flush_seconds, on_flush)
+
+    @staticmethod
+    def first(value):
+
+        '''
+
+        Returns the first value of a variable that repeats, other values as they are
+
+        '''
+
+        if isinstance(value, list):
+            return value[0] if value else None
+        return value
+
+    def columns(self, kind, name):
+
+        '''
+
+        Returns the columns of a table i.e. ('forms', '990') -> {XML_LINK: string, ..., TOTREVCURYEA: int64}
+
+        '''
+
+        if kind == 'forms':
+            return self.catalog.forms.get(name)
+        if kind == 'schedules':
+            return self.catalog.schedules.get(name)
+        if kind == 'tables':
+            return self.catalog.tables.get(name)
+        return self.catalog.repeated
+
+    def split(self, record, kind, name, keys, tax_year, rows):
+
+        '''
+
+        Adds the row of a main form or schedule (record) to rows & the rows of its tables & repeating variables to their own tables
+        Returns the partitions the record was added to
+
+        '''
+
+        # Step 1. Keep the values of the columns of the table, tables become rows of their own table
+        columns = self.columns(kind, name) or {}
+        row = {}
+        partitions = [(kind, name, tax_year)]
+        for variable, value in record.items():
+            if variable in self.catalog.tables and isinstance(value, list):
+                partitions.append(('tables', variable, tax_year))
+                table = rows.setdefault(partitions[-1], [])
+                for position, table_row in enumerate(value):
+                    if isinstance(table_row, dict):
+                        table.append(dict(table_row, ROW=position, **keys))
+            elif variable in columns:
+                # Step 1a. A variable that repeats keeps its first value, every value is a row of the repeated table
+                if isinstance(value, list):
+                    partitions.append(('repeated', name, tax_year))
+                    rows.setdefault(partitions[-1], []).extend(dict(keys, VARIABLE=variable, POSITION=position, VALUE=item) for position, item in enumerate(value))
+                row[variable] = self.first(value)
+
+        # Step 2. Every row has the keys of its filing
+        row.update(keys)
+        rows.setdefault(partitions[0], []).append(row)
+        return partitions
+
+    def write(self, forms, result):
+
+        '''
+
+        Writes the forms of a batch, their schedules, tables & repeating variables to a file per table & tax year with the columns of the catalog
+
+        '''
+
+        # Step 1. Split every form into rows of the tables it is written to
+        rows = {}
+        form_partitions = []
+        for form in forms:
+            all_data = form.all_data
+            keys = {'XML_LINK': all_data.get('XML_LINK'), 'FILEREIN': self.first(all_data.get('FILEREIN')), 'TAXYEAR': number(self.text(self.first(all_data.get('TAXYEAR'))), 'int64')}
+            tax_year = str.format('TAXYEAR={0}', PARTITION_NULL if keys['TAXYEAR'] is None else keys['TAXYEAR'])
+            partitions = self.split(all_data, 'forms', form.form_type, keys, tax_year, rows)
+            for schedule in form.schedules or []:
+                partitions += self.split(dict(schedule, RETURNTYPE=form.form_type), 'schedules', schedule.get('type'), keys, tax_year, rows)
+            form_partitions.append(partitions)
+
+        # Step 2. Write each table as typed columns in the order of the catalog (TAXYEAR is the partition folder)
+        failed = set()
+        for partition, table_rows in rows.items():
+            folder = os.path.join(self.directory, *partition)
+            try:
+                os.makedirs(folder, exist_ok=True)
+                columns = {column: value_type for column, value_type in (self.columns(*partition[:2]) or {}).items() if column != 'TAXYEAR'}
+                arrays = []
+                for column, value_type in columns.items():
+                    array, invalid = coerce_column([self.text(self.first(row.get(column))) for row in table_rows], value_type)
+                    arrays.append(array)
+                    result['invalid'] += invalid
+                table = pa.Table.from_arrays(arrays, names=list(columns))
+                pq.write_table(table, self.part_path(folder, table_rows))
+            except Exception as g:
+                failed.add(partition)
+                log_error(g, str.format("Failed to write {0} rows to {1}", len(table_rows), folder), Log_Details)
+
+        # Step 3. A form counts as written when every table it has rows in was written
+        for partitions in form_partitions:
+            if failed.intersection(partitions):
+                result['errors'] += 1
+            else:
+                result['written'] += 1
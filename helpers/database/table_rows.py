@@ -0,0 +1,208 @@
+import os,sys                           # lets us use console and system
+import hashlib                          # each table is stored with the sha256 of its rows so unchanged tables aren't written again
+import bson                             # rows are hashed the way mongo stores them
+from pymongo import ReplaceOne, UpdateOne, DeleteMany # bulk write operations
+from settings.Settings import table_rows_collection_prefix
+from helpers.helpers import csv_to_object, csv_table_to_object
+from helpers.parser.mapping import CompiledMapping # cleans variable names the way the parser does
+from helpers.metrics import METRICS     # times every mongo operation per collection (when metrics are on)
+from helpers.loggingutil import Log_Details, log_error  # Import Custom Logging
+
+# Store name of current script in Log_Details class object as script name. We do this so that error log will always tell us which script error comes from.
+Log_Details.script = os.path.split(sys.argv[0])[1]
+
+TABLES_FIELD = 'TABLES'                        # Field of a main form that lists its tables stored as rows {table variable: {'type': 'SI', 'rows': 120, 'sha256': '...'}}
+ROW_FIELDS = ('_id', 'FORM_ID', 'ROW', 'type', 'FILEREIN', 'TAXYEAR') # Fields every row document has next to the values of the row
+
+# Overview: Tables (repeating groups see find_table_value in formparser.py) i.e. the grants of schedule I or the investments of a 990PF are lists of rows
+# embedded in their form or schedule, they are what makes documents grow past 16mb. With --normalize-tables each row is stored as its own document
+# in a collection per table (rows_GRANTS_SI_PART_II) under the _id ObjectId_row (the filing's ObjectId & the position of the row), the form keeps
+# which tables it had in TABLES. Rows are written with the batch of their form (1 unordered bulk_write per table) & every table collection is indexed
+# on its form, on (FILEREIN, TAXYEAR) & on the EINs its rows hold so i.e. every grant to an EIN is an index lookup. load_form puts the rows back.
+
+
+def table_collection_name(table):
+
+    '''
+
+    Returns the name of the collection that holds the rows of a table i.e. GRANTS_SI_PART_II -> rows_GRANTS_SI_PART_II
+
+    '''
+
+    return table_rows_collection_prefix + table
+
+
+def row_id(form_id, row):
+
+    '''
+
+    Returns the _id of a row of a table of a form i.e. ('201803129349301355', 3) -> '201803129349301355_3' (the table is the collection)
+
+    '''
+
+    return str.format('{0}_{1}', form_id, row)
+
+
+def is_table(value):
+
+    '''
+
+    Returns True when the value of a field is a table i.e. a list of rows (dictionaries) as opposed to a variable that repeats (list of values)
+
+    '''
+
+    return isinstance(value, list) and len(value) > 0 and all(isinstance(row, dict) for row in value)
+
+
+def table_index_fields(csv_object=None, csv_table_object=None):
+
+    '''
+
+    Returns {table variable: [variables of its rows that hold an EIN]} i.e. {'GRANTS_SI_PART_II': ['RTEINORECIPI'], ...}
+    A row variable holds an EIN when the tag of its path does i.e. Return/ReturnData/IRS990ScheduleI/RecipientTable/RecipientEIN
+
+    '''
+
+    if csv_object is None:
+        csv_object = csv_to_object()
+    if csv_table_object is None:
+        csv_table_object = csv_table_to_object()
+    fields = {}
+    for path, variable_table in csv_table_object.items():
+        if path in csv_object and 'EIN' in path[path.rfind('/') + 1:]:
+            table = CompiledMapping.clean_variable_name(variable_table)
+            name = CompiledMapping.clean_variable_name(csv_object[path])
+            if table and name and name not in fields.setdefault(table, []):
+                fields[table].append(name)
+    return fields
+
+
+def load_rows(database, form):
+
+    '''
+
+    Puts the rows of the tables of a form (listed in TABLES) back into the main form & its schedules (schedules have to be loaded already),
+    one query per table. Returns the form
+
+    '''
+
+    parts = {schedule.get('type'): schedule for schedule in form.get('schedules', []) if isinstance(schedule, dict)}
+    main_id = form.get('_id')
+    for table, details in (form.get(TABLES_FIELD) or {}).items():
+        with METRICS.timer('mongo_load_rows', table):
+            rows = [{field: value for field, value in row.items() if field not in ROW_FIELDS}
+                    for row in database[table_collection_name(table)].find({'FORM_ID': main_id}).sort('ROW', 1)]
+        document = form if details.get('type') == 'F9' else parts.get(details.get('type'))
+        if document is not None:
+            document[table] = rows
+    return form
+
+
+class TableRows (object):
+
+    '''
+
+    Moves the tables of forms & their schedules out into row documents (--normalize-tables) for BulkWriter & DiffUpdater. split builds the writes of
+    the rows of a form (tables whose sha256 matches what is stored aren't written again), group hands them over per table collection so each batch is
+    1 unordered bulk_write per table. Rows are replaced when replace is True otherwise rows already stored are left as they are (like schedules)
+
+        Example:
+            tables = TableRows(mongo_database, replace=True)
+            requests = tables.split(form, form_id(form.all_data), stored.get('TABLES'))
+            for table, requests_of_table in tables.group({form_id(form.all_data): requests}):
+                tables.collection(table).bulk_write(requests_of_table, ordered=False)
+
+    '''
+
+    def __init__(self, database, replace=False):
+        self.database = database               # mongo database the table collections are in
+        self.replace = replace                 # True replaces stored rows (-f & -u) instead of leaving them as they are
+        self.index_fields = table_index_fields() # {table: [row variables holding an EIN]} indexed next to FORM_ID & (FILEREIN, TAXYEAR)
+        self.indexed = set()                   # table collections whose indexes were created by this process
+
+    def split(self, form, main_id, stored_tables=None):
+
+        '''
+
+        Takes the tables out of the main form & schedules of a form, lists them in TABLES of the main form & returns {table: [writes of its rows]}.
+        stored_tables is TABLES of the stored form (when there is one) so unchanged tables are skipped, rows past the end of a table that shrank
+        are removed & so are the rows of tables that are gone
+
+        '''
+
+        all_data = form.all_data
+        stored_tables = stored_tables or {}
+        tables = {}
+        requests = {}
+
+        # Step 1. Take the tables out of the main form (type F9) & of every schedule (by type), one row document per row
+        for part, document in [('F9', all_data)] + [(schedule.get('type'), schedule) for schedule in form.schedules or []]:
+            for table in [field for field, value in document.items() if is_table(value)]:
+                rows = document.pop(table)
+                tables[table] = {'type': part, 'rows': len(rows), 'sha256': hashlib.sha256(bson.encode({'rows': rows})).hexdigest()}
+                stored = stored_tables.get(table) or {}
+                if stored.get('sha256') == tables[table]['sha256'] and stored.get('type') == part:
+                    continue
+                requests[table] = [self.row_request(dict(row, _id=row_id(main_id, position), FORM_ID=main_id, ROW=position, type=part,
+                                                         FILEREIN=all_data.get('FILEREIN'), TAXYEAR=all_data.get('TAXYEAR'))) for position, row in enumerate(rows)]
+                if stored.get('rows', 0) > len(rows):
+                    requests[table].append(DeleteMany({'FORM_ID': main_id, 'ROW': {'$gte': len(rows)}}))
+
+        # Step 2. Remove the rows of the tables the stored form had that are gone
+        for table in stored_tables:
+            if table not in tables:
+                requests[table] = [DeleteMany({'FORM_ID': main_id})]
+
+        # Step 3. The main form lists its tables so they can be put back (see load_rows)
+        if tables:
+            all_data[TABLES_FIELD] = tables
+        return requests
+
+    def row_request(self, row):
+
+        '''
+
+        Returns the upsert of a row document on its _id (replaces a stored row when replace is True, otherwise leaves it as it is)
+
+        '''
+
+        if self.replace:
+            return ReplaceOne({'_id': row['_id']}, row, upsert=True)
+        return UpdateOne({'_id': row['_id']}, {'$setOnInsert': {field: value for field, value in row.items() if field != '_id'}}, upsert=True)
+
+    def group(self, row_requests, skipped=()):
+
+        '''
+
+        Returns [(table, writes)] for the row writes of a batch {_id of a form: {table: writes}} leaving out the forms that weren't written (skipped)
+
+        '''
+
+        tables = {}
+        for main_id, requests_of_form in row_requests.items():
+            if main_id in skipped:
+                continue
+            for table, requests in requests_of_form.items():
+                tables.setdefault(table, []).extend(requests)
+        return list(tables.items())
+
+    def collection(self, table):
+
+        '''
+
+        Returns the collection of a table, the first time a process writes to it its indexes are created:
+        (FORM_ID, ROW) to load & remove the rows of a form, (FILEREIN, TAXYEAR) & each row variable that holds an EIN (sparse as not every row has one)
+
+        '''
+
+        collection = self.database[table_collection_name(table)]
+        if table not in self.indexed:
+            self.indexed.add(table)
+            try:
+                collection.create_index([('FORM_ID', 1), ('ROW', 1)])
+                collection.create_index([('FILEREIN', 1), ('TAXYEAR', 1)])
+                for field in self.index_fields.get(table, []):
+                    collection.create_index([(field, 1)], sparse=True)
+            except Exception as g:
+                log_error(g, str.format("Failed to create the indexes of table collection {0}", collection.name), Log_Details)
+        return collection
@@ -0,0 +1,241 @@
+import os,sys                           # lets us use console and system
+from gridfs import GridFS               # library that allows us to store files larger than 16mb into mongo
+from pymongo import UpdateOne, DeleteMany # bulk write operations
+from settings.Settings import mongo_bulk_flush_seconds
+from helpers.database.interface import mongo_database, schedules_collection, schedules_collection_b, form_id
+from helpers.database.large_documents import delete_document # removes schedules stored in GridFS that are replaced or gone
+from helpers.database.bulk_writer import BulkWriter # batches, bulk writes & GridFS fallback of the mongo sink
+from helpers.database.table_rows import TableRows # stores the rows of tables as their own documents (--normalize-tables)
+from helpers.metrics import METRICS     # times every mongo operation per collection (when metrics are on)
+from helpers.loggingutil import Log_Details, log_error  # Import Custom Logging
+
+# Store name of current script in Log_Details class object as script name. We do this so that error log will always tell us which script error comes from.
+Log_Details.script = os.path.split(sys.argv[0])[1]
+
+KEEP_FIELDS = ('_id', 'schedules') # Fields of a stored document that aren't part of the parsed data so they are never unset
+
+# Overview: Updates forms that are already in mongo with a fresh parse of their filing (-u) by only writing what changed:
+# the fields of the main form & of each schedule (matched by type) that changed are $set, fields that are gone are $unset,
+# schedules that are new are inserted & schedules that are gone are removed. Forms that aren't in mongo yet are inserted.
+
+
+def diff_fields(stored, fresh):
+
+    '''
+
+    Returns a tuple of ({field: value} to $set, {field: ''} to $unset) that turns a stored document into fresh (fields in KEEP_FIELDS are left alone)
+
+    '''
+
+    changed = {field: value for field, value in fresh.items() if field not in KEEP_FIELDS and (field not in stored or stored[field] != value)}
+    removed = {field: '' for field in stored if field not in KEEP_FIELDS and field not in fresh}
+    return changed, removed
+
+
+def diff_update(changed, removed):
+
+    '''
+
+    Returns the update document for a diff i.e. {'$set': {...}, '$unset': {...}} or None when nothing changed
+
+    '''
+
+    update = {}
+    if changed:
+        update['$set'] = changed
+    if removed:
+        update['$unset'] = removed
+    return update or None
+
+
+class DiffUpdater (BulkWriter):
+
+    '''
+
+    Buffers forms of a fresh parse and writes only what changed since they were stored (-u). Each batch takes 1 query per form collection for the
+    stored forms & 1 query for all of their schedules ($in), then 1 unordered bulk_write for the schedules & 1 per form collection.
+    Unlike update_data_mongo fields that are gone from the filing are unset & schedules that are gone are removed.
+    With tables=True tables are stored as a document per row (see table_rows.py), only the tables whose sha256 changed are written again.
+
+        Example:
+            updater = DiffUpdater(1000)
+            for form in forms:
+                updater.add(form)
+            updater.close()
+
+    '''
+
+    name = 'Diff updater'
+
+    def __init__(self, batch_size=1000, flush_seconds=mongo_bulk_flush_seconds, on_flush=None, coercion=None, tables=False):
+        super(DiffUpdater, self).__init__(batch_size, flush_seconds, False, on_flush, coercion)
+        self.tables = TableRows(mongo_database, replace=True) if tables else None # moves tables into row collections (--normalize-tables)
+
+    @staticmethod
+    def new_result():
+
+        '''
+
+        Returns an empty batch result i.e. how many forms were inserted, updated or unchanged & how many fields & schedules were written
+
+        '''
+
+        return {'forms': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0, 'fields_set': 0, 'fields_unset': 0,
+                'schedules_inserted': 0, 'schedules_updated': 0, 'schedules_removed': 0, 'rows': 0, 'gridfs': 0, 'errors': 0, 'invalid': 0}
+
+    def write(self, forms, result):
+
+        '''
+
+        Writes the changes of a batch of forms to mongo (see Sink.flush which buffers them & reports the result)
+
+        '''
+
+        # Step 1. Group forms by collection (990/990EZ/990PF) & key (FILEREIN, TAXYEAR), a key that shows up twice in a batch keeps the last form
+        batches = {}
+        for form in forms:
+            batches.setdefault(form.form_type, {})[self.form_key(form.all_data)] = form
+
+        # Step 2. One query per collection for the stored forms of the batch & one query for all of their schedules
+        stored = {form_type: self.find_existing(mongo_database[form_type], batch, None) for form_type, batch in batches.items()}
+        schedule_ids = [schedule_id for existing in stored.values() for document in existing.values() for schedule_id in document.get('schedules', [])]
+        stored_schedules = self.find_schedules(schedule_ids)
+
+        # Step 3. Build the write operations of every form
+        schedule_requests = []
+        row_requests = {}
+        form_requests = {}
+        for form_type, batch in batches.items():
+            requests = form_requests[form_type] = []
+            for key, form in batch.items():
+                document = stored[form_type].get(key)
+                if document is None:
+                    self.insert_form(form, form_type, requests, schedule_requests, result, row_requests)
+                else:
+                    self.update_form(form, form_type, document, stored_schedules, requests, schedule_requests, result, row_requests)
+
+        # Step 4. Write the rows of the tables that changed & the schedules first (the forms point to them) then the forms of each collection
+        if self.tables is not None:
+            for table, requests in self.tables.group(row_requests):
+                rows_result = self.bulk_write(self.tables.collection(table), requests, result)
+                result['rows'] += rows_result.get('nUpserted', 0) + rows_result.get('nModified', 0) + rows_result.get('nRemoved', 0)
+        schedules_result = self.bulk_write(schedules_collection, schedule_requests, result)
+        result['schedules_inserted'] += schedules_result.get('nUpserted', 0)
+        result['schedules_removed'] += schedules_result.get('nRemoved', 0)
+        for form_type, requests in form_requests.items():
+            self.bulk_write(mongo_database[form_type], requests, result)
+
+    @staticmethod
+    def find_schedules(schedule_ids):
+
+        '''
+
+        Returns {_id: schedule} for the stored schedules with these ids (one query)
+
+        '''
+
+        if not schedule_ids:
+            return {}
+        try:
+            with METRICS.timer('mongo_find_schedules', schedules_collection.name):
+                return {schedule['_id']: schedule for schedule in schedules_collection.find({'_id': {'$in': schedule_ids}})}
+        except Exception as g:
+            log_error(g, "Failed to load the stored schedules of the batch", Log_Details)
+            return {}
+
+    def insert_form(self, form, form_type, requests, schedule_requests, result, row_requests=None):
+
+        '''
+
+        Adds the writes of a form that isn't stored yet: the rows of its tables (with tables), its schedules & an upsert of the main form on its _id
+        (oversized main forms go to GridFS under the same _id)
+
+        '''
+
+        all_data = form.all_data
+        all_data['_id'] = form_id(all_data)
+        if self.tables is not None:
+            row_requests[all_data['_id']] = self.tables.split(form, all_data['_id'])
+        if form.schedules:
+            all_data['schedules'] = self.new_schedules(form.schedules, form_type, all_data, schedule_requests, result, replace=True)
+        if self.oversized(all_data):
+            self.put_gridfs(GridFS(mongo_database, (form_type + 'b')), all_data, all_data, form_type, 'main_form', result, all_data['_id'], True)
+            return
+        requests.append(UpdateOne({'_id': all_data['_id']}, {'$setOnInsert': {field: value for field, value in all_data.items() if field != '_id'}}, upsert=True))
+        result['inserted'] += 1
+
+    def update_form(self, form, form_type, document, stored_schedules, requests, schedule_requests, result, row_requests=None):
+
+        '''
+
+        Adds the writes that turn a stored form (document) & its stored schedules into the fresh parse (form):
+        schedules are matched by type, changed schedules get a $set/$unset of their changed fields, new ones are inserted & those that are gone removed
+
+        '''
+
+        # Step 0. With tables the rows of the tables of the fresh parse are taken out first (TABLES of the stored form tells which tables changed)
+        if self.tables is not None:
+            row_requests[form_id(form.all_data)] = self.tables.split(form, form_id(form.all_data), document.get('TABLES'))
+
+        # Step 1. Match the stored schedules with the fresh ones by type, schedules stored in GridFS can't be diffed so they are replaced
+        # (as are schedules that became too large, their stored document is removed)
+        by_type = {}
+        for schedule_id in document.get('schedules', []):
+            schedule = stored_schedules.get(schedule_id)
+            if schedule is not None and schedule.get('type') not in by_type:
+                by_type[schedule.get('type')] = schedule
+        schedules_ids = []
+        added = []
+        moved = []
+        for schedule in form.schedules or []:
+            old = by_type.pop(schedule.get('type'), None)
+            if old is None or self.oversized(schedule):
+                added.append(schedule)
+                if old is not None:
+                    moved.append(old['_id'])
+                continue
+            schedules_ids.append(old['_id'])
+            update = diff_update(*diff_fields(old, schedule))
+            if update is not None:
+                schedule_requests.append(UpdateOne({'_id': old['_id']}, update))
+                result['schedules_updated'] += 1
+        schedules_ids.extend(self.new_schedules(added, form_type, form.all_data, schedule_requests, result, replace=True))
+
+        # Step 2. Remove the stored schedules that are no longer in the filing
+        removed_ids = [schedule_id for schedule_id in document.get('schedules', []) if schedule_id in stored_schedules and (schedule_id not in schedules_ids or schedule_id in moved)]
+        if removed_ids:
+            schedule_requests.append(DeleteMany({'_id': {'$in': removed_ids}}))
+
+        # Step 2a. Schedules stored in GridFS (not in stored_schedules) were replaced by the fresh ones (or are gone) so their files are removed,
+        # unless the fresh schedule went to GridFS under the same id (which already replaced the file)
+        in_gridfs = {schedule['_id'] for schedule in added if self.oversized(schedule)}
+        for schedule_id in document.get('schedules', []):
+            if schedule_id is None or schedule_id in stored_schedules or schedule_id in in_gridfs:
+                continue
+            try:
+                with METRICS.timer('mongo_gridfs_delete', form_type):
+                    result['schedules_removed'] += delete_document(schedules_collection_b, schedule_id)
+            except Exception as g:
+                result['errors'] += 1
+                log_error(g, str.format("FAILED TO REMOVE SCHEDULE {0} FOR EIN: {1} from mongo gridfs.", schedule_id, form.all_data.get("FILEREIN")), Log_Details)
+
+        # Step 3. A main form that became too large for mongo moves to GridFS
+        if self.oversized(form.all_data):
+            form.all_data['schedules'] = schedules_ids
+            self.put_gridfs(GridFS(mongo_database, (form_type + 'b')), form.all_data, form.all_data, form_type, 'main_form', result, form_id(form.all_data), True)
+            requests.append(DeleteMany({'_id': document['_id']}))
+            result['updated'] += 1
+            return
+
+        # Step 4. Otherwise only the fields of the main form that changed are written (and the list of schedules when it changed)
+        changed, removed = diff_fields(document, form.all_data)
+        if schedules_ids != document.get('schedules', []):
+            changed['schedules'] = schedules_ids
+        update = diff_update(changed, removed)
+        if update is None:
+            result['unchanged'] += 1
+            return
+        requests.append(UpdateOne({'_id': document['_id']}, update))
+        result['updated'] += 1
+        result['fields_set'] += len(changed)
+        result['fields_unset'] += len(removed)
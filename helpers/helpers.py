@@ -4,6 +4,7 @@ import csv  # allows us to open/close/write to CSV Files
 import re  # python library for regular expressions
 from settings.Settings import mongo_qa_details, mongo_production_details, mapping_main_file, mapping_table_file
 from .loggingutil import Log_Details, log_access, log_error, log_progress # import logging
+from helpers.parser.mapping import CompiledMapping # compiled trie of the mapping files
 
 Log_Details.script = os.path.split(sys.argv[0])[1] # Store name of current script in Log_Details class object as script name. We do this so that error log will always tell us which script error comes from. 
 
@@ -80,6 +81,25 @@ def csv_table_to_object():
     return csv_object
 
 
+def csv_to_mapping(csv_object=None, csv_table_object=None):
+    '''
+
+    This method compiles the objects from csv_to_object and csv_table_to_object into a trie of xml tags (see helpers/parser/mapping.py)
+    Compile it once per run and pass it to every FormParser so no regex or string work is repeated per filing
+    Sample Output: CompiledMapping where mapping.root('Return').children['ReturnHeader'].children['ReturnTs'] is the node for Return/ReturnHeader/ReturnTs
+
+    '''
+
+    # Step 1. Read the mapping files if they were not passed
+    if csv_object is None:
+        csv_object = csv_to_object()
+    if csv_table_object is None:
+        csv_table_object = csv_table_to_object()
+
+    # Step 2. Return the compiled mapping
+    return CompiledMapping(csv_object, csv_table_object)
+
+
 def get_location_form_part(original_part_line, form_type):
     '''
         Get the location of mapping form part.
@@ -232,31 +252,28 @@ def get_config(database):
     return CONFIG.get(database).get(ENV, 'prod')
 
 
-def partition_list(general_list, limit):
+def partition_list(general_list, limit, field='URL'):
     '''
 
-    This method takes a general_list of dictionaries and a limit Outputs a list of list. In each list will be a link to aws xml filing
+    This method takes a general_list (or generator) of dictionaries and a limit and yields lists of up to limit links to aws xml filings
+    The lists are created one at a time so an index read with iter_filings_from_index_file is never held in memory.
+    When field is None the lists hold the whole dictionaries instead of their links (i.e. to look up their FileSha256).
         Example Input: [{u'OrganizationName': u'JAWONIO RESIDENTIAL OPPORTUNITIES III INC', u'ObjectId': u'201803129349301355', u'URL': u'https://s3.amazonaws.com/irs-form-990/201803129349301355_public.xml', u'SubmittedOn': u'2018-12-03', u'DLN': u'93493312013558', u'LastUpdated': u'2019-02-21T16:25:33', u'TaxPeriod': u'201712', u'FormType': u'990', u'EIN': u'201078564'}]
-        Example Output: [[u'https://s3.amazonaws.com/irs-form-990/201803129349301355_public.xml']]
+        Example Output: [u'https://s3.amazonaws.com/irs-form-990/201803129349301355_public.xml']
 
     '''
 
     # Step 0. Setup some initial place holders
-    result = []  # final output that will be returned
     to_change = []
-    limit_change = limit
-
-    # Step 1. For each dictionary in general list grab the url and add it to the to change list do this until none are left
-    for index, element in enumerate(general_list):
-        # To clarify index = position in list  element  =dictionary with content & element['URL'] = url of xml
-        to_change.append(element['URL'])
-        if index+1 == limit_change:
-            result.append(to_change)
-            limit_change += limit
+
+    # Step 1. For each dictionary in general list grab the url and add it to the to change list, yield the list each time it reaches the limit
+    for element in general_list:
+        # To clarify element = dictionary with content & element['URL'] = url of xml
+        to_change.append(element[field] if field is not None else element)
+        if len(to_change) == limit:
+            yield to_change
             to_change = []
-    # Step 2. Check to see if length of to_change is greater than 0 if it is append it to results
-    if len(to_change) > 0:
-        result.append(to_change)
 
-    # Step 3. Return list of lists (of links to xml files)
-    return result
+    # Step 2. Check to see if length of to_change is greater than 0 if it is yield it as well
+    if len(to_change) > 0:
+        yield to_change
@@ -1,5 +1,7 @@
 import os,sys # allows us to use operating system functions
 import json # allows us to parse and store json
+import re # allows us to count filings in an index without parsing it
+import numpy as np # allows us to store the columns of an index as a memory mapped array (sidecar) & filter them all at once
 #import urllib2 # allows us to handle urls - requests etc
 from urllib.request import urlopen
 from datetime import datetime, timedelta # allows us to figure out what date we are on and calculate a difference in dates
@@ -11,6 +13,13 @@ Log_Details.script = os.path.split(sys.argv[0])[1] # Store name of current scrip
 ROOT_DIR = os.path.join(os.path.dirname(__file__)) # Sets root to Helpers Directory
 INDEXES_DIR = os.path.join(ROOT_DIR, indices_directory_name) # adds "indices" to the helpers directory path
 
+INDEX_FIELDS = ('URL', 'FormType', 'EIN', 'TaxYear', 'ObjectId', 'FileSha256', 'LastUpdated', 'ZipFile') # The only fields of an index entry the parser uses
+INDEX_CHUNK_SIZE = 1024 * 1024 # Number of characters read from an index file at a time
+REGEXP_INDEX_URL = re.compile(rb'"URL"\s*:') # Every filing in an index has exactly one URL key
+SIDECAR_VERSION = 1 # Increase when the layout of the sidecar changes so old sidecars are rebuilt
+SIDECAR_CHUNK_SIZE = 65536 # Number of filings written to/read from a sidecar at a time
+SIDECAR_TYPES = {'TaxYear': 'i4', 'LastUpdated': 'datetime64[s]'} # Columns that are not stored as bytes (0 & NaT mean missing)
+
 # Overview: Variety of methods for downloading and processing index data from Giving Tuesday Datalake on AWS
 
 
@@ -61,6 +70,9 @@ def download_index(index_name):
             # Step 4d Set file to 0 to avoid memory issues. 
             response = None
 
+            # Step 4e. Build the sidecar (columns we filter & shard on) now so the first run doesn't have to
+            build_index_sidecar(index_name, new_file_path)
+
         except Exception as g:
             print(str.format( "Failed To Download Index: {0} Giving Tuesday AWS: {1} Error was: {2}", index_name, full_url, g ))
             log_error(g,str.format( "Failed To Download Index: {0} Giving Tuesday AWS: {1}", index_name, full_url),Log_Details)
@@ -79,16 +91,18 @@ def remove_index(index_name):
 
     '''
 
-    # Step 1. Create a path given base index directory & index_name -> indexes/2018.json
+    # Step 1. Create a path given base index directory & index_name -> indexes/2018.json (and the paths of its sidecar)
     path = os.path.join(INDEXES_DIR, str(index_name)+'.json')
 
     # Step 2. Check if the path exists. If patth exists means file exists
-    if os.path.exists(path):
+    for path in (path,) + index_sidecar_paths(index_name):
+        if not os.path.exists(path):
+            continue
         
         # Step 3. Remove the path -> i.e. remove the file. 
         try:
             os.remove(path)
-            log_progress('',str.format( "Successfully Removed Index: {0}", index_name),Log_Details)
+            log_progress('',str.format( "Successfully Removed Index: {0} ({1})", index_name, os.path.basename(path)),Log_Details)
         except Exception as g:
             log_error(g, str.format( "Failed To Remove Index: {0} from Mongo", index_name),Log_Details)
  
@@ -102,25 +116,13 @@ def fetch_filings_from_index_file(index_name):
 
     '''
 
-    # Step 1a. Grab Index Location Flag From Commandline
-
-    ENV = 'gt'
-    if '--gtdatalake' in sys.argv[1:]:
-        ENV = 'gt'
-    elif '--local' in sys.argv[1:]:
-        ENV = 'local'
-    
-    if ENV !='local': # If we have --gtdatalake passed via commandline then download index from giving tuesday datalake
-        # Step 1b: Download Index by calling the download_index method and pass index_name name with appropriate naming conventions "all_years + date or latest_only + date" 
-        download_index(index_name)
-
-    # Step 2. Create a file path for index_name we are processing. 
-    file_path = str.format('{0}.json', index_name)
+    # Step 1-2. Download the index if needed & create a file path for index_name we are processing.
+    file_path = index_file_path(index_name)
 
     try:
 
         # Step 3. open index file
-        with open(os.path.join(INDEXES_DIR, file_path)) as file:
+        with open(file_path) as file:
 
             #Step 3a. Load the file as json object
             index_obj = json.load(file)
@@ -145,6 +147,302 @@ def fetch_filings_from_index_file(index_name):
         log_error(g,str.format( "Failed To Fetch Filings From Index named: {0}", index_name),Log_Details)
         return None
 
+def index_file_path(index_name):
+
+    '''
+
+    Downloads the index (unless --local was passed) and returns the path of the index file i.e. helpers/indices/latest_only_2018-12-31.json
+
+    '''
+
+    # Step 1a. Grab Index Location Flag From Commandline
+    ENV = 'gt'
+    if '--gtdatalake' in sys.argv[1:]:
+        ENV = 'gt'
+    elif '--local' in sys.argv[1:]:
+        ENV = 'local'
+
+    if ENV !='local': # If we have --gtdatalake passed via commandline then download index from giving tuesday datalake
+        # Step 1b: Download Index by calling the download_index method and pass index_name name with appropriate naming conventions "all_years + date or latest_only + date" 
+        download_index(index_name)
+
+    # Step 2. Return the file path for index_name we are processing.
+    return os.path.join(INDEXES_DIR, str.format('{0}.json', index_name))
+
+
+def iter_filings_from_index_file(index_name, start=0, stop=None, file_path=None):
+
+    '''
+
+    Generator version of fetch_filings_from_index_file. The index file is read piece by piece and each filing is yielded as soon as it is read
+    as a dictionary with only the fields in INDEX_FIELDS (missing fields are None) so the whole index is never held in memory.
+    Only the filings from position start (0 = first filing) up to but not including position stop (None = end of index) are yielded.
+    file_path is the path of an index file already downloaded, when None the index is downloaded if needed (see index_file_path).
+
+        Example Output: {'URL': 'https://gt990datalake-rawdata.s3.amazonaws.com/EfileData/XmlFiles/202312919349100301_public.xml', 'FormType': '990PF', 'EIN': '873700196', 'TaxYear': '2022', 'ObjectId': '202312919349100301', 'FileSha256': 'fd45...', 'LastUpdated': None}
+
+    '''
+
+    # Step 0. Setup a json decoder that can read one filing at a time & our position in the index
+    decoder = json.JSONDecoder()
+    position = 0
+    index = 0
+
+    try:
+
+        # Step 1. open index file
+        with open(file_path or index_file_path(index_name), encoding='utf-8') as file:
+            buffer = file.read(INDEX_CHUNK_SIZE)
+
+            while stop is None or index < stop:
+
+                # Step 2. Skip everything between filings i.e. the opening [ of the list, commas & white space, reading more of the file when we run out
+                while True:
+                    while position < len(buffer) and buffer[position] in ' \t\r\n,[':
+                        position += 1
+                    if position < len(buffer):
+                        break
+                    buffer = file.read(INDEX_CHUNK_SIZE)
+                    position = 0
+                    if not buffer:
+                        return
+
+                # Step 3. The closing ] of the list means we are done
+                if buffer[position] == ']':
+                    return
+
+                # Step 4. Read the next filing, if it is cut off by the end of what we read so far read more of the file and try again
+                try:
+                    filing, position = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    more = file.read(INDEX_CHUNK_SIZE)
+                    if not more:
+                        raise
+                    buffer = buffer[position:] + more
+                    position = 0
+                    continue
+
+                # Step 5. Yield the fields we use of the filings from start onwards
+                if index >= start:
+                    yield {field: filing.get(field) for field in INDEX_FIELDS}
+                index += 1
+
+    except Exception as g:
+        log_error(g,str.format( "Failed To Fetch Filings From Index named: {0}", index_name),Log_Details)
+
+
+def count_filings_in_index_file(index_name):
+
+    '''
+
+    Returns the number of filings in an index file without parsing it (counts the URL keys) or None if the index can't be read
+
+    '''
+
+    count = 0
+    tail = b''
+    try:
+        with open(index_file_path(index_name), 'rb') as file:
+            for chunk in iter(lambda: file.read(INDEX_CHUNK_SIZE), b''):
+                # keys that start in the last bytes of a chunk might be cut off so they are counted with the next chunk
+                data = tail + chunk
+                limit = max(len(data) - 64, 0)
+                count += sum(1 for match in REGEXP_INDEX_URL.finditer(data) if match.start() < limit)
+                tail = data[limit:]
+            return count + len(REGEXP_INDEX_URL.findall(tail))
+    except Exception as g:
+        log_error(g,str.format( "Failed To Count Filings In Index named: {0}", index_name),Log_Details)
+        return None
+
+
+def index_sidecar_paths(index_name):
+
+    '''
+
+    Returns the paths of the sidecar of an index i.e. (helpers/indices/latest_only_2018-12-31.npy, helpers/indices/latest_only_2018-12-31.npy.meta)
+    The .npy file holds the INDEX_FIELDS of every filing as a numpy structured array, the .meta file the size & modification time of the json it was built from
+
+    '''
+
+    path = os.path.join(INDEXES_DIR, str.format('{0}.npy', index_name))
+    return path, path + '.meta'
+
+
+def index_sidecar_meta(file_path):
+
+    '''
+
+    Returns what a sidecar has to match to be up to date with the index file at file_path i.e. {'version': 1, 'fields': [...], 'size': 1024, 'mtime': 1700000000000000000}
+
+    '''
+
+    stat = os.stat(file_path)
+    return {'version': SIDECAR_VERSION, 'fields': list(INDEX_FIELDS), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+
+def build_index_sidecar(index_name, file_path=None):
+
+    '''
+
+    Builds the sidecar of an index i.e. a numpy structured array with one row per filing & one column per field in INDEX_FIELDS saved next to the json.
+    Text fields are stored as fixed width bytes (as wide as their longest value), TaxYear as an integer & LastUpdated as a date so they can be compared.
+    The index is read twice one filing at a time (once to size the columns, once to fill them) so it is never held in memory.
+    Returns the sidecar memory mapped (see load_index_sidecar) or None if it could not be built.
+
+    '''
+
+    file_path = file_path or os.path.join(INDEXES_DIR, str.format('{0}.json', index_name))
+    sidecar_path, meta_path = index_sidecar_paths(index_name)
+
+    try:
+
+        # Step 1. Remember the size & modification time of the json before reading it so a change while we build makes the sidecar stale
+        # & remove what the old sidecar was built from so it isn't used if we fail half way
+        meta = index_sidecar_meta(file_path)
+        if os.path.isfile(meta_path):
+            os.remove(meta_path)
+
+        # Step 2. First pass: count the filings & find the longest value of each text field
+        count = 0
+        widths = {field: 1 for field in INDEX_FIELDS if field not in SIDECAR_TYPES}
+        for filing in iter_filings_from_index_file(index_name, file_path=file_path):
+            count += 1
+            for field in widths:
+                if filing[field] is not None:
+                    widths[field] = max(widths[field], len(str(filing[field]).encode('utf-8')))
+        dtype = np.dtype([(field, SIDECAR_TYPES.get(field) or str.format('S{0}', widths[field])) for field in INDEX_FIELDS])
+
+        # Step 3. Second pass: write the filings straight to a memory mapped file a chunk at a time (to a temporary file so nobody reads it half written)
+        sidecar = np.lib.format.open_memmap(sidecar_path + '.tmp', mode='w+', dtype=dtype, shape=(count,))
+        rows = []
+        position = 0
+        for filing in iter_filings_from_index_file(index_name, 0, count, file_path):
+            rows.append(tuple(index_sidecar_value(field, filing[field]) for field in INDEX_FIELDS))
+            if len(rows) == SIDECAR_CHUNK_SIZE:
+                sidecar[position:position + len(rows)] = rows
+                position += len(rows)
+                rows = []
+        if rows:
+            sidecar[position:position + len(rows)] = rows
+        sidecar.flush()
+        del sidecar
+
+        # Step 4. Put the sidecar in place then write what it was built from (a sidecar without a .meta file is never used)
+        os.replace(sidecar_path + '.tmp', sidecar_path)
+        with open(meta_path, 'w') as file:
+            json.dump(meta, file)
+        log_progress('', str.format('Built sidecar for index {0} with {1} filings', index_name, count), Log_Details)
+        return np.load(sidecar_path, mmap_mode='r')
+
+    except Exception as g:
+        log_error(g, str.format('Failed To Build Sidecar For Index named: {0}', index_name), Log_Details)
+        return None
+
+
+def index_sidecar_value(field, value):
+
+    '''
+
+    Converts the value of a field of an index entry to what is stored in the sidecar (missing or unreadable values are stored as b'', 0 or NaT)
+
+    '''
+
+    if field == 'TaxYear':
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return 0
+    if field == 'LastUpdated':
+        try:
+            return np.datetime64(value[0:19], 's')
+        except (TypeError, ValueError):
+            return np.datetime64('NaT')
+    return b'' if value is None else str(value).encode('utf-8')
+
+
+def load_index_sidecar(index_name):
+
+    '''
+
+    Downloads the index if needed (see index_file_path) and returns its sidecar memory mapped i.e. only the rows we look at are read from disk.
+    The sidecar is (re)built when it is missing or when the size or modification time of the json has changed since it was built.
+    Returns None when the sidecar can't be built or read, callers should then fall back to iter_filings_from_index_file.
+
+        Example:
+            sidecar = load_index_sidecar('latest_only_2018-12-31')
+            sidecar = filter_index_sidecar(sidecar, form_types=['990PF'], tax_years=[2021])
+            for filing in iter_filings_from_index_sidecar(sidecar): ...
+
+    '''
+
+    file_path = index_file_path(index_name)
+    sidecar_path, meta_path = index_sidecar_paths(index_name)
+
+    try:
+
+        # Step 1. Use the sidecar when it was built from the json as it is now
+        if os.path.isfile(sidecar_path) and os.path.isfile(meta_path):
+            with open(meta_path) as file:
+                if json.load(file) == index_sidecar_meta(file_path):
+                    return np.load(sidecar_path, mmap_mode='r')
+            log_progress('', str.format('Index {0} changed since its sidecar was built, rebuilding it', index_name), Log_Details)
+
+    except Exception as g:
+        log_error(g, str.format('Failed To Read Sidecar For Index named: {0}, rebuilding it', index_name), Log_Details)
+
+    # Step 2. Otherwise build it (again)
+    return build_index_sidecar(index_name, file_path)
+
+
+def filter_index_sidecar(sidecar, form_types=None, tax_years=None, updated_since=None):
+
+    '''
+
+    Returns the rows of a sidecar that match every filter passed (filters that are None are ignored), each filter compares a whole column at once.
+    form_types is a list like ['990', '990EZ'], tax_years a list like [2020, 2021] & updated_since a datetime (only filings with a later LastUpdated date are kept)
+
+    '''
+
+    mask = np.ones(len(sidecar), dtype=bool)
+    if form_types is not None:
+        mask &= np.isin(sidecar['FormType'], [str(form_type).encode('utf-8') for form_type in form_types])
+    if tax_years is not None:
+        mask &= np.isin(sidecar['TaxYear'], [int(tax_year) for tax_year in tax_years])
+    if updated_since is not None:
+        # like fetch_filings_updated only the date of LastUpdated is compared (NaT is never later)
+        mask &= sidecar['LastUpdated'].astype('datetime64[D]') > np.datetime64(updated_since)
+    return sidecar if mask.all() else sidecar[mask]
+
+
+def iter_filings_from_index_sidecar(sidecar, start=0, stop=None):
+
+    '''
+
+    Generator that yields the rows of a sidecar from position start up to but not including position stop (None = end) as the same
+    dictionaries iter_filings_from_index_file yields i.e. {'URL': 'https://...', 'FormType': '990PF', 'TaxYear': '2022', 'LastUpdated': None ...}
+
+    '''
+
+    stop = len(sidecar) if stop is None else min(stop, len(sidecar))
+    for position in range(start, stop, SIDECAR_CHUNK_SIZE):
+
+        # Step 1. Read a chunk of rows one column at a time as python values
+        chunk = sidecar[position:min(position + SIDECAR_CHUNK_SIZE, stop)]
+        columns = [chunk[field].tolist() for field in INDEX_FIELDS]
+
+        # Step 2. Turn the stored values back into the strings found in the index (missing values are None)
+        for row in zip(*columns):
+            filing = {}
+            for field, value in zip(INDEX_FIELDS, row):
+                if field == 'TaxYear':
+                    filing[field] = str(value) if value else None
+                elif field == 'LastUpdated':
+                    filing[field] = value.isoformat() if value is not None else None
+                else:
+                    filing[field] = value.decode('utf-8') if value else None
+            yield filing
+
+
 def fetch_filings_updated(index_name):
     '''
 
@@ -161,12 +459,17 @@ def fetch_filings_updated(index_name):
     # Step 2. Redownloads the index
     download_index(index_name)
 
-    # Step 3. Downloads latest index and create a list of dictionaries of all filings for that index
-    filings = fetch_filings_from_index_file(index_name)
-
-    # Step 4.  Stores Yesterday's Date as difference between today and 1 day That is to say 1 day ago. 
+    # Step 3.  Stores Yesterday's Date as difference between today and 1 day That is to say 1 day ago. 
     # Example if today is 2019-10-16 15:53:25.393400 yesterday will be 2019-10-15 15:53:25.393400
     yesterday = datetime.now() - timedelta(days=1)
+
+    # Step 4. Filter the LastUpdated column of the sidecar all at once
+    sidecar = load_index_sidecar(index_name)
+    if sidecar is not None:
+        return iter_filings_from_index_sidecar(filter_index_sidecar(sidecar, updated_since=yesterday))
+
+    # Step 4a. Without a sidecar read the latest index one filing at a time (dictionaries with the fields we use)
+    filings = iter_filings_from_index_file(index_name)
  
     # Step 5.  Each object in list of dictionaries contains a last field u'LastUpdated': u'2018-03-14T23:04:38'
     #          We only want to select those where the lastupdate is greater than yesterday i.e this means its a new filing
@@ -174,7 +477,7 @@ def fetch_filings_updated(index_name):
     #          Then we will return the filtered list
 
     return filter(
-        (lambda x: datetime.strptime(
+        (lambda x: x['LastUpdated'] and datetime.strptime(
             x['LastUpdated'][0:10],
             '%Y-%m-%d') > yesterday), filings
     )
\ No newline at end of file
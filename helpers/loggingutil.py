@@ -1,18 +1,33 @@
 import logging # Import Pythons Logging Library
+import logging.handlers # QueueHandler hands records over to the log writer instead of writing them
+import os # lets us write whole batches of lines to the log files
+import json # every log line is a json record
+import time # allows us to rate limit progress summaries
+import queue # records wait here until the log writer thread writes them
+import threading # the log writer runs next to the parser
+import atexit # writes what is left in the queue when the script ends
+import multiprocessing.util # ... or when a child process (Process, Pool worker) ends
+from datetime import datetime # time stamp of every record
+from settings.Settings import progress_every_filings, progress_every_seconds
 
 
 ########### Logging Details
 # We have 3 Logs
     # Access Log = Basically keeps track of time parser was activated and finished.
-    # Error Log = Keeps track of any issues arising during the running of the parser. 
-    # Progress Log = Keeps track of the script as it runs. But only exists for each independent session. I.e. its overwritten 
+    # Error Log = Keeps track of any issues arising during the running of the parser.
+    # Progress Log = Keeps track of the script as it runs. But only exists for each independent session. I.e. its overwritten
+# Every line of a log is a json record i.e. {"time": "2024-01-05T03:00:00.123", "level": "INFO", "log": "progress", "script": "XML_Parser.py", "pid": 123, "message": "..."}
+# Logging never writes to disk on the thread that logs: records go on a queue (QueueHandler) and a log writer thread (one per process) writes them
+# in batches (every log_flush_seconds at most), one write per log file per batch, so processes appending to the same logs don't interleave lines and logging stays out of the hot loop.
 
 # Log Locations - i.e. where things get saved to
-access_log_location = './logs/access.log' 
-error_log_location = './logs/error.log' 
-progress_log_location = './logs/progress.log' 
+access_log_location = './logs/access.log'
+error_log_location = './logs/error.log'
+progress_log_location = './logs/progress.log'
 
-## Create Simple Logging Classes that will create & store script as a variable. 
+log_flush_seconds = 0.5 # Seconds the log writer waits after a record for more records to write with it (it doesn't wait when it is stopping)
+
+## Create Simple Logging Classes that will create & store script as a variable.
 
 class Log_Details:
     def __init__(
@@ -26,61 +41,220 @@ class Log_Details:
             "script": self.script,
         }
 
+##### Log Writer
+
+class LogWriter (object):
+
+    '''
+
+    Queue of records of this process & the thread that writes them to their log file (by logger name) in batches.
+    The thread is started by the first record a process logs (a forked child starts its own) and writes what is left when the process ends
+
+    '''
+
+    def __init__(self, locations):
+        self.locations = locations # logger name -> log file
+        self.pid = None            # process the queue & thread belong to
+        self.queue = None
+        self.thread = None
+        self.stopping = None       # set by stop so the writer doesn't wait for more records
+
+    def put_nowait(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        self.queue.put_nowait(record)
+
+    def start(self):
+        self.pid = os.getpid()
+        self.queue = queue.SimpleQueue()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(self.queue,), name='log-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+        multiprocessing.util.Finalize(self, self.stop, exitpriority=0)
+
+    def run(self, records):
+
+        '''
+
+        Waits for records & writes every record already queued with them as one batch
+
+        '''
+
+        descriptors = {}
+        while True:
+            # Step 1. Wait for a record, give the process a moment to log more & take everything that is queued
+            batch = [records.get()]
+            if batch[0] is not None:
+                self.stopping.wait(log_flush_seconds)
+            while True:
+                try:
+                    batch.append(records.get_nowait())
+                except queue.Empty:
+                    break
+
+            # Step 2. One write per log file, files are opened in append mode so whole lines from other processes never mix
+            lines = {}
+            for record in batch:
+                if record is not None:
+                    lines.setdefault(self.locations.get(record.name, progress_log_location), []).append(format_record(record))
+            for location, text in lines.items():
+                try:
+                    if location not in descriptors:
+                        descriptors[location] = os.open(location, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                    data = ''.join(text).encode('utf-8')
+                    while data:
+                        data = data[os.write(descriptors[location], data):]
+                except OSError:
+                    pass
+
+            # Step 3. Stop once stop was called (None is queued)
+            if None in batch:
+                for descriptor in descriptors.values():
+                    os.close(descriptor)
+                return
+
+    def stop(self):
+
+        '''
+
+        Writes the records still queued & stops the thread
+
+        '''
+
+        if self.pid != os.getpid() or not self.thread.is_alive():
+            return
+        self.stopping.set()
+        self.queue.put_nowait(None)
+        self.thread.join()
+
+
+class QueueHandler (logging.handlers.QueueHandler):
+
+    '''
+
+    Queues records for the log writer. The message & the traceback of an exception are kept apart so both end up as fields of the json record
+
+    '''
+
+    def prepare(self, record):
+        if record.exc_info and record.exc_info[0] is not None and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.message = record.getMessage()
+        record.msg, record.args, record.exc_info = record.message, None, None
+        return record
+
+
+def format_record(record):
+
+    '''
+
+    Returns a record as a json line
+
+    '''
+
+    entry = {
+        'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+        'level': record.levelname,
+        'log': record.name,
+        'script': getattr(record, 'script', None),
+        'pid': record.process,
+        'message': record.message,
+    }
+    for field in ('details', 'summary'):
+        if getattr(record, field, None):
+            entry[field] = getattr(record, field)
+    if record.exc_text:
+        entry['exception'] = record.exc_text
+    return json.dumps(entry, default=str) + '\n'
+
+
+# Records only need the time, the process & the message: skip looking up the caller, the thread & the process name of every record (see Optimization in the logging docs)
+logging._srcfile = None
+logging.logThreads = False
+logging.logMultiprocessing = False
+
+LOG_WRITER = LogWriter({'access': access_log_location, 'error': error_log_location, 'progress': progress_log_location})
+
 ##### Access Logger
 
-## Create Access Logger
+## Create Access Logger -> records are queued for the log writer which adds them to /logs/access.log
 logger_access  = logging.getLogger("access")
 logger_access.setLevel(logging.INFO)
-
-## Setup Access  Log Handler -> In this case a file handler to dump error log to /logs/access.log
-access_file_handler =  logging.FileHandler(access_log_location, mode='a')
-
-## Setup Access  Log Formatter -> To ensure error logs have appropriate time stamps
-access_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-access_file_handler.setFormatter(access_formatter)
-logger_access.addHandler(access_file_handler)
+logger_access.addHandler(QueueHandler(LOG_WRITER))
+logger_access.propagate = False
 
 ## Create custom access log function that we can import anywhere in the code base
 def log_access(e: Exception, message: str, detail: Log_Details):
-    log = f"Script: {detail.script} - Message: {message}"
-    logger_access.info(log)
+    logger_access.info(message, extra={'script': detail.script})
 
 ##### Error Logger
 
-## Create Error Logger
+## Create Error Logger -> records are queued for the log writer which adds them to /logs/error.log
 logger_error  = logging.getLogger("error")
 logger_error.setLevel(logging.ERROR)
-
-## Setup Error Log Handler -> In this case a file handler to dump error log to /logs/error.log
-error_file_handler =  logging.FileHandler(error_log_location, mode='a')
-
-## Setup Error Log Formatter -> To ensure error logs have appropriate time stamps
-error_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-error_file_handler.setFormatter(error_formatter)
-logger_error.addHandler(error_file_handler)
+logger_error.addHandler(QueueHandler(LOG_WRITER))
+logger_error.propagate = False
 
 ## Create custom error log function that we can import anywhere in the code base
 def log_error(e: Exception, message: str, detail: Log_Details):
-	log = f"Script: {detail.script} - Message: {message} - Details: {e}"
-	logger_error.exception(log)
+	logger_error.exception(message, extra={'script': detail.script, 'details': str(e) if e != '' else None})
 
 ##### Progress Logger
 
-## Create Progress Logger
+## Create Progress Logger -> records are queued for the log writer which adds them to /logs/progress.log
 logger_progress  = logging.getLogger("progress")
 logger_progress.setLevel(logging.INFO)
-
-## Setup Progress  Log Handler -> In this case a file handler to dump error log to /logs/progress.log
-progress_file_handler =  logging.FileHandler(progress_log_location, mode='a')
-
-## Setup Progress  Log Formatter -> To ensure error logs have appropriate time stamps
-progress_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-progress_file_handler.setFormatter(progress_formatter)
-logger_progress.addHandler(progress_file_handler)
+logger_progress.addHandler(QueueHandler(LOG_WRITER))
+logger_progress.propagate = False
 
 ## Create custom progress log function that we can import anywhere in the code base
 def log_progress(e: Exception, message: str, detail: Log_Details):
-    log = f"Script: {detail.script} - Message: {message}"
-    logger_progress.info(log)
+    logger_progress.info(message, extra={'script': detail.script})
+
+##### Progress Summaries
+
+class ProgressSummary (object):
+
+    '''
+
+    Rate limited progress: counts filings as they are processed & prints/logs one summary every `every` filings or `seconds` seconds
+    (whichever comes first) instead of a line per filing i.e. Completed 12000 / 250000 filings (48.0 filings/s, 2 failed)
+
+        Example:
+            progress = ProgressSummary(total_filings, Log_Details, start=continue_progress)
+            for form in forms:
+                progress.tick(failed=form is None)
+            progress.finish()
+
+    '''
+
+    def __init__(self, total, detail, start=0, every=progress_every_filings, seconds=progress_every_seconds):
+        self.total = total       # number of filings we will have processed once we reach the end
+        self.detail = detail
+        self.completed = start   # filings processed so far (counting from the start of the index)
+        self.failed = 0
+        self.every = every
+        self.seconds = seconds
+        self.started = self.last = time.monotonic()
+        self.since = 0           # filings processed since the last summary
+
+    def tick(self, count=1, failed=False):
+        self.completed += count
+        self.failed += count if failed else 0
+        self.since += count
+        if self.since >= self.every or time.monotonic() - self.last >= self.seconds:
+            self.summary()
 
+    def summary(self):
+        now = time.monotonic()
+        rate = self.since / max(now - self.last, 1e-9)
+        message = str.format("Completed {0} / {1} filings ({2:.1f} filings/s, {3} failed)", self.completed, self.total, rate, self.failed)
+        print (message)
+        logger_progress.info(message, extra={'script': self.detail.script, 'summary': {'completed': self.completed, 'total': self.total, 'failed': self.failed, 'rate': round(rate, 2)}})
+        self.last = now
+        self.since = 0
 
+    def finish(self):
+        if self.since:
+            self.summary()
@@ -0,0 +1,367 @@
+import os,sys                           # lets us use console and system
+import json                             # file format of the stats file
+import time                             # allows us to time the stages of the parser
+import threading                        # serves the metrics & writes the stats file in the background
+from bisect import bisect_left          # finds the bucket of a timing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer # local metrics endpoint
+from settings.Settings import metrics_interval_seconds
+from helpers.loggingutil import Log_Details, log_error, log_progress  # Import Custom Logging
+
+# Store name of current script in Log_Details class object as script name. We do this so that error log will always tell us which script error comes from.
+Log_Details.script = os.path.split(sys.argv[0])[1]
+
+BUCKETS = tuple(0.0001 * 2 ** power for power in range(21)) # Upper bounds in seconds of the buckets of every histogram 0.1ms, 0.2ms ... ~105s (anything slower goes in +Inf)
+QUANTILES = (0.5, 0.95, 0.99)                                # Quantiles reported for every histogram i.e. p50, p95 & p99
+PREFIX = 'form990_parser'                                    # Prefix of every metric served at /metrics
+
+# Overview: Timings of each stage of the parser (download, xml parse, path extraction, tables, schedules, main form & every mongo operation) are kept
+# as histograms per stage & form type along with counters (filings parsed, failed, bytes). Metrics are off unless --metrics-port or --metrics-file is passed,
+# when they are off every timer is the same object that does nothing so the parser pays for a single check per stage.
+# They are served in the prometheus text format at http://localhost:PORT/metrics (--metrics-port) and/or written every metrics_interval_seconds to a json file (--metrics-file).
+# Worker processes (--workers) send what they measured back with the filings they parse (see drain & merge).
+
+
+class Histogram (object):
+
+    '''
+
+    Number of timings that fell in each bucket of BUCKETS (the last one is +Inf) plus their count & sum, quantiles are estimated out of the buckets
+
+    '''
+
+    __slots__ = ('buckets', 'count', 'sum')
+
+    def __init__(self, buckets=None, count=0, total=0.0):
+        self.buckets = buckets or [0] * (len(BUCKETS) + 1)
+        self.count = count
+        self.sum = total
+
+    def observe(self, seconds):
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def merge(self, buckets, count, total):
+        self.buckets = [mine + theirs for mine, theirs in zip(self.buckets, buckets)]
+        self.count += count
+        self.sum += total
+
+    def quantile(self, q):
+
+        '''
+
+        Returns the estimated timing below which q (0.95 -> 95%) of the timings fall, interpolated within its bucket like prometheus' histogram_quantile
+
+        '''
+
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for position, count in enumerate(self.buckets):
+            if count and seen + count >= rank:
+                if position == len(BUCKETS):
+                    return BUCKETS[-1]
+                lower = BUCKETS[position - 1] if position else 0.0
+                return lower + (BUCKETS[position] - lower) * (rank - seen) / count
+            seen += count
+        return BUCKETS[-1]
+
+
+class NullTimer (object):
+
+    '''
+
+    Timer & laps used while metrics are off, does nothing
+
+    '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+    def lap(self, stage):
+        pass
+
+    def done(self, label=''):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timer (object):
+
+    '''
+
+    Context manager that observes how long its block took i.e. with METRICS.timer('download'): ...
+
+    '''
+
+    __slots__ = ('metrics', 'stage', 'label', 'start')
+
+    def __init__(self, metrics, stage, label):
+        self.metrics = metrics
+        self.stage = stage
+        self.label = label
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start, self.label)
+        return False
+
+
+class Laps (object):
+
+    '''
+
+    Times steps that run one after the other (i.e. the steps of FormParser.parse), each lap ends a step. The laps are observed by done
+    once the label (form type) is known, at the end of the filing
+
+    '''
+
+    __slots__ = ('metrics', 'laps', 'last')
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.laps = []
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.laps.append((stage, now - self.last))
+        self.last = now
+
+    def done(self, label=''):
+        for stage, seconds in self.laps:
+            self.metrics.observe(stage, seconds, label)
+
+
+class Metrics (object):
+
+    '''
+
+    Histograms of the time spent in each stage {(stage, form type): Histogram} & counters {(name, form type): number} of a process.
+    Off until enable is called, then served at a local endpoint (serve) and/or written to a stats file (write_every).
+
+        Example:
+            METRICS.enable()
+            with METRICS.timer('mongo_bulk_write', '990'):
+                collection.bulk_write(requests)
+            METRICS.count('filings', '990')
+            METRICS.serve(9100)
+
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()   # the endpoint reads the metrics from another thread
+        self.histograms = {}
+        self.counters = {}
+        self.started = time.time()
+        self.server = None
+        self.stats_file = None
+        self.stop = threading.Event()
+
+    def enable(self):
+        self.enabled = True
+
+    def timer(self, stage, label=''):
+
+        '''
+
+        Returns a context manager that times its block as stage (with label i.e. the form type), does nothing when metrics are off
+
+        '''
+
+        return Timer(self, stage, label) if self.enabled else NULL_TIMER
+
+    def laps(self):
+
+        '''
+
+        Returns a Laps that times steps one after the other (see Laps), does nothing when metrics are off
+
+        '''
+
+        return Laps(self) if self.enabled else NULL_TIMER
+
+    def observe(self, stage, seconds, label=''):
+        with self.lock:
+            histogram = self.histograms.get((stage, label))
+            if histogram is None:
+                histogram = self.histograms[(stage, label)] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name, label='', value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[(name, label)] = self.counters.get((name, label), 0) + value
+
+    def drain(self):
+
+        '''
+
+        Returns what was measured since the last drain & starts over, used by worker processes to send their metrics to the main process (see merge).
+        Returns None when metrics are off
+
+        '''
+
+        if not self.enabled:
+            return None
+        with self.lock:
+            histograms, counters = self.histograms, self.counters
+            self.histograms, self.counters = {}, {}
+        return {'histograms': {key: (histogram.buckets, histogram.count, histogram.sum) for key, histogram in histograms.items()}, 'counters': counters}
+
+    def merge(self, drained):
+
+        '''
+
+        Adds the metrics drained from a worker process to the metrics of this process
+
+        '''
+
+        if not drained:
+            return
+        with self.lock:
+            for key, values in drained['histograms'].items():
+                self.histograms.setdefault(key, Histogram()).merge(*values)
+            for key, value in drained['counters'].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def stats(self):
+
+        '''
+
+        Returns the metrics as a dictionary i.e. {'stages': {'find_all_nodes': {'990': {'count': 10, 'sum': 0.2, 'mean': 0.02, 'p50': ..., 'p95': ..., 'p99': ...}}}, 'counters': {'filings': {'990': 10}}}
+
+        '''
+
+        with self.lock:
+            stages = {}
+            for (stage, label), histogram in sorted(self.histograms.items()):
+                stats = {'count': histogram.count, 'sum': round(histogram.sum, 6), 'mean': round(histogram.sum / histogram.count, 6)}
+                stats.update(('p%d' % (100 * q), round(histogram.quantile(q), 6)) for q in QUANTILES)
+                stages.setdefault(stage, {})[label] = stats
+            counters = {}
+            for (name, label), value in sorted(self.counters.items()):
+                counters.setdefault(name, {})[label] = value
+        return {'uptime_seconds': round(time.time() - self.started, 1), 'stages': stages, 'counters': counters}
+
+    def prometheus(self):
+
+        '''
+
+        Returns the metrics in the prometheus text format: a histogram of seconds per stage & form type, its quantiles & a counter per counted name
+
+        '''
+
+        lines = ['# HELP %s_stage_seconds Time spent in each stage of the parser per form type' % PREFIX, '# TYPE %s_stage_seconds histogram' % PREFIX]
+        quantiles = ['# HELP %s_stage_quantile_seconds p50, p95 & p99 of the time spent in each stage of the parser' % PREFIX, '# TYPE %s_stage_quantile_seconds gauge' % PREFIX]
+        with self.lock:
+            for (stage, label), histogram in sorted(self.histograms.items()):
+                labels = 'stage="%s",form_type="%s"' % (stage, label)
+                cumulative = 0
+                for bound, count in zip(BUCKETS + (float('inf'),), histogram.buckets):
+                    cumulative += count
+                    lines.append('%s_stage_seconds_bucket{%s,le="%s"} %d' % (PREFIX, labels, '+Inf' if bound == float('inf') else repr(bound), cumulative))
+                lines.append('%s_stage_seconds_sum{%s} %r' % (PREFIX, labels, histogram.sum))
+                lines.append('%s_stage_seconds_count{%s} %d' % (PREFIX, labels, histogram.count))
+                quantiles.extend('%s_stage_quantile_seconds{%s,quantile="%s"} %r' % (PREFIX, labels, q, histogram.quantile(q)) for q in QUANTILES)
+            names = sorted(set(name for name, _ in self.counters))
+            for name in names:
+                lines.append('# TYPE %s_%s_total counter' % (PREFIX, name))
+                lines.extend('%s_%s_total{form_type="%s"} %d' % (PREFIX, name, label, value) for (counted, label), value in sorted(self.counters.items()) if counted == name)
+        return '\n'.join(lines + quantiles) + '\n'
+
+    def serve(self, port):
+
+        '''
+
+        Serves the metrics at http://localhost:port/metrics (prometheus) & /stats (json) from a background thread
+
+        '''
+
+        metrics = self
+
+        class Handler (BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.startswith('/metrics'):
+                    body, content_type = metrics.prometheus().encode('utf-8'), 'text/plain; version=0.0.4'
+                elif self.path.startswith('/stats'):
+                    body, content_type = json.dumps(metrics.stats(), indent=2).encode('utf-8'), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *arguments):
+                pass
+
+        try:
+            self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        except OSError as g:
+            log_error(g, str.format("Could not serve metrics on port {0}", port), Log_Details)
+            return
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        log_progress('', str.format("Serving metrics at http://127.0.0.1:{0}/metrics", port), Log_Details)
+
+    def write_stats(self):
+
+        '''
+
+        Writes the stats (see stats) to the stats file, the file is replaced at once so readers never see half of it
+
+        '''
+
+        try:
+            with open(self.stats_file + '.tmp', 'w') as output:
+                json.dump(self.stats(), output, indent=2)
+            os.replace(self.stats_file + '.tmp', self.stats_file)
+        except Exception as g:
+            log_error(g, str.format("Failed to write metrics to {0}", self.stats_file), Log_Details)
+
+    def write_every(self, path, seconds=metrics_interval_seconds):
+
+        '''
+
+        Writes the stats to path every seconds from a background thread (and once more on close)
+
+        '''
+
+        self.stats_file = path
+
+        def run():
+            while not self.stop.wait(seconds):
+                self.write_stats()
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def close(self):
+
+        '''
+
+        Writes the stats file one last time & stops serving the metrics
+
+        '''
+
+        self.stop.set()
+        if self.stats_file:
+            self.write_stats()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+METRICS = Metrics() # Metrics of this process, every module times its stages with it
@@ -0,0 +1,118 @@
+import re # this allows us to use regular expressions in python
+from helpers.parser.mapping import REGEXP_SCHEDULE_TYPE # We use this to undestand what part of form or schedule a variable belongs to
+
+FORM_TYPES = {'PC': '990', 'EZ': '990EZ', 'PF': '990PF'} # Part of form in a F9 variable -> form type i.e. F9-EZ-01-TOTREV -> 990EZ
+ROOT_FORM_TYPES = {'IRS990': '990', 'IRS990EZ': '990EZ', 'IRS990PF': '990PF'} # Element under ReturnData that holds the main form -> form type
+KEY_COLUMNS = (('XML_LINK', 'string'), ('FILEREIN', 'string'), ('TAXYEAR', 'int64')) # Columns every table starts with so its rows can be joined back to their filing
+META_COLUMNS = ('FILERNAME1', 'TAXPERBEGIN', 'TAXPEREND') # Meta data find_schedules copies from the main form into every schedule
+REPEATED_COLUMNS = KEY_COLUMNS + (('VARIABLE', 'string'), ('POSITION', 'int64'), ('VALUE', 'string')) # Columns of the table of variables that repeat within a filing
+
+# Overview: The concordance files list every variable a filing can have. The catalog turns them into a fixed set of typed columns per form type,
+# schedule type & table so every batch of filings can be written with the same columns (see ColumnarSink in helpers/database/sinks.py)
+
+
+class VariableCatalog (object):
+
+    '''
+
+    Fixed columns (name -> type, see VALUE_TYPES in mapping.py) of every table a filing is written to, built once per run from the compiled mapping
+        forms     - form type -> columns of the main form i.e. 990 -> {XML_LINK, FILEREIN, TAXYEAR, ..., TOTREVCURYEA: int64}
+        schedules - schedule type -> columns of the schedule i.e. SA -> {XML_LINK, FILEREIN, TAXYEAR, RETURNTYPE, FILERNAME1, ...}
+        tables    - table -> columns of one row of the table i.e. OFFICERS_PC_PART_VII_A -> {XML_LINK, FILEREIN, TAXYEAR, ROW, NAMEPEPERSON, ...}
+        names     - every column of every table above i.e. NAMEPEPERSON -> string (a name with different types in different tables is text)
+
+        Example:
+            catalog = VariableCatalog(csv_to_mapping())
+            catalog.forms['990']['TOTREVCURYEA'] -> 'int64'
+
+    '''
+
+    def __init__(self, mapping):
+        self.forms = {form_type: dict(KEY_COLUMNS) for form_type in FORM_TYPES.values()}
+        self.schedules = {}
+        self.tables = {}
+        self.repeated = dict(REPEATED_COLUMNS)
+        table_variables = set(mapping.csv_table_object.values())
+
+        # Step 1. Every variable under the repeating group of a table is a column of that table (a row holds the cleaned variable names of the leaves of its group)
+        groups = set()
+        for node in mapping.walk():
+            details = mapping.variables.get(node.table)
+            if not node.table or not details or (node.table, node.parent.path) in groups:
+                continue
+            groups.add((node.table, node.parent.path))
+            columns = self.tables.setdefault(details[1], dict(KEY_COLUMNS, ROW='int64'))
+            leaves = [node.parent]
+            while leaves:
+                leaf = leaves.pop()
+                leaves.extend(leaf.children.values())
+                if leaf.name is not None:
+                    self.add(columns, leaf.name, leaf.value_type or 'string')
+
+        # Step 2. Every other variable is a column of the form types its paths are found in (F9) or of its schedule type, tables are kept as child tables
+        for path, variable in sorted(mapping.csv_object.items(), key=lambda item: item[1]):
+            details = mapping.variables.get(variable)
+            if details is None or variable in table_variables:
+                continue
+            schedule_type, name = details
+            if schedule_type == 'F9':
+                for form_type in self.form_types(path, variable):
+                    self.add(self.forms[form_type], name, mapping.types.get(variable, 'string'))
+            else:
+                columns = self.schedules.setdefault(schedule_type, dict(KEY_COLUMNS, RETURNTYPE='string'))
+                self.add(columns, name, mapping.types.get(variable, 'string'))
+
+        # Step 3. Schedules carry the meta data of their main form, with the type the main forms give it
+        for columns in self.schedules.values():
+            for name in META_COLUMNS:
+                columns.setdefault(name, self.forms['990'].get(name, 'string'))
+
+        # Step 4. Collect every column by name
+        self.names = {}
+        for group in (self.forms, self.schedules, self.tables):
+            for columns in group.values():
+                for name, value_type in columns.items():
+                    self.add(self.names, name, value_type)
+
+    @staticmethod
+    def add(columns, name, value_type):
+
+        '''
+
+        Adds a column, a column that more than one variable maps to with different types becomes text
+
+        '''
+
+        if columns.get(name, value_type) != value_type:
+            value_type = 'string'
+        columns[name] = value_type
+
+    @classmethod
+    def form_types(cls, path, variable):
+
+        '''
+
+        Returns the form types a path of a main form variable is found in. The header is shared by every form type (a header path maps to a single variable
+        of mapping.csv i.e. Return/ReturnHeader/TaxYr -> F9-PC-00-TAXYEAR also for 990EZ filings), other paths belong to the form under ReturnData
+
+        '''
+
+        tags = path.split('/')
+        if len(tags) > 1 and tags[1] == 'ReturnHeader':
+            return list(FORM_TYPES.values())
+        if len(tags) > 2 and tags[2] in ROOT_FORM_TYPES:
+            return [ROOT_FORM_TYPES[tags[2]]]
+        form_type = FORM_TYPES.get(cls.part(variable))
+        return [form_type] if form_type else []
+
+    @staticmethod
+    def part(variable):
+
+        '''
+
+        Returns the part of form of a variable i.e. F9-EZ-01-TOTREV -> EZ
+
+        '''
+
+        pattern = re.search(REGEXP_SCHEDULE_TYPE, variable, re.IGNORECASE)
+        return pattern.group(2).upper() if pattern else None
@@ -0,0 +1,169 @@
+from collections import ChainMap # looks a column up in the columns of a table & then in those of its form
+from datetime import datetime, date # dates are stored as datetimes (mongo has no date only type)
+from decimal import Decimal, InvalidOperation # reads amounts written with decimals i.e. 1200.00
+import pyarrow as pa # typed columns
+import pyarrow.compute as pc # converts whole text columns to the type of their column at once
+
+ARROW_TYPES = {'string': pa.string(), 'int64': pa.int64(), 'float64': pa.float64(), 'bool': pa.bool_(), 'date': pa.date32()} # Type of value (see VALUE_TYPES in mapping.py) -> arrow type
+TRUE_VALUES = ['true', '1', 'x', 'yes']  # Text of a checkbox or yes/no question that is checked/answered yes
+FALSE_VALUES = ['false', '0', 'no']      # Text of a checkbox or yes/no question that is answered no
+INT64_MAX = 2 ** 63 - 1                  # Largest integer mongo & parquet can store
+LOOKUP_KEYS = ('FILEREIN', 'TAXYEAR')    # Variables forms are looked up by in mongo (see helpers/database/interface.py) they stay text so typed & untyped runs find the same documents
+DATE_PATTERN = r'^[0-9]{4}-[0-9]{2}-[0-9]{2}$' # Text of a date (first 10 characters of a value) i.e. 2021-12-31
+
+# Overview: Every value the parser extracts is the text of an xml element. The type implied by the concordance paths of a variable (see VALUE_TYPES in mapping.py)
+# lets us store amounts & counts as integers, percentages & rates as floats, checkboxes as booleans and dates as dates (--typed).
+# The parser converts value by value (FormParser(typed=True)), sinks convert the values of a whole batch at once (Coercion) which is much cheaper per value.
+# A value that doesn't fit its type is kept as text so nothing is lost.
+
+
+def number(text, value_type):
+
+    '''
+
+    Returns the number of a text value i.e. '1,200.00' -> 1200 or None when it isn't one (or is an int64 with decimals or too large)
+
+    '''
+
+    if text is None:
+        return None
+    try:
+        value = Decimal(text.strip().replace(',', ''))
+    except InvalidOperation:
+        return None
+    if not value.is_finite():
+        return None
+    if value_type == 'float64':
+        return float(value)
+    if value != value.to_integral_value() or abs(value) > INT64_MAX:
+        return None
+    return int(value)
+
+
+def coerce_value(text, value_type):
+
+    '''
+
+    Returns a text value converted to value_type i.e. ('1200', 'int64') -> 1200, ('X', 'bool') -> True, ('2021-12-31', 'date') -> datetime(2021, 12, 31)
+    Returns None when the text doesn't fit the type
+
+    '''
+
+    if text is None or value_type in (None, 'string'):
+        return text
+    if value_type == 'bool':
+        lowered = text.strip().lower()
+        return True if lowered in TRUE_VALUES else False if lowered in FALSE_VALUES else None
+    if value_type == 'date':
+        try:
+            return datetime.strptime(text.strip()[0:10], '%Y-%m-%d')
+        except ValueError:
+            return None
+    return number(text, value_type)
+
+
+def coerce_column(texts, value_type):
+
+    '''
+
+    Returns a tuple of (arrow array of value_type, number of values that didn't fit the type & are null) for a list of text values (or None)
+    The whole column is converted at once, numbers only fall back to converting value by value when some of them aren't plain numbers
+
+    '''
+
+    # Step 1. Text columns are stored as they are
+    texts = pa.array(texts, pa.string())
+    if value_type in (None, 'string'):
+        return texts, 0
+    trimmed = pc.utf8_trim_whitespace(texts)
+
+    # Step 2. Convert the column to its type
+    # Options are passed by keyword as the compute functions of older pyarrow releases (requirements.txt) don't take them by position
+    if value_type == 'bool':
+        lowered = pc.utf8_lower(trimmed)
+        column = pc.if_else(pc.is_in(lowered, value_set=pa.array(TRUE_VALUES)), True, pc.if_else(pc.is_in(lowered, value_set=pa.array(FALSE_VALUES)), False, pa.scalar(None, pa.bool_())))
+    elif value_type == 'date':
+        # Values that don't look like a date are nulled first (strptime raises on them), should strptime still reject one the column is converted value by value
+        dates = pc.utf8_slice_codeunits(trimmed, start=0, stop=10)
+        dates = pc.if_else(pc.match_substring_regex(dates, pattern=DATE_PATTERN), dates, pa.scalar(None, pa.string()))
+        try:
+            column = pc.cast(pc.strptime(dates, format='%Y-%m-%d', unit='s'), pa.date32())
+        except pa.ArrowInvalid:
+            column = pa.array([value.date() if value is not None else None for value in (coerce_value(text, value_type) for text in dates.to_pylist())], pa.date32())
+    else:
+        try:
+            column = pc.cast(trimmed, ARROW_TYPES[value_type])
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            column = pa.array([number(text, value_type) for text in trimmed.to_pylist()], ARROW_TYPES[value_type])
+
+    # Step 3. Count the values that were there but couldn't be converted
+    return column, column.null_count - texts.null_count
+
+
+class Coercion (object):
+
+    '''
+
+    Converts the values of a batch of forms (main form, schedules & table rows) to the types of their columns in the variable catalog (helpers/parser/catalog.py).
+    The values of every column of the same type are converted as one column. Used by sinks before a batch is written (--typed), values that don't fit their type are kept as text.
+
+        Example:
+            coercion = Coercion(VariableCatalog(csv_to_mapping()))
+            invalid = coercion.coerce_forms(forms)
+
+    '''
+
+    def __init__(self, catalog, keep=LOOKUP_KEYS):
+        self.catalog = catalog # VariableCatalog with the type of every column
+        self.keep = set(keep)  # columns that are never converted
+
+    def cells(self, record, columns, cells):
+
+        '''
+
+        Adds every value of a main form or schedule (record) & its table rows to cells {type: [(container, key, text)]}
+        Variables that repeat are added value by value. Rows with a single value also hold the values of their parent element (see find_table_rows)
+        so their columns are looked up in the table, then in the form & then in every table of the catalog
+
+        '''
+
+        for variable, value in record.items():
+            if variable in self.catalog.tables and isinstance(value, list):
+                table = ChainMap(self.catalog.tables[variable], columns, self.catalog.names)
+                for row in value:
+                    if isinstance(row, dict):
+                        self.cells(row, table, cells)
+            elif columns.get(variable, 'string') != 'string' and variable not in self.keep:
+                values = cells.setdefault(columns[variable], [])
+                if isinstance(value, list):
+                    values.extend((value, position, item) for position, item in enumerate(value) if isinstance(item, str))
+                elif isinstance(value, str):
+                    values.append((record, variable, value))
+
+    def coerce_forms(self, forms):
+
+        '''
+
+        Converts the values of forms in place & returns how many values didn't fit their type (they are kept as text)
+
+        '''
+
+        # Step 1. Collect the values of every column of the batch by type
+        cells = {}
+        for form in forms:
+            self.cells(form.all_data, self.catalog.forms.get(form.form_type) or {}, cells)
+            for schedule in form.schedules or []:
+                self.cells(schedule, self.catalog.schedules.get(schedule.get('type')) or {}, cells)
+
+        # Step 2. Convert the values of each type at once & put them back (dates as datetimes so mongo can store them)
+        invalid = 0
+        for value_type, values in cells.items():
+            column, _ = coerce_column([text for _, _, text in values], value_type)
+            for (container, key, text), value in zip(values, column.to_pylist()):
+                if value is None:
+                    invalid += 1
+                elif isinstance(value, date):
+                    container[key] = datetime(value.year, value.month, value.day)
+                else:
+                    container[key] = value
+        return invalid
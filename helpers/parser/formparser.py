@@ -1,7 +1,7 @@
 #import urllib2 # this is a library that allows us to handle url requests
 import os,sys
 from urllib.request import urlopen
-import re # this allows us to use regular expressions in python
+from io import BytesIO # allows us to stream filings that were already downloaded
 from lxml import etree # this is an xml parsing library 
 import logging # allows us to store logs
 from helpers.factory.formfactory import FormFactory # library allows us to create forms
@@ -9,9 +9,67 @@ from helpers.loggingutil import Log_Details, log_error # Import Custom Logging
 
 Log_Details.script = os.path.split(sys.argv[0])[1] # Store name of current script in Log_Details class object as script name. We do this so that error log will always tell us which script error comes from. 
 
-URL_IRS = '{http://www.irs.gov/efile}'   # This is a tag present in all XML filings
-REGEXP_SCHEDULE_TYPE = '(.*)-(PF|EZ|PC)' # We use this to undestand what part of form or schedule we are dealing with
-REGEXP_TYPE = '(.*)-(.*)-(.*)'           # We use this to remove initial unesscessary data and grab variable name: F9-PC-09-PENPLACONTOT becomes -> PENPLACONTOT
+from helpers.parser.mapping import CompiledMapping, URL_IRS # Compiled trie of the mapping & tag present in all XML filings
+from helpers.parser.coercion import coerce_value, LOOKUP_KEYS # Converts values to the type implied by their concordance paths (typed=True)
+from helpers.metrics import METRICS # Times each step of the parser per form type (when metrics are on)
+
+EMPTY_SPAN = (0, 0, 0, 0) # Span of an element without values see find_all_nodes
+PARSER_VERSION = 1        # Increase when a change to the parser changes what it stores so filings stored by an older parser are parsed again (see helpers/database/fingerprints.py)
+COMPILED_MAPPINGS = {}    # (id of csv_object, id of csv_table_object) -> (csv_object, csv_table_object, CompiledMapping) for parsers built without a mapping (see compiled_mapping)
+
+
+def compiled_mapping(csv_object, csv_table_object):
+
+    '''
+
+    Returns the CompiledMapping of a pair of mapping objects, compiling it (~0.2s) only the first time the pair is seen so building a FormParser
+    without a mapping (i.e. one per filing) doesn't compile it again. The objects are kept with their mapping so their ids aren't reused
+
+    '''
+
+    key = (id(csv_object), id(csv_table_object))
+    if key not in COMPILED_MAPPINGS:
+        COMPILED_MAPPINGS[key] = (csv_object, csv_table_object, CompiledMapping(csv_object, csv_table_object))
+    return COMPILED_MAPPINGS[key][2]
+
+
+class ParsedFiling (object):
+
+    '''
+
+    Result of parsing one filing (see FormParser.parse). Holds everything about the filing so the parser itself keeps no state between filings
+
+    '''
+
+    __slots__ = ('xml_link', 'object_parsed', 'all_data', 'schedules')
+
+    def __init__(self, xml_link=None):
+        self.xml_link = xml_link   # location of the filing
+        self.object_parsed = {}    # variable -> value(s) i.e. F9-PC-01-TOGRUBBII -> '0' (see handle_object_parsed)
+        self.all_data = None       # main form data i.e. form 990 (see find_all_data)
+        self.schedules = None      # list of schedules (see find_schedules)
+
+    def form(self):
+
+        '''
+
+        Returns the form (Form990/Form990EZ/Form990PF) for the filing
+
+        '''
+
+        return FormFactory(self.all_data, self.schedules).create()
+
+    def form_type(self):
+
+        '''
+
+        Returns the form type of the filing (990, 990EZ or 990PF) or '' when the filing doesn't have one
+
+        '''
+
+        return_type = (self.all_data or {}).get('RETURNTYPE')
+        return return_type if isinstance(return_type, str) else ''
+
 
 class FormParser (object):
 
@@ -19,15 +77,17 @@ class FormParser (object):
 
     Each form parser is a class object with 4 initiated variables/objects and various methods used to parse xml
     Xml is parsed as main form data, table data, and schedule data. 
+    A parser keeps no state about the filings it parses (see parse & ParsedFiling) so build one per worker & reuse it for every filing.
 
 
     '''
 
-    def __init__(self, csv_object, csv_table_object):
+    def __init__(self, csv_object, csv_table_object, mapping=None, stream=False, typed=False):
         self.csv_object = csv_object # Initiate with a csv_object variable within class/object allows us to pass/access/store variables mapping
         self.csv_table_object = csv_table_object # Initiate with a csv_table variable within/object allows us to pass/access/store table variables mapping
-        self.object_parsed = {} # Initiate with a variable that allows us to store parsed results
-        self.type = '' # Initiate with an empty variable that gets set as we parse document. I.e 990/EZ/PF etc
+        self.mapping = mapping if mapping is not None else compiled_mapping(csv_object, csv_table_object) # Compiled trie of both mappings -> pass one in (see csv_to_mapping) or it is compiled once per pair of mapping objects
+        self.stream = stream # When True filings are parsed with iterparse while they download instead of being loaded whole (see find_all_nodes_streaming)
+        self.typed = typed # When True values are converted to the type implied by their concordance paths i.e. amounts to integers (see coerce_leaves)
 
     def path_to_variable_name(self, path):
         
@@ -39,120 +99,197 @@ class FormParser (object):
 
         return self.csv_object.get(path)
 
-    def find_table_value(self, path, object_parsed, root):
+    def find_table_value(self, node, object_parsed, tables, leaves):
 
         '''
 
         Goal: Find the lists which represent a table in the form. 
 
-        Receive a path, object_parsed dictionary that is initially empty, document
+        Receive a mapping node of a leaf, object_parsed dictionary that is initially empty, rows of every table collected by find_all_nodes & the leaves they point into
         '''
-	
-
-        # Step 1. Create a variable Say a path is Return/ReturnHeader/ReturnTs -> Path to cleaned will be Return/ReturnHeader/
-        path2_cleaned = path[:path.rfind('/')]
-
-        # Step 2. Create a variable Path to Original will then be {http://www.irs.gov/efile}ReturnHeader
-        path2_original = path2_cleaned.replace(
-            '/', '/' + URL_IRS).replace('Return/', '')
 
+        # Step 1. Set variable_name list as the table of the node # variable name list then will be F9-PC-07-OFFICERS_PC_PART_VII_A or NONE
+        # The mapping already skipped paths that do not represent tables (only paths with 3 or 4 '/' in their parent represent tables)
+        # for example Return/ReturnHeader/PreparerFirmGrp/PreparerFirmName
+        variable_name_list = node.table
+
+        # Step 2 if the value is not none and the variable is not in object_parsed dictionary
+        if variable_name_list and variable_name_list not in object_parsed:
+
+            # Step 2a. Store the rows collected for the repeating group (parent of the leaf) i.e. every Form990PartVIISectionAGrp element in the filing
+            object_parsed[variable_name_list] = self.find_table_rows(tables.get(node.parent, []), leaves)
+
+                # 
+                # So a section with tables like the realted orgs table with variable SR-PC-02-RELATED_ORGS_PART_II
+                # will contain a dictionary with key - SR-PC-02-RELATED_ORGS_PART_II and values: 
+                #        [{'IICONTROORGRG': 'false', 'IIEININN': '131761660', 'IIDCENBBNLINE11': 'NA', 
+                #        'IIEXEMCODESECT': '501(C)(3)', 'IIPUBLCHARSTAT': '10', 'IIADDRADDRLINE1': 
+                #        '260 NORTH LITTLE TOR ROAD', 'IIADDRESSTATET': 'NY', 'IIADZIIPPCCOOD': '10956', 
+                #        'IIPRIMARACTIVI': 'SRVC PROVIDER', 'IINODEBNLINE11': 'JAWONIO INC', 
+                #        'IILEGADOMISTAT': 'NY', 'IIADDRESCITYIT': 'NEW CITY'}, {'IICONTROORGRG': 
+                #        'false', 'IIEININN': '133889526', 'IIDCENBBNLINE11': 'NA', 'IIEXEMCODESECT': 
+                #        '501(C)(3)', 'IIPUBLCHARSTAT': '10', 'IIADDRADDRLINE1': '260 NORTH LITTLE TOR ROAD', 
+                #        'IIADDRESSTATET': 'NY', 'IIADZIIPPCCOOD': '10956', 'IIPRIMARACTIVI': 'HOUSING', 
+                #        'IINODEBNLINE11': 'JAWONIO RESIDENTIAL OPPORTUNITIES INC', 'IILEGADOMISTAT': 'NY', 'IIADDRESCITYIT': 
+                #        'NEW CITY'}, {'IICONTROORGRG': 'false', 'IIEININN': '134109910', 'IIDCENBBNLINE11': 
+                #        'NA', 'IIEXEMCODESECT': '501(C)(3)', 'IIPUBLCHARSTAT': '10', 'IIADDRADDRLINE1': '
+                #        260 NORTH LITTLE TOR ROAD', 'IIADDRESSTATET': 'NY', 'IIADZIIPPCCOOD': '10956', 
+                #        'IIPRIMARACTIVI': 'HOUSING', 'IINODEBNLINE11': 'JAWONIO RESIDENTIAL OPPORTUNITIES 
+                #        II INC', 'IILEGADOMISTAT': 'NY', 'IIADDRESCITYIT': 'NEW CITY'}]
+
+    def find_table_rows(self, rows, leaves):
+
+        '''
+
+        Turns the rows collected by find_all_nodes for a repeating group into a list of dictionaries {variable name: value}
+
+        Each row is a tuple of (row span, parent span) where a span is [first value, first leaf, last value, last leaf] of an element.
+        Leaves of an element are contiguous so the mapped values of a row are simply leaves[first leaf:last leaf].
+        A row with exactly 1 value borrows all the values of its parent element
+        i.e. Return/ReturnData/IRS990ScheduleR/IdRelatedTaxExemptOrgGrp/DisregardedEntityName/BusinessNameLine1Txt -> uses the values of IdRelatedTaxExemptOrgGrp
 
-        # Step 3a. If path count is 3 or 4 ( only paths with more 2 '/' represent tables) 
-        if path2_cleaned.count('/') == 3 or path2_cleaned.count('/') == 4:
-            # if there are more than 3 paths then we need to find the path form the table object otherwise we skip it because its not a table
-            # for example Return/ReturnHeader/PreparerFirmGrp/PreparerFirmName
+        '''
 
-            # Step 3b. Set variable_name list as result of calling tableobject lookup # variable name list then will be Return/ReturnData/IRS990/Form990PartVIISectionAGrp or NONE
-            variable_name_list = self.csv_table_object.get(path, None) 
+        # Step 0. Setup a list container for the table & a place to keep parent rows so each parent is only built once
+        table = []
+        parent_rows = {}
 
-            # Step 3c1 if the value is not none: example: F9-PC-07-OFFICERS_PC_PART_VII_A
-            if variable_name_list:
+        # Step 1. For each row in the repeating group
+        for span, parent_span in rows:
 
+            # Step 1a. If the row only holds 1 value use the values of the parent element instead
+            if span[2] - span[0] == 1:
+                parent_row = parent_rows.get(id(parent_span))
+                if parent_row is None:
+                    parent_row = parent_rows[id(parent_span)] = {node.name: value for node, value in leaves[parent_span[1]:parent_span[3]] if node.name is not None}
+                table.append(dict(parent_row))
 
-                # Step 3c2 if the variable is not in object_parsed dictionary
-                if variable_name_list not in object_parsed.keys():
+            # Step 1b. Otherwise store the values of the row i.e. {'NAMEPEPERSON': 'JILL WARNER', 'TITLE': 'EXECUTIVE DIRECTOR/CEO'}
+            else:
+                table.append({node.name: value for node, value in leaves[span[1]:span[3]] if node.name is not None})
 
-                    # Step 3c2a create an empty list for the variable
-                    object_parsed[variable_name_list] = [] 
+        # Step 2. Return the list of rows
+        return table
 
-                    # Step 3c2b use the path to original to find all the elements
-                    elememts = root.findall(path2_original)
+    def find_all_nodes(self, elem, node, tables=None):
 
-                    # Step 3c2c for each element that is found 
-                    for element in elememts:
+        '''
 
-                        # Step 3c2c1 create a dictionary
-                        row = {}
+        Given an xml element and the mapping node that matches it, walk the xml and the mapping trie together in a single pass -- 
+        initially elem = document and node = mapping node for 'Return' -- return a list of tuples (mapping node and text)
 
-                        # STep 3c2c2 # as long as the length of list associated with variable is less than list of elements
-                        if len(object_parsed[variable_name_list]) < len(elememts):
+        Branches that are not in the mapping are skipped. When a tables dictionary is passed the rows of every repeating group
+        are collected into it on the same pass {mapping node of repeating group: [(row span, parent span)]} see find_table_rows
 
-                            # Step 3c2c2a search and store paths by passing element and path 2 cleaned
-                            paths = self.find_all_path(element, path2_cleaned)
+        '''
 
-                                # path2_cleaned  Return/ReturnData/IRS990/Form990PartVIISectionAGrp
-                                # paths = [('Return/ReturnData/IRS990/Form990PartVIISectionAGrp/PersonNm', 'JILL WARNER'), ('Return/ReturnData/IRS990/Form990PartVIISectionAGrp/TitleTxt', 'EXECUTIVE DIRECTOR/CEO')]
+        # Step 0 create a list container where leaves will be stored, a count of every value (mapped or not) & the number of rows we are currently inside of
+        leaves = []
+        values = 0
+        depth = 0
 
-                            # Step 3c2c2b if the list of tuples is length 1 example: [('Return/ReturnData/IRS990ScheduleR/IdRelatedTaxExemptOrgGrp/DisregardedEntityName/BusinessNameLine1Txt', 'JAWONIO INC')]
-                            if len(paths) == 1:
+        # Step 1. Create a find_node function that takes element, mapping node and the span of the closest row (or parent of rows) we are inside of
+        def find_node(elem, node, parent_span):
+            nonlocal values, depth
 
-                                # Step 3c2c2b1 Set parent 
-                                parent = element.getparent()
-                                # example parent: <Element {http://www.irs.gov/efile}IdRelatedTaxExemptOrgGrp at 0x110ad8b90>
-                                
-                                # Step 3c2c2b2 Set path parent
-                                path_parent = path2_cleaned[:path2_cleaned.rfind('/')]
-                                # path_parent : Return/ReturnData/IRS990ScheduleR/IdRelatedTaxExemptOrgGrp
-                                # Generate list of tuples passing an element and path output is list tuples (path/value)
+            # Step 1a. for each child of the element look up the child tag in the mapping i.e. {http://www.irs.gov/efile}ReturnTs -> ReturnTs
+            for child in elem:
+                child_node = node.lookup.get(child.tag) if node is not None else None
+                if child_node is None and not (depth and isinstance(child.tag, str)): # unmapped branches only matter inside of a row, comments never do
+                    continue
+
+                # Step 1b. if child element has no chilren and it has text that is to say it's not empty (i.e. leaf vs branch)
+                text = child.text
+                if text and not len(child):
+                    values += 1
+                    if child_node is not None:
+                        leaves.append((child_node, text))
+
+                        # Step 1b1. A repeating group without children is still a (empty) row
+                        if child_node.group and tables is not None:
+                            tables.setdefault(child_node, []).append((EMPTY_SPAN, parent_span))
+
+                # Step 1c. if child element is a repeating group (or holds repeating groups) remember where its values start and end
+                elif child_node is not None and tables is not None and (child_node.group or child_node.group_parent):
+                    span = [values, len(leaves), 0, 0]
+                    if child_node.group:
+                        tables.setdefault(child_node, []).append((span, parent_span))
+                    depth += 1
+                    find_node(child, child_node, span)
+                    depth -= 1
+                    span[2] = values
+                    span[3] = len(leaves)
+
+                # Step 1d. otherwise keep walking
+                else:
+                    find_node(child, child_node, parent_span)
+
+        # Step 2. Call the function passing the element and mapping node passed into function
+        find_node(elem, node, EMPTY_SPAN)
+
+        # Step 3. Return a list of tuples containing (mapping node and text)
+        return leaves
+
+    def find_all_nodes_streaming(self, source, tables=None):
 
-                                # Step 3c2c2b2 Find all paths and set as paths
-                                paths = self.find_all_path(parent, path_parent)
-                                # example: ('Return/ReturnData/IRS990ScheduleR/IdRelatedTaxExemptOrgGrp/DisregardedEntityName/BusinessNameLine1Txt', 'JAWONIO INC')
-                            
-                            # Step 3c2c2c if paths contains more than 1 tuple 
-                            for path, value in paths:
+        '''
 
-                                # Step 3c2c2c1 Set variable name by searching for the variable name from mapping i.e. csv_object
-                                variable_name = self.path_to_variable_name(path)
+        Streaming version of find_all_nodes used for very large filings -- source is a file like object (i.e. the response of urlopen) or a file name.
+        The xml is read with etree.iterparse and every element is cleared as soon as it has been processed so the document is never held in memory,
+        only the mapped values (and the spans of the rows they belong to) are kept. Returns the same list of tuples (mapping node and text) as find_all_nodes.
 
-                                # Step 3c2c2c2 # Assuming variable name exists if not pass !!!GOOD PLACE FOR ERROR HANDLING
-                                if variable_name:  
+        '''
 
-                                    # Step 3c2c2c2a do a regular expression on '(.*)-(.*)-(.*)', passing a variable name
-                                    pattern = re.search(REGEXP_TYPE, variable_name)
-                                    # example variable name F9-PC-07-NAMEPEPERSON
+        # Step 0 create a list container where leaves will be stored, a count of every value (mapped or not)
+        # & a stack with one entry [mapping node, span, has children] per element we are currently inside of
+        leaves = []
+        values = 0
+        stack = []
+        parent_span = EMPTY_SPAN
+
+        # Step 1. For each element that opens or closes in the xml
+        for event, elem in etree.iterparse(source, events=('start', 'end')):
+
+            # Step 1a. When an element opens look up its tag in the mapping under the node of its parent (the root tag is looked up in the roots of the mapping)
+            if event == 'start':
+                if stack:
+                    parent = stack[-1]
+                    parent[2] = True
+                    node = parent[0].lookup.get(elem.tag) if parent[0] is not None else None
+                else:
+                    node = self.mapping.root(elem.tag)
+
+                # Step 1a1. A repeating group (or an element holding repeating groups) remembers where its values start
+                span = None
+                if node is not None and tables is not None and (node.group or node.group_parent):
+                    span = [values, len(leaves), values, len(leaves)]
+                    if node.group:
+                        tables.setdefault(node, []).append((span, parent_span))
+                    parent_span = span
+                stack.append([node, span, False])
+                continue
 
-                                    # Step 3c2c2c2b if a pattern exists
-                                    if pattern:
+            # Step 1b. When an element closes, close its span before counting its own value (a repeating group without children is an empty row)
+            node, span, has_children = stack.pop()
+            if span is not None:
+                span[2] = values
+                span[3] = len(leaves)
+                parent_span = next((entry[1] for entry in reversed(stack) if entry[1] is not None), EMPTY_SPAN)
 
-                                        # Step 3c2c2c2b1 select everything after third dash -> NAMEPEPERSON from F9-PC-07-NAMEPEPERSON
-                                        variable_name_cleaned = pattern.group(3)
-                                        variable_name_cleaned = re.sub(r'[^\x00-\x7f]',r'', variable_name_cleaned)
-                                        # Step 3c2c2c2b2 update the row dictionary
-                                        row.update({variable_name_cleaned: value})
-                            
-                            # 3c2c2d Store data into variable_name_list and append
-                            object_parsed[variable_name_list].append(row)
+            # Step 1c. if the element has no chilren and it has text that is to say it's not empty (i.e. leaf vs branch)
+            text = elem.text
+            if text and not has_children:
+                values += 1
+                if node is not None:
+                    leaves.append((node, text))
 
-                                # 
-                                # So a section with tables like the realted orgs table with variable SR-PC-02-RELATED_ORGS_PART_II
-                                # will contain a dictionary with key - SR-PC-02-RELATED_ORGS_PART_II and values: 
-                                #        [{'IICONTROORGRG': 'false', 'IIEININN': '131761660', 'IIDCENBBNLINE11': 'NA', 
-                                #        'IIEXEMCODESECT': '501(C)(3)', 'IIPUBLCHARSTAT': '10', 'IIADDRADDRLINE1': 
-                                #        '260 NORTH LITTLE TOR ROAD', 'IIADDRESSTATET': 'NY', 'IIADZIIPPCCOOD': '10956', 
-                                #        'IIPRIMARACTIVI': 'SRVC PROVIDER', 'IINODEBNLINE11': 'JAWONIO INC', 
-                                #        'IILEGADOMISTAT': 'NY', 'IIADDRESCITYIT': 'NEW CITY'}, {'IICONTROORGRG': 
-                                #        'false', 'IIEININN': '133889526', 'IIDCENBBNLINE11': 'NA', 'IIEXEMCODESECT': 
-                                #        '501(C)(3)', 'IIPUBLCHARSTAT': '10', 'IIADDRADDRLINE1': '260 NORTH LITTLE TOR ROAD', 
-                                #        'IIADDRESSTATET': 'NY', 'IIADZIIPPCCOOD': '10956', 'IIPRIMARACTIVI': 'HOUSING', 
-                                #        'IINODEBNLINE11': 'JAWONIO RESIDENTIAL OPPORTUNITIES INC', 'IILEGADOMISTAT': 'NY', 'IIADDRESCITYIT': 
-                                #        'NEW CITY'}, {'IICONTROORGRG': 'false', 'IIEININN': '134109910', 'IIDCENBBNLINE11': 
-                                #        'NA', 'IIEXEMCODESECT': '501(C)(3)', 'IIPUBLCHARSTAT': '10', 'IIADDRADDRLINE1': '
-                                #        260 NORTH LITTLE TOR ROAD', 'IIADDRESSTATET': 'NY', 'IIADZIIPPCCOOD': '10956', 
-                                #        'IIPRIMARACTIVI': 'HOUSING', 'IINODEBNLINE11': 'JAWONIO RESIDENTIAL OPPORTUNITIES 
-                                #        II INC', 'IILEGADOMISTAT': 'NY', 'IIADDRESCITYIT': 'NEW CITY'}]
-                                
+            # Step 1d. Free the element & the siblings that came before it, we are done with them
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
 
+        # Step 2. Return a list of tuples containing (mapping node and text)
+        return leaves
 
     def find_all_path(self, elem, elem_path="", root=None):
 
@@ -218,14 +355,10 @@ class FormParser (object):
             if var_key is None: # could be a good error log area
                 continue
 
-            # Step 2b. Search the var_key using a regular expression that matches for '(.*)-(PF|EZ|PC)' and store first group
-            # example SA-PC-02-IIUBTICTYMYE3 ---> will store SA which corresponds with schedule a
-            type_schedule = re.search(REGEXP_SCHEDULE_TYPE, var_key, re.IGNORECASE).group(1)
-            
+            # Step 2b. Look up the schedule type and variable name the mapping resolved when it was compiled
+            # example SA-PC-02-IIUBTICTYMYE3 ---> will store SA which corresponds with schedule a & variable name -> IIUBTICTYMYE3
+            type_schedule, variable_name = self.variable_details(var_key)
 
-            # Step 2c Using a regular expression extract the variable name -> IIUBTICTYMYE3
-            variable_name = re.search("(.*)-(.*)-(.*)", var_key).group(3)
-            variable_name = re.sub(r'[^\x00-\x7f]',r'', variable_name)
             # adding meta data to file  ## test with pf, ez, regular might need to add variations adding this so that we know what type of col
             
             # Following if statements all check for certain variables and add them to meta container
@@ -310,13 +443,10 @@ class FormParser (object):
             if var_key is None:
                 continue
 
-            # Step 1b Search the var_key using a regular expression that matches for '(.*)-(PF|EZ|PC)' and store first group
-            # example F9-PC-09-PENPLACONTOT ---> will store F9 which corresponds with schedule a form 990
-            type_form = re.search(REGEXP_SCHEDULE_TYPE, var_key, re.IGNORECASE).group(1)
+            # Step 1b Look up the form type and variable name the mapping resolved when it was compiled
+            # example F9-PC-09-PENPLACONTOT ---> will store F9 which corresponds with schedule a form 990 & variable name -> PENPLACONTOT
+            type_form, variable_name = self.variable_details(var_key)
 
-            # Step 1c Search the var_key using a regular expression extract the variable name -> TOFUEXPRSEER
-            variable_name = re.search("(.*)-(.*)-(.*)", var_key, re.IGNORECASE).group(3)
-            variable_name = re.sub(r'[^\x00-\x7f]',r'', variable_name)
             # Step 1d If its main form data (i.e. form 990, 990ez, 990pf) add data otherwise its a schedule and has been processed
             if type_form == 'F9': 
 
@@ -326,19 +456,49 @@ class FormParser (object):
         # Step 2 return all_data container #! should we also set container back to empty 
         return all_data
 
-    def handle_object_parsed(self, paths, object_parsed):
+    def variable_details(self, var_key):
 
-        ''' This function receives paths (a list of tuples containint (path/text)) and an empty dictionary'''
+        '''
 
-        #Step 0 For each key, value store in paths
-        for path, value in paths:
+        Returns the (schedule type, variable name) tuple for a variable i.e. F9-PC-09-PENPLACONTOT -> ('F9', 'PENPLACONTOT')
+
+        '''
+
+        details = self.mapping.variables.get(var_key)
+        if details is None:
+            raise ValueError(str.format("Variable {0} does not follow the concordance naming convention", var_key))
+        return details
+
+    def coerce_leaves(self, leaves):
+
+        '''
+
+        Returns leaves with each value converted to the type of its mapping node i.e. (node of CYTotalRevenueAmt, '1200') -> (node, 1200)
+        Values that don't fit their type & the variables forms are looked up by in mongo (FILEREIN, TAXYEAR) are kept as text
+
+        '''
+
+        coerced = []
+        for node, value in leaves:
+            if node.value_type not in (None, 'string') and node.name not in LOOKUP_KEYS:
+                typed_value = coerce_value(value, node.value_type)
+                value = value if typed_value is None else typed_value
+            coerced.append((node, value))
+        return coerced
+
+    def handle_object_parsed(self, leaves, object_parsed, tables):
+
+        ''' This function receives leaves (a list of tuples containint (mapping node/text)), an empty dictionary and the table rows collected by find_all_nodes'''
+
+        #Step 0 For each node, value store in leaves
+        for node, value in leaves:
+
+            # Step 1. the mapping node already knows the corresponding variable in csv_object i.e mapping
+            variable_name = node.variable
 
-            # Step 1. uses the paths from paths tuple and looks up corresponding variable in csv_object i.e mapping
-            variable_name = self.path_to_variable_name(path)
-            #variable_name = re.sub(r'[^\x00-\x7f]',r'', variable_name)
             # Step 2. first we are going to extract all tables
-            # Look for a table value calling find_table_value function passing path, empty dictionary, xml document
-            self.find_table_value(path, object_parsed, self.root)
+            # Look for a table value calling find_table_value function passing node, empty dictionary, table rows
+            self.find_table_value(node, object_parsed, tables, leaves)
 
             # Step 3a. if the variable is in the object_parsed i.e. in the dictionary
             if variable_name in object_parsed: 
@@ -357,10 +517,59 @@ class FormParser (object):
                 #Step 3b1 then append the variable name and value to dictionary
                 object_parsed[variable_name] = value
 
-    def create(self, xml_link):
+    def parse(self, source, xml_link=None):
+
+        '''
+
+        Parses a filing & returns a ParsedFiling with its main form data (all_data) & schedules. source is the bytes of the filing
+        (or a file like object i.e. the response of urlopen), xml_link is only stored with the data.
+
+        The parser keeps nothing between calls (everything about a filing lives in the ParsedFiling) so one parser can be reused for every filing
+        of a worker & shared by threads. Raises an exception when the filing can't be parsed (see create which logs it instead)
+
+        '''
+
+        # Step 1. Find all mapped leaves & table rows from xml form in a single pass. Passing (Document, mapping node for the root tag i.e. 'Return', empty dictionary for table rows)
+        # Once this step is done we will have a list of mapping nodes and values. In streaming mode the filing is read (and parsed) piece by piece
+        # Each step is timed as a lap & observed once the form type is known (laps do nothing when metrics are off)
+        laps = METRICS.laps()
+        tables = {}
+        if self.stream:
+            leaves = self.find_all_nodes_streaming(BytesIO(source) if isinstance(source, bytes) else source, tables)
+        else:
+            root = etree.XML(source if isinstance(source, bytes) else source.read())
+            laps.lap('xml_parse')
+            leaves = self.find_all_nodes(root, self.mapping.root(root.tag), tables)
+        laps.lap('find_all_nodes')
+
+        # Step 1a. When typed convert every value to the type implied by its concordance paths (table rows point into the same leaves)
+        if self.typed:
+            leaves = self.coerce_leaves(leaves)
+            laps.lap('coerce')
+
+        # Step 2. Passing leaves which is a list of tuples (mapping node and text), object_parsed which is an empty dictionary & table rows
+        parsed = ParsedFiling(xml_link)
+        self.handle_object_parsed(leaves, parsed.object_parsed, tables)
+        laps.lap('handle_object_parsed')
+
+        # Step 3. Find all schedules data in parsed object. Result will be a list of dictionaries with each dictionary representing a schedule & its contents
+        parsed.schedules = self.find_schedules(parsed.object_parsed)
+        laps.lap('find_schedules')
+
+        # Step 4. Find all data related to main form 990/ez/pf
+        parsed.all_data = self.find_all_data(parsed.object_parsed)
+        laps.lap('find_all_data')
+        laps.done(parsed.form_type())
+
+        # Step 5. To the main filing data that we got in step 4 add a link so that we can download the original xml if ever needed from aws.
+        parsed.all_data['XML_LINK'] = xml_link
+        return parsed
+
+    def create(self, xml_link, xml_data=None):
 
         '''
         This method takes an xml_link i.e. location of a xml filing, downloads the filing, processes it and creates a form object which can then be inserted. 
+        When the filing has already been downloaded (see helpers/xml_downloader.py) its bytes are passed as xml_data and xml_link is only stored with the form.
 
         '''
 
@@ -369,43 +578,45 @@ class FormParser (object):
 
         # Step 1a. Try to run following code
         try:
-            # Step 2 Given a link download the filing and store as parser.root
-
+            # Step 2 Given a link download the filing (unless it was already downloaded)
+            # In streaming mode we only open the link, the filing is read (and parsed) piece by piece in step 3
             try:
-                self.root = etree.XML(urlopen(xml_link).read())
+                if xml_data is not None:
+                    source = xml_data
+                elif self.stream:
+                    source = urlopen(xml_link)
+                else:
+                    with METRICS.timer('download'):
+                        source = urlopen(xml_link).read()
 
             except Exception as g:
 
                 # Step 1b1. Print Exception to console
                 log_error(g, str.format( "Issue Downloadin the following xml_link: {0}.", xml_link), Log_Details)
+                METRICS.count('failed_downloads')
+                return None
 
-            # Step 3. Find all paths from xml form. Passing (Document, stripping url from form so says 'Return' only, Document)
-            # Once this step is done we will have a list of paths and variables. 
-            paths = self.find_all_path(self.root, self.root.tag.replace(URL_IRS, ''), self.root)
-
-            # Step 4. Passing Paths which is a list of tuples (path and text) & object_parsed which is an empty dictionary initated with class
-            self.handle_object_parsed(paths, self.object_parsed)
-            # -----currently here
-
-            # Step 5. Find all schedules data in parsed object. Result will be a list of dictionaries with each dictionary representing a schedule & its contents
-            schedules = self.find_schedules(self.object_parsed)
-
-            # Step 6. Find all data related to main form 990/ez/pf
-            all_data = self.find_all_data(self.object_parsed)
-
-            # Step 7. To the main filing data that we got in step 6 add a link so that we can download the original xml if ever needed from aws. 
-            all_data['XML_LINK'] = xml_link
+            # Step 3. Parse the filing into main form data & schedules (see parse)
+            if hasattr(source, 'close'):
+                with source:
+                    parsed = self.parse(source, xml_link)
+            else:
+                parsed = self.parse(source, xml_link)
 
-            # Recap: at this point we have all the main form data in -> all_data and we have schedule data in schedules
+            # Recap: at this point we have all the main form data in -> parsed.all_data and we have schedule data in parsed.schedules
 
-            # Step 8. We are passing all the data (main form, and schedules) to create a form 
-            form = FormFactory(all_data, schedules).create()
+            # Step 4. We are passing all the data (main form, and schedules) to create a form 
+            form = parsed.form()
+            METRICS.count('filings' if form is not None else 'failed_filings', parsed.form_type())
+            if form is not None and isinstance(source, bytes):
+                METRICS.count('bytes', parsed.form_type(), len(source))
 
         # Step 1b. If code cant be run throw an exception and print it to console
         except Exception as g:
 
             # Step 1b1. Print Exception to console
             log_error(g, str.format( "Issue parsing the following xml file: {0}.", xml_link), Log_Details)
+            METRICS.count('failed_filings')
 
         # Step 2/9. Return the form that has been created back to whatever file called this method -> main_xml.py
         # Once the form is created and return, main can then store it or do other things with it.  
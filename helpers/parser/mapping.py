@@ -0,0 +1,200 @@
+import re # this allows us to use regular expressions in python
+
+URL_IRS = '{http://www.irs.gov/efile}'   # This is a tag present in all XML filings
+REGEXP_SCHEDULE_TYPE = '(.*)-(PF|EZ|PC)' # We use this to undestand what part of form or schedule we are dealing with
+REGEXP_TYPE = '(.*)-(.*)-(.*)'           # We use this to remove initial unesscessary data and grab variable name: F9-PC-09-PENPLACONTOT becomes -> PENPLACONTOT
+
+# Type of value implied by the suffix of the last tag of a path (IRS schema naming conventions) i.e. .../CYTotalRevenueAmt -> int64
+# Tags of the older schemas don't follow the conventions (i.e. TotalRevenueCurrentYear) so they don't imply a type, see value_type
+VALUE_TYPES = (
+    ('Amt', 'int64'),    # USAmountType i.e. CYTotalRevenueAmt
+    ('Cnt', 'int64'),    # counts i.e. TotalEmployeeCnt
+    ('Yr', 'int64'),     # years i.e. TaxYr
+    ('Pct', 'float64'),  # percentages i.e. PublicSupportCY170Pct
+    ('Rt', 'float64'),   # rates i.e. AverageHoursPerWeekRt
+    ('Ind', 'bool'),     # checkboxes & yes/no questions i.e. GrossReceiptsInd
+    ('Dt', 'date'),      # dates i.e. TaxPeriodBeginDt
+    ('Txt', 'string'),
+    ('Cd', 'string'),
+    ('Nm', 'string'),
+    ('Num', 'string'),   # phone numbers, ssn & other numbers that are identifiers
+    ('EIN', 'string'),   # EINs keep their leading zeros
+)
+
+# Overview: The concordance files are read once per run and compiled into a trie of xml tags so the parser never has to do string or regex work per filing
+
+
+class MappingNode (object):
+
+    '''
+
+    Each mapping node represents one element tag of an XPATH from the concordance files i.e. Return -> ReturnData -> IRS990 -> Form990PartVIISectionAGrp
+    Everything the parser needs to know about a path (variable, cleaned variable name, table membership) is resolved when the node is compiled.
+
+    '''
+
+    __slots__ = ('tag', 'path', 'parent', 'children', 'lookup', 'variable', 'name', 'table', 'group', 'group_parent', 'value_type')
+
+    def __init__(self, tag, parent=None):
+        self.tag = tag           # element tag without the irs url i.e. PersonNm
+        self.parent = parent     # node one level up in the xml i.e. Form990PartVIISectionAGrp
+        self.path = tag if parent is None else parent.path + '/' + tag # full path i.e. Return/ReturnData/IRS990/Form990PartVIISectionAGrp/PersonNm
+        self.children = {}       # child tag -> MappingNode
+        self.lookup = {}         # same as children but also keyed by the tag as lxml reports it i.e. {http://www.irs.gov/efile}PersonNm -> MappingNode
+        self.variable = None     # variable from mapping.csv i.e. F9-PC-07-NAMEPEPERSON
+        self.name = None         # cleaned variable name used inside table rows i.e. NAMEPEPERSON
+        self.table = None        # variable from mapping_table.csv when this path is part of a table i.e. F9-PC-07-OFFICERS_PC_PART_VII_A
+        self.group = False       # True when this node is the repeating group of a table i.e. each Form990PartVIISectionAGrp element is one row
+        self.group_parent = False # True when this node holds repeating groups i.e. IRS990 -> rows with a single value borrow the values of this element
+        self.value_type = None   # type of the values of the variable i.e. int64 (see CompiledMapping.types)
+
+    def child(self, tag):
+
+        '''
+
+        Find or create the node for a child tag
+
+        '''
+
+        node = self.children.get(tag)
+        if node is None:
+            node = self.children[tag] = self.lookup[tag] = self.lookup[URL_IRS + tag] = MappingNode(tag, self)
+        return node
+
+
+class CompiledMapping (object):
+
+    '''
+
+    Compiled version of mapping.csv and mapping_table.csv.
+    It is built once per run (see csv_to_mapping in helpers.py) and shared by every FormParser.
+
+    '''
+
+    def __init__(self, csv_object, csv_table_object):
+        self.csv_object = csv_object             # {path: variable} from mapping.csv
+        self.csv_table_object = csv_table_object # {path: table variable} from mapping_table.csv
+        self.roots = {}                          # root tag (i.e. Return) -> MappingNode
+        self.variables = {}                      # variable -> (schedule type, cleaned variable name) i.e. F9-PC-07-NAMEPEPERSON -> ('F9', 'NAMEPEPERSON')
+        self.types = {}                          # variable -> type of its values (see value_type) i.e. F9-PC-08-TOTREVCURYEA -> int64
+        path_types = {}                          # (schedule type, cleaned variable name) -> set of types implied by the paths of every variable stored under it
+
+        # Step 1. Add every path of the main mapping to the trie
+        for path, variable in csv_object.items():
+            node = self.node(path)
+            node.variable = variable
+            node.name = self.clean_variable_name(variable)
+            self.variables[variable] = self.resolve_variable(variable)
+            path_types.setdefault(self.variables[variable] or variable, set()).add(self.value_type(path))
+
+        # Step 1a. A variable has the type the paths of every variable stored under the same name agree on i.e. F9-PF-05-PROPFOQUDIYE3 (older schema, no type)
+        # & F9-PF-14-PROPFOQUDIYE3 (Year3Amt) are both int64. Names whose paths disagree (or imply nothing) are text
+        for types in path_types.values():
+            types.discard(None)
+        for path, variable in csv_object.items():
+            types = path_types[self.variables[variable] or variable]
+            self.types[variable] = self.node(path).value_type = next(iter(types)) if len(types) == 1 else 'string'
+
+        # Step 2. Add every path of the table mapping to the trie
+        for path, variable_table in csv_table_object.items():
+            self.variables[variable_table] = self.resolve_variable(variable_table)
+
+            # Step 2a. Only paths whose parent has 3 or 4 '/' represent tables
+            # for example Return/ReturnHeader/PreparerFirmGrp/PreparerFirmName is not a table
+            path_cleaned = path[:path.rfind('/')]
+            if not variable_table or path_cleaned.count('/') not in (3, 4):
+                continue
+
+            # Step 2b. The leaf knows its table and its parent is the repeating group i.e. Return/ReturnData/IRS990/Form990PartVIISectionAGrp
+            node = self.node(path)
+            node.table = variable_table
+            node.parent.group = True
+            node.parent.parent.group_parent = True
+
+    def node(self, path):
+
+        '''
+
+        Find or create the node for a path i.e. Return/ReturnHeader/ReturnTs
+
+        '''
+
+        tags = path.split('/')
+        node = self.roots.get(tags[0])
+        if node is None:
+            node = self.roots[tags[0]] = MappingNode(tags[0])
+        for tag in tags[1:]:
+            node = node.child(tag)
+        return node
+
+    def walk(self):
+
+        '''
+
+        Generator that yields every node of the trie
+
+        '''
+
+        nodes = list(self.roots.values())
+        while nodes:
+            node = nodes.pop()
+            yield node
+            nodes.extend(node.children.values())
+
+    def root(self, tag):
+
+        '''
+
+        Returns the node for the root element of a filing or None if nothing is mapped under it
+
+        '''
+
+        return self.roots.get(tag.replace(URL_IRS, '')) if isinstance(tag, str) else None
+
+    @staticmethod
+    def value_type(path):
+
+        '''
+
+        Returns the type of value implied by the last tag of a path (see VALUE_TYPES) i.e. Return/ReturnHeader/TaxYr -> int64
+        Returns None when the tag doesn't follow the naming conventions i.e. Return/ReturnHeader/TaxYear
+
+        '''
+
+        tag = path[path.rfind('/') + 1:]
+        for suffix, value_type in VALUE_TYPES:
+            if tag.endswith(suffix):
+                return value_type
+        return None
+
+    @staticmethod
+    def clean_variable_name(variable):
+
+        '''
+
+        Select everything after third dash -> NAMEPEPERSON from F9-PC-07-NAMEPEPERSON and strip non ascii characters
+        Returns None when the variable doesn't follow the concordance naming convention
+
+        '''
+
+        pattern = re.search(REGEXP_TYPE, variable)
+        if pattern:
+            return re.sub(r'[^\x00-\x7f]', r'', pattern.group(3))
+        return None
+
+    @classmethod
+    def resolve_variable(cls, variable):
+
+        '''
+
+        Returns a tuple of (schedule type, cleaned variable name)
+        example SA-PC-02-IIUBTICTYMYE3 ---> ('SA', 'IIUBTICTYMYE3') and F9-PC-09-PENPLACONTOT ---> ('F9', 'PENPLACONTOT')
+        Returns None when the variable doesn't follow the concordance naming convention
+
+        '''
+
+        pattern = re.search(REGEXP_SCHEDULE_TYPE, variable, re.IGNORECASE)
+        variable_name = cls.clean_variable_name(variable)
+        if pattern is None or variable_name is None:
+            return None
+        return (pattern.group(1), variable_name)
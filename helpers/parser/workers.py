@@ -0,0 +1,180 @@
+import os,sys # allows us to use operating system functions
+from multiprocessing import Pool, current_process # allows us to parse filings on every core
+from helpers.helpers import csv_to_mapping # compiles the mapping once per worker
+from helpers.xml_downloader import archive_path, read_archive, read_xmls # reads filings out of zip archives (--zip) or downloads them one by one
+from helpers.parser.formparser import FormParser # parser used by every worker
+from helpers.factory.formfactory import FormFactory # rebuilds forms out of the data returned by the workers
+from helpers.metrics import METRICS # workers send what they measured back to the main process (when metrics are on)
+from helpers.loggingutil import Log_Details, log_error # Import Custom Logging
+
+Log_Details.script = os.path.split(sys.argv[0])[1] # Store name of current script in Log_Details class object as script name. We do this so that error log will always tell us which script error comes from.
+
+# Overview: Shards the filings of an index over a pool of worker processes (--workers N). Each worker compiles the mapping once when it starts,
+# parses the filings it is handed and returns the parsed data (all_data & schedules) to the main process which writes them to mongo.
+# With --zip the workers are handed pieces of zip archives instead of single filings (see parse_archives).
+# When metrics are on (see helpers/metrics.py) the workers time their filings too & send the timings back with the data.
+
+WORKER = {} # State of a worker process set once by init_worker i.e. {'mapping': CompiledMapping, 'stream': False, 'parser': FormParser}
+
+
+def create_pool(workers, stream=False):
+
+    '''
+
+    Returns a pool of worker processes that parse filings or None when we should parse in this process
+    i.e. 1 worker or we are already running inside of a pool (more than 1 index is being processed, pool processes cant have children)
+
+    '''
+
+    if workers <= 1:
+        return None
+    if current_process().daemon:
+        log_error('', str.format("Can't start {0} workers from inside of a pool process, parsing with 1 worker", workers), Log_Details)
+        return None
+    return Pool(workers, initializer=init_worker, initargs=(stream, METRICS.enabled))
+
+
+def init_worker(stream=False, metrics=False):
+
+    '''
+
+    Runs once when a worker process starts, compiles the mapping & builds the parser every filing parsed by the worker is parsed with
+    metrics turns timing on in the worker when it is on in the main process
+
+    '''
+
+    if metrics:
+        METRICS.enable()
+
+    WORKER['mapping'] = mapping = csv_to_mapping()
+    WORKER['stream'] = stream
+    WORKER['parser'] = FormParser(mapping.csv_object, mapping.csv_table_object, mapping, stream)
+
+
+def parse_filing(download):
+
+    '''
+
+    Runs in a worker process. Takes a tuple of (xml_link, xml bytes or None) parses the filing and returns a tuple of (xml_link, all_data, schedules, metrics)
+    all_data & schedules are None when the filing could not be parsed (the parser already logged why), metrics is what the worker measured since it last sent them (or None)
+
+    '''
+
+    # Step 1. Parse the filing with the parser built when the worker started
+    xml_link, xml_data = download
+    form = WORKER['parser'].create(xml_link, xml_data)
+
+    # Step 2. Only return the data, the form is created again in the main process
+    if form is None:
+        return xml_link, None, None, METRICS.drain()
+    return xml_link, form.all_data, form.schedules, METRICS.drain()
+
+
+def parse_filings(downloads, pool=None, mapping=None, stream=False, parser=None):
+
+    '''
+
+    Generator that parses filings and yields a tuple of (xml_link, form) for each one, form is None when the filing could not be downloaded or parsed.
+    downloads is an iterable of (xml_link, xml bytes or None, error) i.e. helpers.xml_downloader.fetch_xmls, filings that failed to download are logged.
+    When a pool is passed (see create_pool) filings are parsed by the workers and yielded in the order they finish, otherwise they are parsed here in order
+    by parser (one is built out of mapping when it isn't passed) which is reused for every filing.
+
+    '''
+
+    # Step 1. Log filings that could not be downloaded & set them aside (they are yielded without a form) instead of parsing them
+    failed = []
+    def downloaded():
+        for xml_link, xml_data, error in downloads:
+            if error is not None:
+                log_error(error, str.format("Issue Downloadin the following xml_link: {0}.", xml_link), Log_Details)
+                failed.append(xml_link)
+                continue
+            yield xml_link, xml_data
+
+    # Step 2a. Without a pool parse each filing in this process with the same parser
+    if pool is None:
+        parser = parser or FormParser(mapping.csv_object, mapping.csv_table_object, mapping, stream)
+        for xml_link, xml_data in downloaded():
+            while failed:
+                yield failed.pop(0), None
+            yield xml_link, parser.create(xml_link, xml_data)
+
+    # Step 2b. With a pool let the workers parse & create the forms out of the data they send back
+    # (the pool reads downloads in its own thread, failed downloads are yielded in between the parsed filings)
+    else:
+        for xml_link, all_data, schedules, metrics in pool.imap_unordered(parse_filing, downloaded()):
+            METRICS.merge(metrics)
+            while failed:
+                yield failed.pop(0), None
+            yield xml_link, (FormFactory(all_data, schedules).create() if all_data is not None else None)
+
+    # Step 3. Yield the failed downloads that came after the last filing
+    while failed:
+        yield failed.pop(0), None
+
+
+def archive_tasks(filings, chunk_size):
+
+    '''
+
+    Generator that groups filings (index entries) by the zip archive that holds them (ZipFile) and yields a tuple of (zip_file, archive path, xml links)
+    for every chunk_size filings of an archive. The archive is downloaded (if needed) right before its first chunk is yielded.
+    Filings without a ZipFile (or whose archive can't be downloaded) are yielded with a path of None i.e. download them one by one.
+
+    '''
+
+    # Step 1. Group the links of the filings by archive
+    archives = {}
+    for filing in filings:
+        archives.setdefault(filing.get('ZipFile'), []).append(filing['URL'])
+
+    # Step 2. Hand out each archive in chunks
+    for zip_file, xml_links in archives.items():
+        path = archive_path(zip_file) if zip_file else None
+        for position in range(0, len(xml_links), chunk_size):
+            yield zip_file, path, xml_links[position:position + chunk_size]
+
+
+def parse_archive(task):
+
+    '''
+
+    Runs in a worker process. Takes a tuple of (zip_file, archive path, xml links) from archive_tasks, reads those filings out of the archive
+    & parses them. Returns a tuple of (list of (xml_link, all_data, schedules) for every filing, metrics measured by the worker or None).
+    all_data & schedules are None when the filing could not be parsed (the parser already logged why).
+
+    '''
+
+    zip_file, path, xml_links = task
+    downloads = read_archive(path, xml_links) if path is not None else read_xmls(xml_links)
+    results = [(xml_link, form.all_data, form.schedules) if form is not None else (xml_link, None, None) for xml_link, form in parse_filings(downloads, None, parser=WORKER['parser'])]
+    return results, METRICS.drain()
+
+
+def parse_archives(filings, pool=None, mapping=None, stream=False, chunk_size=1000):
+
+    '''
+
+    Generator that parses filings read out of the zip archives named in their index entries (--zip) and yields a tuple of (xml_link, form) for each one,
+    form is None when the filing could not be parsed (like parse_filings).
+    Each archive is read once from start to end without being extracted. When a pool is passed the chunks of the archives are spread over the workers
+    (archives are downloaded by the pool in the background while the workers parse), otherwise they are parsed here one after the other.
+
+    '''
+
+    tasks = archive_tasks(filings, chunk_size)
+
+    # Step 1a. Without a pool read & parse each chunk in this process (with one parser for every chunk)
+    if pool is None:
+        parser = FormParser(mapping.csv_object, mapping.csv_table_object, mapping, stream)
+        for zip_file, path, xml_links in tasks:
+            downloads = read_archive(path, xml_links) if path is not None else read_xmls(xml_links)
+            for xml_link, form in parse_filings(downloads, None, parser=parser):
+                yield xml_link, form
+
+    # Step 1b. With a pool let the workers parse the chunks & create the forms out of the data they send back
+    else:
+        for results, metrics in pool.imap_unordered(parse_archive, tasks):
+            METRICS.merge(metrics)
+            for xml_link, all_data, schedules in results:
+                yield xml_link, (FormFactory(all_data, schedules).create() if all_data is not None else None)
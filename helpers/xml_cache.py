@@ -0,0 +1,180 @@
+import os,sys # allows us to use operating system functions
+import hashlib # allows us to check a downloaded filing against the FileSha256 of its index entry
+import re # allows us to check a FileSha256 looks like one before using it as a file name
+from settings.Settings import xml_cache_directory, xml_cache_max_bytes
+from .loggingutil import Log_Details, log_error, log_progress
+
+Log_Details.script = os.path.split(sys.argv[0])[1] # Store name of current script in Log_Details class object as script name. We do this so that error log will always tell us which script error comes from.
+
+REGEXP_SHA256 = re.compile('^[0-9a-f]{64}$') # A sha256 in hex
+EVICT_TO = 0.9 # When the cache is full the least recently used filings are removed until it is 90% full
+
+# Overview: Keeps the filings we download on disk under the sha256 of their content (FileSha256 of the index entry) so reprocessing
+# an index (-f, -u or after a mapping change) reads them from disk instead of downloading them again. Used with --cache.
+
+
+class XmlCache (object):
+
+    '''
+
+    On disk cache of xml filings stored as {directory}/{first 2 characters of sha256}/{sha256}.xml. A filing is only stored when its content
+    matches the sha256 it is stored under. Reading a filing marks it as recently used, once the cache grows over max_bytes the least
+    recently used filings are removed.
+
+        Example:
+            cache = XmlCache()
+            form_parser = FormParser(CSV_OBJECT, CSV_TABLE_OBJECT, csv_to_mapping(CSV_OBJECT, CSV_TABLE_OBJECT))
+            for xml_link, xml_data, error in cache.fetch(filings, fetch_xmls):
+                form = form_parser.create(xml_link, xml_data)
+
+    '''
+
+    def __init__(self, directory=xml_cache_directory, max_bytes=xml_cache_max_bytes):
+        self.directory = directory  # folder the filings are stored in
+        self.max_bytes = max_bytes  # size the cache may grow to before filings are removed
+        self.hits = 0               # filings read from the cache
+        self.misses = 0             # filings that had to be downloaded
+        os.makedirs(self.directory, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in self.entries())
+
+    def path(self, sha256):
+
+        '''
+
+        Returns the path a filing with this sha256 is stored at or None when sha256 isn't one (i.e. missing from the index entry)
+
+        '''
+
+        sha256 = (sha256 or '').lower()
+        if not REGEXP_SHA256.match(sha256):
+            return None
+        return os.path.join(self.directory, sha256[0:2], sha256 + '.xml')
+
+    def entries(self):
+
+        '''
+
+        Generator that yields a os.DirEntry for every filing in the cache
+
+        '''
+
+        for folder in os.scandir(self.directory):
+            if folder.is_dir():
+                for entry in os.scandir(folder.path):
+                    if entry.name.endswith('.xml'):
+                        yield entry
+
+    def get(self, sha256):
+
+        '''
+
+        Returns the bytes of the filing with this sha256 or None when it isn't in the cache
+
+        '''
+
+        path = self.path(sha256)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as file:
+                xml_data = file.read()
+            # Step 1. Mark the filing as recently used (its modification time is what eviction sorts on)
+            os.utime(path)
+            return xml_data
+        except FileNotFoundError:
+            return None
+        except Exception as g:
+            log_error(g, str.format("Issue reading {0} from the xml cache", path), Log_Details)
+            return None
+
+    def put(self, sha256, xml_data):
+
+        '''
+
+        Stores a filing under its sha256 and returns True, returns False when the content doesn't match the sha256 (nothing is stored)
+
+        '''
+
+        # Step 1. Only store filings that are what the index says they are
+        path = self.path(sha256)
+        if path is None or hashlib.sha256(xml_data).hexdigest() != sha256.lower():
+            return False
+        if os.path.isfile(path):
+            return True
+
+        # Step 2. Write to a temporary file & move it in place so a filing is never read half written
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'wb') as file:
+                file.write(xml_data)
+            os.replace(path + '.tmp', path)
+            self.size += len(xml_data)
+        except Exception as g:
+            log_error(g, str.format("Issue writing {0} to the xml cache", path), Log_Details)
+            return False
+
+        # Step 3. Make room when the cache is full
+        if self.size > self.max_bytes:
+            self.evict()
+        return True
+
+    def evict(self):
+
+        '''
+
+        Removes the least recently used filings until the cache is at most EVICT_TO of max_bytes
+
+        '''
+
+        entries = sorted(((entry.stat().st_mtime_ns, entry.stat().st_size, entry.path) for entry in self.entries()))
+        self.size = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in entries:
+            if self.size <= self.max_bytes * EVICT_TO:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+                removed += 1
+            except FileNotFoundError:
+                continue
+        log_progress('', str.format("Removed {0} least recently used filings from the xml cache ({1} bytes left)", removed, self.size), Log_Details)
+
+    def fetch(self, filings, download):
+
+        '''
+
+        Generator that yields a tuple of (xml_link, xml bytes, error) for each filing (index entries with URL & FileSha256) like helpers.xml_downloader.fetch_xmls.
+        Every filing goes through download (fetch_xmls or read_xmls) which reads the ones in the cache instead of downloading them, the rest are
+        downloaded & stored in the cache. filings is read lazily so the whole index can go through one download. A download that doesn't match its
+        FileSha256 is still yielded (the index may be out of date) but not stored.
+
+        '''
+
+        shas = {}           # {xml_link: FileSha256} of the filings handed over to download that weren't yielded yet
+        from_cache = set()  # links download read from the cache
+
+        # Step 1. Hand the links over to download remembering the FileSha256 of each
+        def links():
+            for filing in filings:
+                shas[filing['URL']] = filing.get('FileSha256')
+                yield filing['URL']
+
+        # Step 2. download asks for each link before downloading it, filings we already have don't touch the network
+        def cached(xml_link):
+            xml_data = self.get(shas.get(xml_link))
+            if xml_data is not None:
+                from_cache.add(xml_link)
+            return xml_data
+
+        # Step 3. Yield the filings as they arrive & keep the downloaded ones for next time
+        for xml_link, xml_data, error in download(links(), cached=cached):
+            sha256 = shas.pop(xml_link, None)
+            if xml_link in from_cache:
+                from_cache.discard(xml_link)
+                self.hits += 1
+            else:
+                self.misses += 1
+                if error is None and self.path(sha256) and not self.put(sha256, xml_data):
+                    log_error('', str.format("Download of {0} doesn't match its FileSha256 {1}, not cached", xml_link, sha256), Log_Details)
+            yield xml_link, xml_data, error
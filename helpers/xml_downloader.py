@@ -0,0 +1,258 @@
+import os,sys # allows us to use operating system functions
+import asyncio # allows us to download many filings at the same time on one thread
+import threading # allows the downloads to run next to the parser
+import queue # allows us to hand downloaded filings over to the parser
+import random # allows us to spread retries out so they dont all hit the server at once
+import zipfile # allows us to read filings straight out of the datalake's bulk zip archives (--zip)
+from urllib.parse import urlparse
+from urllib.request import urlopen
+import aiohttp # asyncio http client with connection pooling
+import requests # allows us to download zip archives to disk piece by piece
+from settings.Settings import xml_download_concurrency, xml_download_per_host, xml_download_retries, xml_download_backoff, xml_download_timeout
+from settings.Settings import zip_directory, gt_datalake_zip_location
+from .loggingutil import Log_Details, log_error, log_progress
+from .metrics import METRICS # times every download (when metrics are on)
+
+Log_Details.script = os.path.split(sys.argv[0])[1] # Store name of current script in Log_Details class object as script name. We do this so that error log will always tell us which script error comes from.
+
+RETRY_STATUSES = (429, 500, 502, 503, 504) # Http statuses that are worth trying again i.e. throttling or a hiccup on aws
+DONE = None # Placed on the queue of links once every link was handed over & on the queue of results once every filing has been downloaded
+
+# Overview: Downloads xml filings concurrently with asyncio/aiohttp in a background thread while the parser works on the filings already downloaded.
+# One aiohttp session is shared by every download so connections are kept alive and reused (limited overall and per host).
+# With --zip filings are read out of the datalake's bulk zip archives instead (one sequential read per archive).
+
+
+def fetch_xmls(xml_links, concurrency=xml_download_concurrency, per_host=xml_download_per_host, retries=xml_download_retries, backoff=xml_download_backoff, timeout=xml_download_timeout, cached=None):
+
+    '''
+
+    Generator that downloads xml links and yields a tuple of (xml_link, xml bytes, error) for each one as soon as it is downloaded.
+    Filings are yielded in the order they finish downloading, error is None unless the download failed after all retries (then xml bytes is None).
+    At most concurrency * 2 downloaded filings wait on the queue so a slow parser never causes the downloads to pile up in memory.
+    xml_links is read on this thread, only as far as the downloader has room for, so it can be the (lazy) filings of a whole index even when they come
+    out of generators that query sqlite or mongo. Pass it once per run: the session & its kept alive connections are shared by every download.
+    cached is called (in a thread) with each link before it is downloaded, the bytes it returns are used instead (see XmlCache.fetch).
+
+        Example:
+            form_parser = FormParser(CSV_OBJECT, CSV_TABLE_OBJECT, csv_to_mapping(CSV_OBJECT, CSV_TABLE_OBJECT))
+            for xml_link, xml_data, error in fetch_xmls(['https://gt990datalake-rawdata.s3.amazonaws.com/EfileData/XmlFiles/201803129349301355_public.xml']):
+                form = form_parser.create(xml_link, xml_data)
+
+    '''
+
+    # Step 0. Setup the queues that hand links over to the downloader & filings over to the parser & a flag to stop downloading if the parser stops early
+    links = queue.Queue(maxsize=concurrency * 2)
+    results = queue.Queue(maxsize=concurrency * 2)
+    stop = threading.Event()
+
+    # Step 1. Run the downloads in their own thread (with their own event loop) so they happen while we parse
+    def run():
+        try:
+            asyncio.run(download_xmls(links, results, stop, concurrency, per_host, retries, backoff, timeout, cached))
+        except Exception as g:
+            log_error(g, 'Issue running the xml downloader', Log_Details)
+        finally:
+            put_result(results, stop, DONE)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+    # Step 2. Hand the links over & yield filings as they arrive until the downloader tells us its done
+    xml_links = iter(xml_links)
+    reading = True
+    try:
+        while True:
+            # Step 2a. Top up the links while the downloader has room for them, DONE once there are none left
+            while reading and not links.full():
+                xml_link = next(xml_links, DONE)
+                links.put_nowait(xml_link)
+                reading = xml_link is not DONE
+
+            # Step 2b. Wait for a filing (only a moment while there are links left to hand over)
+            try:
+                result = results.get(timeout=0.05 if reading else None)
+            except queue.Empty:
+                continue
+            if result is DONE:
+                break
+            yield result
+
+    # Step 3. Stop the downloads if the parser stops asking for filings
+    finally:
+        stop.set()
+        thread.join()
+
+
+def read_xmls(xml_links, cached=None):
+
+    '''
+
+    Generator that downloads xml links one after the other (like the parser does) and yields a tuple of (xml_link, xml bytes, error) for each one.
+    Used instead of fetch_xmls when filings have to be downloaded before they are parsed (i.e. to be cached) without --async.
+    cached is called with each link before it is downloaded, the bytes it returns are used instead (see XmlCache.fetch).
+
+    '''
+
+    for xml_link in xml_links:
+        try:
+            xml_data = cached(xml_link) if cached is not None else None
+            if xml_data is None:
+                with METRICS.timer('download'):
+                    xml_data = urlopen(xml_link).read()
+            yield xml_link, xml_data, None
+        except Exception as g:
+            METRICS.count('failed_downloads')
+            yield xml_link, None, g
+
+
+def archive_path(zip_file):
+
+    '''
+
+    Returns the local path of a zip archive named in the ZipFile field of an index i.e. helpers/zips/2023_TEOS_XML_01A.zip
+    The archive is downloaded from the datalake (see gt_datalake_zip_location) the first time it is needed & kept for later runs.
+    Returns None if the archive isn't there and can't be downloaded (its filings are then downloaded one by one).
+
+    '''
+
+    # Step 1. Archives we already have are used as they are
+    file_name = os.path.basename(urlparse(zip_file).path)
+    path = os.path.join(zip_directory, file_name)
+    if os.path.isfile(path):
+        return path
+
+    # Step 2. Otherwise download the archive to a temporary file & move it in place once it is complete
+    full_url = zip_file if urlparse(zip_file).scheme else str.format(gt_datalake_zip_location, file_name)
+    log_progress('', str.format('Downloading & saving zip archive {0} from {1}.', file_name, full_url), Log_Details)
+    try:
+        os.makedirs(zip_directory, exist_ok=True)
+        with requests.get(full_url, stream=True, timeout=xml_download_timeout) as response:
+            response.raise_for_status()
+            with open(path + '.tmp', mode='wb') as file:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    file.write(chunk)
+        os.replace(path + '.tmp', path)
+        return path
+    except Exception as g:
+        log_error(g, str.format('Failed To Download Zip Archive: {0} from {1}', file_name, full_url), Log_Details)
+        return None
+
+
+def read_archive(path, xml_links):
+
+    '''
+
+    Generator that reads the filings behind a list of xml links out of a zip archive without extracting it and yields a tuple of (xml_link, xml bytes, error) for each one.
+    Members are matched on their file name i.e. 202342929349301294_public.xml and read in the order they are stored so the archive is read from start to end.
+
+    '''
+
+    # Step 1. Match each link to the member of the archive with the same file name
+    wanted = {os.path.basename(urlparse(xml_link).path): xml_link for xml_link in xml_links}
+    with zipfile.ZipFile(path) as archive:
+        for member in archive.infolist():
+            xml_link = wanted.pop(os.path.basename(member.filename), None)
+            if xml_link is None:
+                continue
+
+            # Step 2. Read the member into memory (nothing is written to disk)
+            try:
+                yield xml_link, archive.read(member), None
+            except Exception as g:
+                yield xml_link, None, g
+
+    # Step 3. Links the archive doesn't have are reported as errors
+    for xml_link in wanted.values():
+        yield xml_link, None, KeyError(str.format('{0} is not in zip archive {1}', xml_link, path))
+
+
+def put_result(results, stop, result):
+
+    '''
+
+    Places a result on the queue, waiting while the queue is full unless the parser has stopped asking for filings
+
+    '''
+
+    while not stop.is_set():
+        try:
+            results.put(result, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+async def download_xmls(links, results, stop, concurrency, per_host, retries, backoff, timeout, cached=None):
+
+    '''
+
+    Downloads every xml link placed on the links queue (until DONE) with a fixed number of workers sharing one aiohttp session. Each result is placed on the results queue.
+
+    '''
+
+    # Step 0. Setup the connection pool i.e. at most concurrency connections in total & per_host connections per host which are kept alive between downloads
+    loop = asyncio.get_running_loop()
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=per_host)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=client_timeout) as session:
+
+        # Step 1. Each worker takes the next link (DONE is put back for the other workers), reads it from the cache or downloads it & hands it over to the parser
+        async def worker():
+            while not stop.is_set():
+                try:
+                    xml_link = links.get_nowait()
+                except queue.Empty:
+                    await asyncio.sleep(0.01)
+                    continue
+                if xml_link is DONE:
+                    links.put_nowait(DONE)
+                    return
+                try:
+                    xml_data = await loop.run_in_executor(None, cached, xml_link) if cached is not None else None
+                    if xml_data is None:
+                        with METRICS.timer('download'):
+                            xml_data = await download_xml(session, xml_link, retries, backoff)
+                    result = (xml_link, xml_data, None)
+                except Exception as g:
+                    METRICS.count('failed_downloads')
+                    result = (xml_link, None, g)
+
+                # Step 1a. Wait for room on the queue without blocking the other downloads
+                await loop.run_in_executor(None, put_result, results, stop, result)
+
+        # Step 2. Run the workers until every link has been downloaded
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+async def download_xml(session, xml_link, retries, backoff):
+
+    '''
+
+    Downloads one xml link and returns its bytes. Connection errors, timeouts and statuses in RETRY_STATUSES are retried
+    with an exponential backoff (backoff, 2 * backoff, 4 * backoff ... seconds plus some jitter). Links that are not http(s) i.e. file:// are read with urlopen.
+
+    '''
+
+    # Step 1. Links that aiohttp cant handle are read in a thread so they dont block the other downloads
+    if urlparse(xml_link).scheme not in ('http', 'https'):
+        return await asyncio.get_running_loop().run_in_executor(None, lambda: urlopen(xml_link).read())
+
+    # Step 2. Try to download the link until we run out of retries
+    for attempt in range(retries + 1):
+        try:
+            async with session.get(xml_link) as response:
+                response.raise_for_status()
+                return await response.read()
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as g:
+
+            # Step 2a. Give up when out of retries or when the server told us the link is no good i.e. 404
+            if attempt == retries or (isinstance(g, aiohttp.ClientResponseError) and g.status not in RETRY_STATUSES):
+                raise
+
+            # Step 2b. Wait before trying again
+            delay = backoff * (2 ** attempt) * (1 + random.random())
+            log_progress(g, str.format('Retrying download of {0} in {1:.1f} seconds (attempt {2} of {3})', xml_link, delay, attempt + 1, retries), Log_Details)
+            await asyncio.sleep(delay)
@@ -8,15 +8,31 @@ gt_datalake_index_location = 'https://gt990datalake-rawdata.s3.amazonaws.com/Ind
    We recommend setting up a database called: irs_xml 
    with the following collections: 
    	  - 990 		- For all 990 xml forms smaller than 16mb
-   	  - 990b 		- To store large pickle files of form 990s that surpass 16mb mongo doc limit
+   	  - 990b 		- To store form 990s that surpass 16mb mongo doc limit as compressed bson (see helpers/database/large_documents.py)
    	  - 990EZ 		- For all 990ez xml forms smaller than 16mb
-   	  - 990EZb		- To store large pickle files of form 990ez that surpass 16mb mongo doc limit
+   	  - 990EZb		- To store form 990ez that surpass 16mb mongo doc limit as compressed bson
    	  - 990PF 		- For all 990pf xml forms smaller than 16mb
-   	  - 990PFb 		- To store large pickle files of form 990pf that surpass 16mb mongo doc limit
+   	  - 990PFb 		- To store form 990pf that surpass 16mb mongo doc limit as compressed bson
    	  - schedules 	- For all schedules forms smaller than 16mb
-   	  - schedulesb  - To store large pickle files of schedules that surpass 16mb mongo doc limit
+   	  - schedulesb  - To store schedules that surpass 16mb mongo doc limit as compressed bson
+   	  - rows_*      - With --normalize-tables one collection per table i.e. rows_GRANTS_SI_PART_II, a document per row (see helpers/database/table_rows.py)
 '''
 
+### XML Download Details --- Used when filings are downloaded concurrently (--async see helpers/xml_downloader.py)
+xml_download_concurrency = 32   # Number of filings downloaded at the same time (also the size of the connection pool)
+xml_download_per_host = 16      # Max number of connections open to the same host i.e. the datalake on aws
+xml_download_retries = 3        # Number of times a failed download (connection error, timeout, 429 or 5xx) is tried again
+xml_download_backoff = 0.5      # Seconds to wait before the first retry, doubled on every retry
+xml_download_timeout = 60       # Seconds a single download may take before it is considered failed
+
+### XML Cache Details --- Used when downloaded filings are kept on disk by sha256 (--cache see helpers/xml_cache.py)
+xml_cache_directory = os.path.join('helpers', 'xml_cache') # Folder the filings are stored in
+xml_cache_max_bytes = 20 * 1024 ** 3                       # Size in bytes the cache may grow to (20gb) before the least recently used filings are removed
+
+### ZIP Archive Details --- Used when filings are read out of the datalake's bulk zip archives (--zip see helpers/xml_downloader.py)
+zip_directory = os.path.join('helpers', 'zips') # Folder archives are read from (archives that aren't there are downloaded into it)
+gt_datalake_zip_location = 'https://gt990datalake-rawdata.s3.amazonaws.com/EfileData/ZipFiles/{0}' # Location of an archive named in the ZipFile field of an index
+
 ### Mongo Details ----- Details to local, prod mongo along with basic database details
 mongo_qa_details = 'mongodb://localhost:27017/'# Local host server details
 mongo_production_details = 'mongodb://localhost:27017/' # Production server details
@@ -24,6 +40,21 @@ mongo_max_document_size = 16777216 			   # Measured in Bytes max size of mongo d
 mongo_database_name = 'irs_xml' 			   # Main Mongo DB Name where we store our collection(s) of documments
 schedules_reg_collection_name = 'schedules'   # Name of Schedules Collection for documents < 16mb in size
 schedules_large_collection_name = 'schedulesb' # Name of Schedules Collection for documents > 16mb in size
+mongo_bulk_flush_seconds = 30                  # Seconds after which buffered forms are written to mongo even if the batch (-l) isn't full
+mongo_gridfs_compression = 'zstd'              # Compression of documents larger than mongo_max_document_size stored in gridfs: zstd (zlib when pyarrow has no zstd), zlib or none
+mongo_gridfs_compression_level = 3             # Compression level (zstd 1-22, zlib 1-9)
+table_rows_collection_prefix = 'rows_'         # Tables stored as a document per row (--normalize-tables) go to a collection per table i.e. rows_GRANTS_SI_PART_II
+checkpoint_database = os.path.join('helpers', 'checkpoints.sqlite') # Local sqlite that remembers the filings stored in mongo (ObjectId & FileSha256) used by --since-last-run
+
+### Output Details --- Used when forms are written to files instead of mongo (--sink parquet/ndjson/columnar see helpers/database/sinks.py)
+sink_output_directory = 'output' # Folder the files are written to unless --output is passed
+
+### Metrics Details --- Used when timings of each stage are kept (--metrics-port / --metrics-file see helpers/metrics.py)
+metrics_interval_seconds = 15 # Seconds between two writes of the stats file (--metrics-file)
+
+### Progress Details --- How often the parser reports its progress (see ProgressSummary in helpers/loggingutil.py)
+progress_every_filings = 1000 # Filings processed between two progress summaries
+progress_every_seconds = 30   # Seconds after which a progress summary is printed & logged even if progress_every_filings weren't processed
 
 ### Mapping & Concordance Deatils --- These two files refer to the concordance file created by the Nonprofit Data Collaborative
 #   one file - mapping- contains main variables for all form 990,990ez,990pf, and schedules
@@ -0,0 +1,120 @@
+'''
+    Tests for the concurrent xml downloader (helpers/xml_downloader.py) against a local http stand-in server
+
+    Run from the main repository level:
+
+        python3 -m unittest discover tests
+'''
+
+import collections  # counts the requests the stand-in server receives per path
+import threading  # the stand-in server runs next to the tests
+import time  # allows the downloader to fill its queue
+import unittest  # test framework
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler  # local http stand-in for the datalake
+from helpers.xml_downloader import fetch_xmls
+
+
+class StandInHandler (BaseHTTPRequestHandler):
+
+    '''
+
+    Answers like the datalake would: /flaky/... is 503 for its first 2 requests then 200, /missing/... is 404 & everything else is 200
+    with a small filing that holds its own path
+
+    '''
+
+    protocol_version = 'HTTP/1.1' # keeps connections alive like s3 does
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.hits[self.path] += 1
+            hits = self.server.hits[self.path]
+        if self.path.startswith('/flaky') and hits < 3:
+            status, body = 503, b'slow down'
+        elif self.path.startswith('/missing'):
+            status, body = 404, b'not found'
+        else:
+            status, body = 200, str.format('<Return>{0}</Return>', self.path).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FetchXmlsTest (unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.server.daemon_threads = True
+        self.server.hits = collections.Counter()
+        self.server.lock = threading.Lock()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = str.format('http://127.0.0.1:{0}', self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_downloads_every_link(self):
+        links = [str.format('{0}/{1}_public.xml', self.base, position) for position in range(50)]
+        results = {xml_link: (xml_data, error) for xml_link, xml_data, error in fetch_xmls(links, concurrency=8, per_host=4)}
+        self.assertEqual(set(results), set(links))
+        for xml_link, (xml_data, error) in results.items():
+            self.assertIsNone(error)
+            self.assertEqual(xml_data, str.format('<Return>{0}</Return>', xml_link[len(self.base):]).encode('utf-8'))
+
+    def test_retries_503_until_it_succeeds(self):
+        results = list(fetch_xmls([self.base + '/flaky/1_public.xml'], retries=3, backoff=0.01))
+        self.assertEqual(results, [(self.base + '/flaky/1_public.xml', b'<Return>/flaky/1_public.xml</Return>', None)])
+        self.assertEqual(self.server.hits['/flaky/1_public.xml'], 3)
+
+    def test_404_fails_without_retry(self):
+        [(xml_link, xml_data, error)] = list(fetch_xmls([self.base + '/missing/1_public.xml'], retries=3, backoff=0.01))
+        self.assertIsNone(xml_data)
+        self.assertIsNotNone(error)
+        self.assertEqual(self.server.hits['/missing/1_public.xml'], 1)
+
+    def test_closing_early_stops_the_downloads(self):
+        links = [str.format('{0}/{1}_public.xml', self.base, position) for position in range(500)]
+        downloads = fetch_xmls(links, concurrency=4)
+        next(downloads)
+        downloads.close()
+        requested = sum(self.server.hits.values())
+        time.sleep(0.2)
+        self.assertLess(requested, len(links))
+        self.assertEqual(sum(self.server.hits.values()), requested)
+
+    def test_links_are_read_on_the_callers_thread(self):
+        # Links of an index come out of generators that query sqlite (bound to its thread) so fetch_xmls must not read them on the download thread
+        threads = set()
+        def links():
+            for position in range(20):
+                threads.add(threading.get_ident())
+                yield str.format('{0}/{1}_public.xml', self.base, position)
+        self.assertEqual(len(list(fetch_xmls(links(), concurrency=4))), 20)
+        self.assertEqual(threads, {threading.get_ident()})
+
+    def test_cached_filings_are_not_downloaded(self):
+        links = [str.format('{0}/{1}_public.xml', self.base, position) for position in range(10)]
+        cached = lambda xml_link: b'<Return>cached</Return>' if xml_link.endswith('/1_public.xml') else None
+        results = {xml_link: xml_data for xml_link, xml_data, error in fetch_xmls(links, concurrency=4, cached=cached)}
+        self.assertEqual(results[self.base + '/1_public.xml'], b'<Return>cached</Return>')
+        self.assertEqual(self.server.hits['/1_public.xml'], 0)
+        self.assertEqual(sum(self.server.hits.values()), 9)
+
+    def test_queue_is_bounded(self):
+        # With nobody taking filings off the queue at most concurrency * 2 wait on it, each worker holds one more & one was taken
+        concurrency = 2
+        links = [str.format('{0}/{1}_public.xml', self.base, position) for position in range(100)]
+        downloads = fetch_xmls(links, concurrency=concurrency)
+        next(downloads)
+        time.sleep(0.5)
+        self.assertLessEqual(sum(self.server.hits.values()), concurrency * 2 + concurrency + 1)
+        downloads.close()
+
+
+if __name__ == '__main__':
+    unittest.main()